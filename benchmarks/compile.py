@@ -0,0 +1,236 @@
+"""Measures the end-to-end compile time of the presets on a synthetic tree.
+
+Generates a proto tree (see protogen.py) and compiles it with every preset,
+first with an empty toolchain cache (cold) and then with the warm cache.
+Downloads are served offline by a local mirror (see mirror.py) that wraps the
+local protoc. Every run is a fresh process that reports its wall time,
+discovery and bootstrap time, the protoc time per target (from the --profile
+spans) and the peak RSS of the process and of its children.
+Use ``--json`` or ``--output`` for machine-readable results.
+
+    $ python benchmarks/compile.py --files 500 --messages 20
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import typing
+from pathlib import Path
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from mirror import Mirror, write_stub_plugin  # noqa: E402
+from protogen import generate_tree  # noqa: E402
+
+from proto_compile import proto_compile as compiler  # noqa: E402
+from proto_compile.options import (  # noqa: E402
+    BaseCompilerOptions,
+    CompilerOptions,
+    CompileTarget,
+)
+from proto_compile.profiling import REPORT_FILE  # noqa: E402
+from proto_compile.versions import (  # noqa: E402
+    DEFAULT_PLUGIN_VERSIONS,
+    DEFAULT_PROTOC_VERSION,
+    Target,
+)
+
+PRESETS = ["compile", "python-grpc", "grpc-web"]
+
+
+def peak_rss_mb(who: int) -> float:
+    rss = resource.getrusage(who).ru_maxrss
+    # kilobytes on linux, bytes on macos
+    return rss / (1 << 20) if sys.platform == "darwin" else rss / (1 << 10)
+
+
+def run_preset(spec: typing.Dict[str, typing.Any]) -> typing.Dict[str, typing.Any]:
+    """Compiles the tree with a preset in this process and measures it"""
+    os.environ["PATH"] = spec["bin_dir"] + os.pathsep + os.environ["PATH"]
+
+    profile_dir = Path(spec["profile_dir"])
+    options = BaseCompilerOptions(
+        proto_source_dir=spec["source_dir"],
+        output_dir=spec["output_dir"],
+        clear_output_dirs=True,
+        protoc_version=spec["protoc_version"],
+        protoc_sha256=spec["protoc_sha256"],
+        cache_dir=spec["cache_dir"],
+        jobs=spec["jobs"],
+        embedded_protoc=spec["embedded_protoc"],
+        profile=profile_dir,
+        mirror=spec["mirror"],
+        offline=True,
+    )
+    started = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        if spec["preset"] == "python-grpc":
+            compiler.compile_python_grpc(options)
+        elif spec["preset"] == "grpc-web":
+            compiler.compile_grpc_web(options)
+        else:
+            compiler.compile(
+                CompilerOptions(
+                    options,
+                    targets=[CompileTarget(Target.PYTHON), CompileTarget(Target.CPP)],
+                )
+            )
+    wall = time.perf_counter() - started
+
+    with open(profile_dir / REPORT_FILE) as f:
+        totals = json.load(f)["totals"]
+
+    def total(name: str) -> float:
+        return float(sum(t["total"] for t in totals if t["name"] == name))
+
+    return dict(
+        preset=spec["preset"],
+        run=spec["run"],
+        wall=wall,
+        discovery=total("discover"),
+        bootstrap=total("bootstrap"),
+        targets={
+            t["name"][len("compile ") :]: t["total"]
+            for t in totals
+            if t["category"] == "protoc" and t["name"].startswith("compile ")
+        },
+        peak_rss_mb=peak_rss_mb(resource.RUSAGE_SELF),
+        peak_children_rss_mb=peak_rss_mb(resource.RUSAGE_CHILDREN),
+    )
+
+
+def run_child(spec: typing.Dict[str, typing.Any]) -> typing.Dict[str, typing.Any]:
+    """Runs a preset in a fresh process, so that its peak RSS is its own"""
+    result = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), "--child", json.dumps(spec)],
+        cwd=ROOT_DIR,
+        stdout=subprocess.PIPE,
+        check=True,
+    )
+    return dict(json.loads(result.stdout.decode().splitlines()[-1]))
+
+
+def benchmark(args: argparse.Namespace, work_dir: Path) -> typing.Dict[str, typing.Any]:
+    source_dir = work_dir / "protos"
+    started = time.perf_counter()
+    generate_tree(
+        source_dir,
+        files=args.files,
+        messages=args.messages,
+        depth=args.depth,
+        fanout=args.fanout,
+    )
+    generated = time.perf_counter() - started
+
+    mirror = Mirror(work_dir / "mirror")
+    try:
+        protoc_sha256 = mirror.add_protoc(args.protoc_version, args.protoc)
+        mirror.add_grpc_web(DEFAULT_PLUGIN_VERSIONS[Target.GRPC_WEB])
+        # protoc >= 21 has no builtin javascript generator
+        bin_dir = work_dir / "bin"
+        write_stub_plugin(bin_dir, "protoc-gen-js", "_pb.js")
+
+        runs = []
+        for preset in args.presets:
+            spec = dict(
+                preset=preset,
+                source_dir=str(source_dir),
+                output_dir=str(work_dir / "out" / preset),
+                cache_dir=str(work_dir / "cache" / preset),
+                profile_dir=str(work_dir / "profile"),
+                protoc_version=args.protoc_version,
+                protoc_sha256=protoc_sha256,
+                mirror=mirror.url,
+                bin_dir=str(bin_dir),
+                jobs=args.jobs,
+                embedded_protoc=args.embedded_protoc,
+            )
+            runs.append(run_child(dict(spec, run="cold")))
+            warm = [run_child(dict(spec, run="warm")) for _ in range(args.warm_runs)]
+            # the fastest run is the least noisy
+            runs.append(min(warm, key=lambda r: r["wall"]))
+    finally:
+        mirror.close()
+
+    config = {
+        k: v for k, v in vars(args).items() if k not in ["json", "output", "child"]
+    }
+    return dict(config=config, generate=generated, runs=runs)
+
+
+def print_results(results: typing.Dict[str, typing.Any]) -> None:
+    print(
+        "{:<12} {:<5} {:>9} {:>9} {:>9} {:>10} {:>10}".format(
+            "preset", "run", "wall", "discover", "bootstrap", "rss", "child rss"
+        )
+    )
+    for run in results["runs"]:
+        print(
+            "{:<12} {:<5} {:>8.3f}s {:>8.3f}s {:>8.3f}s {:>7.1f} MB {:>7.1f} MB".format(
+                run["preset"],
+                run["run"],
+                run["wall"],
+                run["discovery"],
+                run["bootstrap"],
+                run["peak_rss_mb"],
+                run["peak_children_rss_mb"],
+            )
+        )
+        for target, seconds in sorted(run["targets"].items()):
+            print("    {:<30} {:>8.3f}s".format(target, seconds))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--files", type=int, default=200, help="proto files")
+    parser.add_argument("--messages", type=int, default=10, help="messages per file")
+    parser.add_argument("--depth", type=int, default=3, help="import depth")
+    parser.add_argument("--fanout", type=int, default=2, help="imports per file")
+    parser.add_argument(
+        "--presets", nargs="+", default=PRESETS, choices=PRESETS, help="presets"
+    )
+    parser.add_argument("--jobs", type=int, default=0, help="see --jobs of the cli")
+    parser.add_argument("--warm-runs", type=int, default=3, help="warm runs")
+    parser.add_argument(
+        "--protoc", default=shutil.which("protoc"), help="protoc served by the mirror"
+    )
+    parser.add_argument("--protoc-version", default=DEFAULT_PROTOC_VERSION)
+    parser.add_argument(
+        "--embedded-protoc",
+        action="store_true",
+        help="allow the protoc bundled with grpcio-tools",
+    )
+    parser.add_argument("--json", action="store_true", help="print json results")
+    parser.add_argument("--output", type=Path, help="write json results to a file")
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child is not None:
+        print(json.dumps(run_preset(json.loads(args.child))))
+        return
+    if args.protoc is None:
+        parser.error("no protoc found, use --protoc")
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        results = benchmark(args, Path(work_dir))
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print_results(results)
+
+
+if __name__ == "__main__":
+    main()
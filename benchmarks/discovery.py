@@ -0,0 +1,83 @@
+"""Compares the discovery of .proto files with and without the index.
+
+Generates a synthetic source tree with --files files, a tenth of them
+.proto files, plus a node_modules and a .git dir of the same size, and
+times a plain recursive glob, a cold discovery and a warm discovery with
+an index. Use ``--json`` for machine-readable results.
+
+    $ python benchmarks/discovery.py --files 100000
+"""
+
+import argparse
+import glob
+import json
+import os
+import sys
+import tempfile
+import time
+import typing
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from proto_compile.discovery import discover  # noqa: E402
+
+FILES_PER_DIR = 50
+
+
+def generate_tree(root: str, files: int) -> None:
+    """Writes files empty files into nested dirs below root"""
+    for top in ["src", "node_modules", ".git"]:
+        for i in range(files // 3):
+            directory = os.path.join(
+                root,
+                top,
+                "d%d" % (i // FILES_PER_DIR % 20),
+                "d%d" % (i // FILES_PER_DIR),
+            )
+            os.makedirs(directory, exist_ok=True)
+            suffix = ".proto" if i % 10 == 0 else ".txt"
+            open(os.path.join(directory, "f%d%s" % (i, suffix)), "w").close()
+
+
+def timed(fn: typing.Callable[[], typing.List[str]]) -> typing.Tuple[float, int]:
+    started = time.perf_counter()
+    found = fn()
+    return time.perf_counter() - started, len(found)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--files", type=int, default=100000, help="files to generate")
+    parser.add_argument("--json", action="store_true", help="print json results")
+    args = parser.parse_args()
+
+    results: typing.Dict[str, typing.Dict[str, typing.Any]] = dict()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        root = os.path.join(tmp_dir, "tree")
+        generate_tree(root, args.files)
+        index = os.path.join(tmp_dir, "index.json")
+        runs = [
+            (
+                "glob",
+                lambda: glob.glob(os.path.join(root, "**/*.proto"), recursive=True),
+            ),
+            ("cold", lambda: discover(root, index_path=index)),
+            ("warm", lambda: discover(root, index_path=index)),
+        ]
+        for name, fn in runs:
+            seconds, found = timed(fn)
+            results[name] = dict(seconds=seconds, files=found)
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    for name, result in results.items():
+        print(
+            "{:<6} {:>8.1f} ms {:>8} files".format(
+                name, result["seconds"] * 1000, result["files"]
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
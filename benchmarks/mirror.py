@@ -0,0 +1,99 @@
+"""Local mirror of the release downloads, so that benchmarks need no network.
+
+The mirror serves a protoc release that wraps a local protoc and stub code
+generator plugins in the layout of a --mirror (see proto_compile/mirrors.py).
+"""
+
+import functools
+import hashlib
+import http.server
+import os
+import sys
+import threading
+import typing
+import zipfile
+from pathlib import Path
+
+from proto_compile.mirrors import GRPC_WEB_DIR, PROTOC_DIR
+from proto_compile.plugins import grpc_web_release_url, protoc_release_url
+
+# a protoc plugin that writes one small file per generated proto file
+STUB_PLUGIN = """#!{python}
+import sys
+from google.protobuf.compiler import plugin_pb2
+
+request = plugin_pb2.CodeGeneratorRequest.FromString(sys.stdin.buffer.read())
+response = plugin_pb2.CodeGeneratorResponse()
+for name in request.file_to_generate:
+    generated = response.file.add()
+    generated.name = name[: -len(".proto")] + "{suffix}"
+    generated.content = "// generated from " + name + "\\n"
+sys.stdout.buffer.write(response.SerializeToString())
+"""
+
+
+def stub_plugin(suffix: str) -> str:
+    return STUB_PLUGIN.format(python=sys.executable, suffix=suffix)
+
+
+class Mirror:
+    """HTTP server that serves release artifacts from a directory"""
+
+    def __init__(self, root: Path) -> None:
+        self.root = root
+        self.root.mkdir(parents=True, exist_ok=True)
+        handler = functools.partial(QuietHandler, directory=str(root))
+        self.httpd = http.server.ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+
+    @property
+    def url(self) -> str:
+        return "http://127.0.0.1:%d" % self.httpd.server_address[1]
+
+    def close(self) -> None:
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def add(self, path: str, content: bytes) -> str:
+        """Serves content at path and returns its sha256"""
+        dest = self.root / path
+        dest.parent.mkdir(parents=True, exist_ok=True)
+        dest.write_bytes(content)
+        return hashlib.sha256(content).hexdigest()
+
+    def protoc_base_url(self) -> str:
+        return self.url + "/" + PROTOC_DIR
+
+    def add_protoc(self, version: str, protoc: str) -> str:
+        """Serves a protoc release whose bin/protoc runs the given protoc"""
+        url = protoc_release_url(version, base_url=self.protoc_base_url())
+        archive = self.root / url[len(self.url) + 1 :]
+        archive.parent.mkdir(parents=True, exist_ok=True)
+        with zipfile.ZipFile(archive, "w") as zf:
+            info = zipfile.ZipInfo("bin/protoc")
+            info.external_attr = 0o755 << 16
+            zf.writestr(info, '#!/bin/sh\nexec {} "$@"\n'.format(protoc))
+        return hashlib.sha256(archive.read_bytes()).hexdigest()
+
+    def grpc_web_base_url(self) -> str:
+        return self.url + "/" + GRPC_WEB_DIR
+
+    def add_grpc_web(self, version: str) -> None:
+        """Serves a stub protoc-gen-grpc-web release"""
+        url = grpc_web_release_url(version, base_url=self.grpc_web_base_url())
+        self.add(url[len(self.url) + 1 :], stub_plugin("_grpc_web_pb.js").encode())
+
+
+def write_stub_plugin(bin_dir: Path, name: str, suffix: str) -> Path:
+    """Writes a stub plugin into bin_dir, e.g. protoc-gen-js for protoc >= 21"""
+    bin_dir.mkdir(parents=True, exist_ok=True)
+    path = bin_dir / name
+    path.write_text(stub_plugin(suffix))
+    os.chmod(path, 0o755)
+    return path
+
+
+class QuietHandler(http.server.SimpleHTTPRequestHandler):
+    def log_message(self, format: str, *args: typing.Any) -> None:
+        pass
@@ -0,0 +1,95 @@
+"""Generates synthetic proto trees for benchmarks.
+
+The files are spread over depth + 1 layers. Files of layer 0 import nothing,
+every file of a deeper layer imports fanout files of the layer below and
+references their messages, so that the import depth and fan-out of the tree
+can be tuned independently of its size.
+
+    $ python benchmarks/protogen.py /tmp/protos --files 1000 --messages 20
+"""
+
+import argparse
+import random
+import typing
+from pathlib import Path
+
+
+def proto_path(layer: int, index: int) -> str:
+    return "layer{}/file{}.proto".format(layer, index)
+
+
+def generate_tree(
+    root: Path,
+    files: int = 100,
+    messages: int = 10,
+    depth: int = 3,
+    fanout: int = 2,
+    services: bool = True,
+    seed: int = 0,
+) -> typing.List[Path]:
+    """Writes files proto files with messages messages each below root"""
+    rng = random.Random(seed)
+    layers: typing.List[typing.List[int]] = [[] for _ in range(depth + 1)]
+    for index in range(files):
+        layers[index % (depth + 1)].append(index)
+
+    paths = []
+    for layer, indices in enumerate(layers):
+        below = layers[layer - 1] if layer > 0 else []
+        for index in indices:
+            imports = sorted(rng.sample(below, min(fanout, len(below))))
+            lines = [
+                'syntax = "proto3";',
+                "package bench.layer{}.file{};".format(layer, index),
+                "",
+            ]
+            lines += ['import "{}";'.format(proto_path(layer - 1, i)) for i in imports]
+            lines.append("")
+            for message in range(messages):
+                lines.append("message M{} {{".format(message))
+                lines.append("  string name = 1;")
+                lines.append("  int64 id = 2;")
+                lines.append("  repeated double values = 3;")
+                lines.append("  map<string, string> labels = 4;")
+                for field, i in enumerate(imports, start=5):
+                    lines.append(
+                        "  bench.layer{}.file{}.M{} dep{} = {};".format(
+                            layer - 1, i, message, field, field
+                        )
+                    )
+                lines.append("}")
+            if services and messages > 0:
+                lines.append("")
+                lines.append("service Service{} {{".format(index))
+                lines.append("  rpc Get(M0) returns (M0);")
+                lines.append("  rpc List(M0) returns (stream M0);")
+                lines.append("}")
+            path = root / proto_path(layer, index)
+            path.parent.mkdir(parents=True, exist_ok=True)
+            path.write_text("\n".join(lines) + "\n")
+            paths.append(path)
+    return paths
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("root", type=Path, help="directory to write the tree to")
+    parser.add_argument("--files", type=int, default=100)
+    parser.add_argument("--messages", type=int, default=10)
+    parser.add_argument("--depth", type=int, default=3)
+    parser.add_argument("--fanout", type=int, default=2)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    paths = generate_tree(
+        args.root,
+        files=args.files,
+        messages=args.messages,
+        depth=args.depth,
+        fanout=args.fanout,
+        seed=args.seed,
+    )
+    print("wrote {} proto files to {}".format(len(paths), args.root))
+
+
+if __name__ == "__main__":
+    main()
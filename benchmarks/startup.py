@@ -0,0 +1,80 @@
+"""Reports the import time of the proto-compile cli for every subcommand.
+
+Runs ``python -X importtime -m proto_compile.cli ... --help`` in a fresh
+interpreter per subcommand and prints the total import time and the slowest
+top-level imports. Use ``--json`` for machine-readable results.
+
+    $ python benchmarks/startup.py
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import typing
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SUBCOMMANDS = [[], ["grpc-web"], ["node-grpc"], ["python-grpc"]]
+
+
+def import_times(
+    arguments: typing.List[str],
+) -> typing.Tuple[int, typing.Dict[str, int]]:
+    """Returns the total and the self import time of each module in microseconds"""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        cli_arguments = [tmp_dir, tmp_dir] + arguments + ["--help"]
+        result = subprocess.run(
+            [sys.executable, "-X", "importtime", "-m", "proto_compile.cli"]
+            + cli_arguments,
+            cwd=ROOT_DIR,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE,
+            check=True,
+        )
+    total = 0
+    times: typing.Dict[str, int] = dict()
+    for line in result.stderr.decode().splitlines():
+        # import time: self [us] | cumulative | imported package
+        if not line.startswith("import time:"):
+            continue
+        self_us, cumulative_us, module = line[len("import time:") :].split("|")
+        if not self_us.strip().isdigit():
+            continue
+        times[module.strip()] = int(self_us)
+        # nested imports are indented and part of the cumulative time
+        if not module.startswith("  "):
+            total += int(cumulative_us)
+    return total, times
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--json", action="store_true", help="print json results")
+    parser.add_argument("--top", type=int, default=5, help="slowest imports to show")
+    parser.add_argument("--repeat", type=int, default=5, help="runs per subcommand")
+    args = parser.parse_args()
+
+    results: typing.Dict[str, typing.Dict[str, typing.Any]] = dict()
+    for subcommand in SUBCOMMANDS:
+        # the fastest of several runs is the least noisy
+        runs = [import_times(subcommand) for _ in range(args.repeat)]
+        total, times = min(runs, key=lambda run: run[0])
+        name = " ".join(subcommand) or "--help"
+        results[name] = dict(
+            total_us=total,
+            slowest=sorted(times.items(), key=lambda t: -t[1])[: args.top],
+        )
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    for name, result in results.items():
+        print("{:<12} {:>8.1f} ms".format(name, result["total_us"] / 1000))
+        for module, us in result["slowest"]:
+            print("    {:<40} {:>8.1f} ms".format(module, us / 1000))
+
+
+if __name__ == "__main__":
+    main()
@@ -8,10 +8,13 @@ __version__ = "0.1.7"
 
 from proto_compile.options import BaseCompilerOptions, CompilerOptions, CompileTarget
 from proto_compile.proto_compile import *
+from proto_compile.result import CompileResult
 from proto_compile.versions import Target
 
 __all__ = [
     "compile",
+    "CompilationError",
+    "CompileResult",
     "compile_grpc_web",
     "compile_python_grpc",
     "Target",
@@ -19,3 +22,20 @@ __all__ = [
     "CompileTarget",
     "CompilerOptions",
 ]
+
+# asyncio is only imported once the asyncio API is used
+_ASYNC = [
+    "compile_async",
+    "compile_grpc_web_async",
+    "compile_node_grpc_async",
+    "compile_python_grpc_async",
+]
+__all__ += _ASYNC
+
+
+def __getattr__(name: str) -> object:
+    if name in _ASYNC:
+        from proto_compile import aio
+
+        return getattr(aio, name)
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
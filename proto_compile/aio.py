@@ -0,0 +1,219 @@
+"""Compiles on an asyncio event loop.
+
+protoc runs as a subprocess of the event loop, so one loop drives many
+concurrent compilations without a thread per compilation. The protoc runs of
+all compilations share a limiter, by default one slot per cpu and loop. The
+blocking steps (discovery, installing the toolchain, the remote cache and
+reconciling the outputs) run on the default executor of the loop.
+
+Cancelling a compilation kills its protoc processes. The output dirs are left
+untouched, as the staged outputs are only reconciled once all protoc runs
+succeeded.
+"""
+
+import asyncio
+import os
+import shutil
+import tempfile
+import typing
+import weakref
+from pathlib import Path
+
+from proto_compile import daemon as daemon
+from proto_compile import profiling as profiling
+from proto_compile import result as result
+from proto_compile import versions as versions
+from proto_compile.cache import ToolchainCache
+from proto_compile.options import BaseCompilerOptions, CompilerOptions, CompileTarget
+from proto_compile.proto_compile import (
+    CompilationError,
+    CompileJob,
+    CompileUnit,
+    NodeGrpcOptions,
+    TargetInvocation,
+    grpc_web_options,
+    install_toolchain,
+    node_grpc_options,
+    python_grpc_options,
+    reconcile,
+    record_versions,
+    resolve_plugins,
+    show_temp_dir,
+)
+from proto_compile.result import CompileResult
+from proto_compile.staging import OutputStaging
+from proto_compile.utils import PathLike, to_thread
+from proto_compile.versions import Target
+
+_limiters: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, asyncio.Semaphore]" = (
+    weakref.WeakKeyDictionary()
+)
+
+
+def default_limiter() -> asyncio.Semaphore:
+    """Returns the limiter shared by all compilations of the running loop"""
+    loop = asyncio.get_running_loop()
+    limiter = _limiters.get(loop)
+    if limiter is None:
+        limiter = _limiters[loop] = asyncio.Semaphore(os.cpu_count() or 1)
+    return limiter
+
+
+async def compile_unit_async(
+    invocation: TargetInvocation,
+    arguments: typing.List[str],
+    limiter: asyncio.Semaphore,
+    verbosity: int = 0,
+) -> None:
+    name = "compile " + ", ".join(t.language.name.lower() for t in invocation.targets)
+    async with limiter:
+        with profiling.span(name, "protoc", arguments=len(arguments)):
+            await invocation.compiler.compile_async(arguments, verbosity=verbosity)
+
+
+async def run_units_async(
+    units: typing.List[CompileUnit],
+    limiter: asyncio.Semaphore,
+    verbosity: int = 0,
+) -> None:
+    """Runs every unit as a task of the loop, see compile_units().
+
+    Once cancelled, all units are cancelled and awaited.
+    """
+    tasks = [
+        asyncio.ensure_future(
+            compile_unit_async(invocation, arguments, limiter, verbosity=verbosity)
+        )
+        for invocation, arguments in units
+    ]
+    try:
+        outcomes = await asyncio.gather(*tasks, return_exceptions=True)
+    except asyncio.CancelledError:
+        for task in tasks:
+            task.cancel()
+        await asyncio.wait(tasks)
+        raise
+
+    failures: typing.List[typing.Tuple[CompileTarget, Exception]] = []
+    for (invocation, _), outcome in zip(units, outcomes):
+        if isinstance(outcome, asyncio.CancelledError):
+            raise outcome
+        if isinstance(outcome, Exception):
+            failures += [(target, outcome) for target in invocation.targets]
+    if failures:
+        raise CompilationError(failures)
+
+
+async def compile_async(
+    options: CompilerOptions, limiter: typing.Optional[asyncio.Semaphore] = None
+) -> CompileResult:
+    """Compiles options like compile() on the running event loop.
+
+    At most limiter protoc runs of all compilations sharing it run at once,
+    None shares default_limiter(). Watching for changes is not supported.
+    """
+    if options.watch:
+        raise ValueError("compile_async cannot watch for changes")
+    if options.daemon_socket is not None:
+        forwarded = await to_thread(daemon.forward, options, options.daemon_socket)
+        if forwarded is not None:
+            return forwarded
+    with profiling.profiled(options.profile), result.recording() as compiled:
+        await _compile_async(options, limiter or default_limiter())
+    return compiled
+
+
+async def _compile_async(options: CompilerOptions, limiter: asyncio.Semaphore) -> None:
+    cache = (
+        ToolchainCache(options.cache_dir, verbosity=options.verbosity)
+        if options.use_cache
+        else None
+    )
+    job = await to_thread(CompileJob.prepare, options, cache)
+    if job is None:
+        return
+
+    tmp_dir = Path(tempfile.mkdtemp())
+    try:
+        staging = OutputStaging(tmp_dir / "staging")
+        if await to_thread(job.fetch_outputs, staging, tmp_dir):
+            record_versions(options, None)
+        else:
+            target_plugins = resolve_plugins(options, tmp_dir, cache=cache)
+            proto_compiler, installed_plugins = await to_thread(
+                install_toolchain, options, target_plugins, cache, tmp_dir
+            )
+            record_versions(options, installed_plugins)
+            await to_thread(show_temp_dir, tmp_dir, options.verbosity)
+
+            units = await to_thread(
+                job.units,
+                proto_compiler,
+                target_plugins,
+                installed_plugins,
+                tmp_dir,
+                staging,
+            )
+            await run_units_async(units, limiter, verbosity=options.verbosity)
+            await to_thread(job.store_outputs, staging, tmp_dir)
+        await to_thread(reconcile, staging, [job], options.verbosity)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+async def compile_grpc_web_async(
+    options: BaseCompilerOptions,
+    js_out_options: typing.Optional[str] = "import_style=commonjs,binary",
+    js_output_dir: typing.Optional[PathLike] = None,
+    grpc_web_out_options: typing.Optional[str] = None,
+    grpc_web_plugin_version: typing.Optional[str] = versions.DEFAULT_PLUGIN_VERSIONS[
+        Target.GRPC_WEB
+    ],
+    grpc_web_output_dir: typing.Optional[PathLike] = None,
+    improbable: bool = False,
+    limiter: typing.Optional[asyncio.Semaphore] = None,
+) -> CompileResult:
+    return await compile_async(
+        grpc_web_options(
+            options,
+            js_out_options=js_out_options,
+            js_output_dir=js_output_dir,
+            grpc_web_out_options=grpc_web_out_options,
+            grpc_web_plugin_version=grpc_web_plugin_version,
+            grpc_web_output_dir=grpc_web_output_dir,
+            improbable=improbable,
+        ),
+        limiter=limiter,
+    )
+
+
+async def compile_node_grpc_async(
+    options: BaseCompilerOptions,
+    out_options: typing.Optional[NodeGrpcOptions] = None,
+    out_dirs: typing.Optional[NodeGrpcOptions] = None,
+    limiter: typing.Optional[asyncio.Semaphore] = None,
+) -> CompileResult:
+    return await compile_async(
+        node_grpc_options(options, out_options=out_options, out_dirs=out_dirs),
+        limiter=limiter,
+    )
+
+
+async def compile_python_grpc_async(
+    options: BaseCompilerOptions,
+    py_out_options: typing.Optional[str] = None,
+    py_output_dir: typing.Optional[PathLike] = None,
+    py_grpc_out_options: typing.Optional[str] = None,
+    py_grpc_output_dir: typing.Optional[PathLike] = None,
+    limiter: typing.Optional[asyncio.Semaphore] = None,
+) -> CompileResult:
+    return await compile_async(
+        python_grpc_options(
+            options,
+            py_out_options=py_out_options,
+            py_output_dir=py_output_dir,
+            py_grpc_out_options=py_grpc_out_options,
+            py_grpc_output_dir=py_grpc_output_dir,
+        ),
+        limiter=limiter,
+    )
@@ -0,0 +1,177 @@
+"""Batch manifests that list many compile jobs sharing a single toolchain.
+
+A manifest is a TOML or YAML file with optional ``options`` shared by all
+jobs and a list of ``compile`` jobs, e.g.::
+
+    [options]
+    protoc_version = "27.2"
+    jobs = 0
+
+    [[compile]]
+    name = "api"
+    source_dirs = ["protos/api", "protos/admin"]
+    include_dirs = ["third_party/googleapis"]
+    output_dir = "gen/python"
+    targets = ["python", {target = "python_grpc", output_dir = "gen/grpc"}]
+
+Relative paths are relative to the directory of the manifest. Targets are
+the lower case names of proto_compile.versions.Target. Jobs may be named to
+build only some of them, see build.py.
+"""
+
+import os
+import sys
+import typing
+
+from proto_compile.options import BaseCompilerOptions, CompilerOptions, CompileTarget
+from proto_compile.utils import PathLike
+from proto_compile.versions import Target
+
+# options that may only be set for all jobs, see TOOLCHAIN_OPTIONS
+SHARED_OPTIONS = [
+    "protoc_version",
+    "protoc_sha256",
+    "use_cache",
+    "cache_dir",
+    "embedded_protoc",
+    "verbosity",
+    "profile",
+    "mirror",
+    "offline",
+    "remote_cache",
+    "remote_cache_read_only",
+]
+JOB_OPTIONS = [
+    "minimal_include_dir",
+    "clear_output_dirs",
+    "incremental",
+    "jobs",
+    "shards",
+    "include",
+    "exclude",
+    "gitignore",
+    "descriptor_set",
+]
+TARGET_OPTIONS = ["target", "output_dir", "out_options", "plugin_version"]
+
+
+class BatchManifest:
+    def __init__(
+        self,
+        jobs: typing.List[CompilerOptions],
+        workers: typing.Optional[int],
+        names: typing.Optional[typing.List[typing.Optional[str]]] = None,
+    ) -> None:
+        self.jobs = jobs
+        # size of the shared worker pool, None uses the cpu count
+        self.workers = workers
+        # the name of every job or None
+        self.names = names or [None] * len(jobs)
+
+    def select(self, names: typing.Iterable[str]) -> typing.List[CompilerOptions]:
+        """Returns the jobs with the given names, all jobs without names"""
+        names = list(names)
+        if not names:
+            return self.jobs
+        unknown = sorted(set(names) - set(self.names))
+        if unknown:
+            raise ValueError("unknown job(s): {}".format(", ".join(unknown)))
+        return [job for job, name in zip(self.jobs, self.names) if name in names]
+
+
+def _parse(path: PathLike) -> typing.Dict[str, typing.Any]:
+    extension = os.path.splitext(str(path))[1].lower()
+    if extension == ".toml":
+        if sys.version_info >= (3, 11):
+            import tomllib
+        else:  # pragma: no cover
+            try:
+                import tomli as tomllib
+            except ImportError:
+                raise ValueError("reading {} requires tomli".format(path))
+        with open(path, "rb") as f:
+            return tomllib.load(f)
+    if extension in [".yaml", ".yml"]:
+        try:
+            import yaml
+        except ImportError:  # pragma: no cover
+            raise ValueError("reading {} requires pyyaml".format(path))
+        with open(path) as f:
+            return yaml.safe_load(f) or dict()
+    raise ValueError("{} is neither a .toml nor a .yaml file".format(path))
+
+
+def _check_keys(
+    where: str, values: typing.Dict[str, typing.Any], allowed: typing.List[str]
+) -> None:
+    unknown = sorted(set(values) - set(allowed))
+    if unknown:
+        raise ValueError("unknown {} option(s): {}".format(where, ", ".join(unknown)))
+
+
+def _target(
+    value: typing.Union[str, typing.Dict[str, typing.Any]],
+    resolve: typing.Callable[[PathLike], str],
+) -> CompileTarget:
+    spec = dict(target=value) if isinstance(value, str) else dict(value)
+    _check_keys("target", spec, TARGET_OPTIONS)
+    name = str(spec.pop("target", "")).upper()
+    if name not in Target.__members__:
+        raise ValueError("unknown target: {}".format(name.lower()))
+    output_dir = spec.pop("output_dir", None)
+    return CompileTarget(
+        Target[name],
+        output_dir=resolve(output_dir) if output_dir is not None else None,
+        **spec,
+    )
+
+
+def load_manifest(path: PathLike, **overrides: typing.Any) -> BatchManifest:
+    """Reads a batch manifest, overrides replace the shared options"""
+    manifest = _parse(path)
+    base_dir = os.path.dirname(os.path.abspath(path))
+
+    def resolve(p: PathLike) -> str:
+        return os.path.join(base_dir, os.path.expanduser(str(p)))
+
+    _check_keys("manifest", manifest, ["options", "compile"])
+    shared = dict(manifest.get("options") or dict())
+    _check_keys("shared", shared, SHARED_OPTIONS + JOB_OPTIONS)
+    shared.update({k: v for k, v in overrides.items() if v is not None})
+    for name in ["cache_dir", "profile"]:
+        if shared.get(name) is not None:
+            shared[name] = resolve(shared[name])
+    for name in ["mirror", "remote_cache"]:
+        if shared.get(name) is not None and "://" not in str(shared[name]):
+            shared[name] = resolve(shared[name])
+
+    jobs: typing.List[CompilerOptions] = []
+    names: typing.List[typing.Optional[str]] = []
+    for job in manifest.get("compile") or []:
+        job = dict(job)
+        _check_keys(
+            "job",
+            job,
+            JOB_OPTIONS
+            + ["name", "source_dirs", "include_dirs", "output_dir", "targets"],
+        )
+        name = job.pop("name", None)
+        if name is not None and name in names:
+            raise ValueError("duplicate job name: {}".format(name))
+        names.append(name)
+        sources = [resolve(d) for d in job.pop("source_dirs", [])]
+        if not sources:
+            raise ValueError("every job needs at least one source dir")
+        if "output_dir" not in job or not job.get("targets"):
+            raise ValueError("every job needs an output dir and targets")
+        targets = [_target(t, resolve) for t in job.pop("targets")]
+        options = dict(
+            shared,
+            proto_source_dir=sources[0],
+            extra_source_dirs=sources[1:],
+            include_dirs=[resolve(d) for d in job.pop("include_dirs", [])],
+            output_dir=resolve(job.pop("output_dir")),
+        )
+        options.update(job)
+        jobs.append(CompilerOptions(BaseCompilerOptions(**options), targets=targets))
+    return BatchManifest(jobs, workers=shared.get("jobs"), names=names)
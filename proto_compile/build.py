@@ -0,0 +1,359 @@
+"""Builds the jobs of a project file as a graph of steps.
+
+A project file is a batch manifest named ``proto-compile.toml``, which is
+looked up from the current dir upwards, see batch.py. Instead of installing
+the whole toolchain before the first protoc run, every job is a chain of
+steps that only waits for what it needs:
+
+- discover: finds the proto files of the job and fetches its outputs from the
+  remote cache. Jobs that are up to date or fetched end here.
+- install: installs protoc or a plugin. Installs are shared by all jobs and
+  only run once a job needs them.
+- plan: builds the protoc runs of the job once protoc and its plugins are
+  installed.
+- generate: runs protoc, one step per target and shard.
+- store: uploads the outputs of the job to the remote cache.
+
+Installs run on their own pool, so downloads never wait for protoc runs.
+Failing steps skip their dependents, the other steps keep running. The
+outputs of all jobs are reconciled at once when every step succeeded.
+"""
+
+import concurrent.futures
+import copy
+import functools
+import os
+import shutil
+import tempfile
+import threading
+import time
+import typing
+from pathlib import Path
+
+from proto_compile import profiling as profiling
+from proto_compile import result as result
+from proto_compile.cache import ToolchainCache
+from proto_compile.options import CompilerOptions, CompileTarget
+from proto_compile.plugins import ProtocPlugin, ProtoCompiler
+from proto_compile.proto_compile import (
+    CompilationError,
+    CompileJob,
+    TargetInvocation,
+    check_toolchain,
+    compile_unit,
+    embedded_compiler,
+    evict_unused,
+    install_plugin,
+    install_protoc,
+    protoc_compiler,
+    reconcile,
+    record_versions,
+    resolve_plugins,
+)
+from proto_compile.result import CompileResult
+from proto_compile.staging import OutputStaging
+from proto_compile.utils import PathLike, submit
+
+PROJECT_FILE = "proto-compile.toml"
+
+
+def find_project(start_dir: PathLike = ".") -> typing.Optional[str]:
+    """Returns the closest project file in start_dir or its parents"""
+    current = os.path.abspath(start_dir)
+    while True:
+        path = os.path.join(current, PROJECT_FILE)
+        if os.path.isfile(path):
+            return path
+        parent = os.path.dirname(current)
+        if parent == current:
+            return None
+        current = parent
+
+
+# a step returns the steps that were added by it
+StepResult = typing.Optional[typing.List["Step"]]
+
+
+class Step:
+    """A node of the build graph, which runs once all its deps succeeded"""
+
+    def __init__(
+        self,
+        name: str,
+        run: typing.Callable[[], StepResult],
+        deps: typing.Sequence["Step"] = (),
+        install: bool = False,
+    ) -> None:
+        self.name = name
+        self.run = run
+        self.deps = list(deps)
+        # installs run on their own pool
+        self.install = install
+
+    def __repr__(self) -> str:
+        return "Step({!r})".format(self.name)
+
+
+def run_graph(
+    steps: typing.Iterable[Step], jobs: typing.Optional[int] = None
+) -> typing.List[typing.Tuple[Step, Exception]]:
+    """Runs every step as soon as all its deps succeeded.
+
+    At most jobs steps that are no installs run at once (None uses the cpu
+    count). The steps returned by a step are added to the graph together with
+    their deps. Returns the failed steps with their errors, the dependents of
+    failed steps are skipped.
+    """
+    known: typing.Set[Step] = set()
+    # deps are always added before their dependents
+    waiting: typing.List[Step] = []
+    succeeded: typing.Set[Step] = set()
+    failed: typing.Set[Step] = set()
+    failures: typing.List[typing.Tuple[Step, Exception]] = []
+
+    def add(step: Step) -> None:
+        if step in known:
+            return
+        known.add(step)
+        for dep in step.deps:
+            add(dep)
+        waiting.append(step)
+
+    for step in steps:
+        add(step)
+
+    running: typing.Dict["concurrent.futures.Future[StepResult]", Step] = dict()
+    with concurrent.futures.ThreadPoolExecutor(
+        max_workers=jobs or None
+    ) as pool, concurrent.futures.ThreadPoolExecutor() as install_pool:
+        while waiting or running:
+            for step in list(waiting):
+                if any(dep in failed for dep in step.deps):
+                    waiting.remove(step)
+                    failed.add(step)
+                elif all(dep in succeeded for dep in step.deps):
+                    waiting.remove(step)
+                    future = submit(install_pool if step.install else pool, step.run)
+                    running[future] = step
+            if not running:
+                break
+            done, _ = concurrent.futures.wait(
+                running, return_when=concurrent.futures.FIRST_COMPLETED
+            )
+            for future in done:
+                step = running.pop(future)
+                try:
+                    added = future.result()
+                except Exception as e:
+                    failed.add(step)
+                    failures.append((step, e))
+                    continue
+                succeeded.add(step)
+                for new in added or []:
+                    add(new)
+    return failures
+
+
+class Build:
+    """The build graph of a batch of jobs that share one toolchain"""
+
+    def __init__(
+        self,
+        batch: typing.List[CompilerOptions],
+        cache: typing.Optional[ToolchainCache],
+        tmp_dir: Path,
+        staging: OutputStaging,
+    ) -> None:
+        self.batch = batch
+        self.cache = cache
+        self.tmp_dir = tmp_dir
+        self.staging = staging
+        self.verbosity = max(options.verbosity for options in batch)
+        self.toolchain = copy.copy(batch[0])
+        self.toolchain.verbosity = self.verbosity
+        # the prepared job of every options, None if there is nothing to do
+        self.prepared: typing.List[typing.Optional[CompileJob]] = [None] * len(batch)
+        # the targets of every generate step
+        self.generates: typing.Dict[Step, typing.List[CompileTarget]] = dict()
+        self._lock = threading.Lock()
+        self._protoc: typing.Optional[Step] = None
+        self._compiler: typing.Optional[ProtoCompiler] = None
+        # plugin cache key -> install step and installed plugin
+        self._installs: typing.Dict[typing.Tuple[str, ...], Step] = dict()
+        self._installed: typing.Dict[
+            typing.Tuple[str, ...], typing.Optional[ProtocPlugin]
+        ] = dict()
+
+    @property
+    def bootstrapped(self) -> bool:
+        """Whether any job needed the toolchain"""
+        return self._protoc is not None
+
+    def steps(self) -> typing.List[Step]:
+        return [
+            Step(
+                "discover {}".format(index),
+                functools.partial(self.discover, index, options),
+            )
+            for index, options in enumerate(self.batch)
+        ]
+
+    def discover(self, index: int, options: CompilerOptions) -> StepResult:
+        job = CompileJob.prepare(options, self.cache)
+        if job is None:
+            return None
+        self.prepared[index] = job
+        if job.fetch_outputs(self.staging, self.tmp_dir):
+            record_versions(options, None)
+            return None
+
+        target_plugins = resolve_plugins(options, self.tmp_dir, cache=self.cache)
+        with self._lock:
+            deps = [self.protoc_step()] + [
+                self.install_step(plugin)
+                for plugin in target_plugins
+                if plugin is not None
+            ]
+        return [
+            Step(
+                "plan {}".format(index),
+                functools.partial(self.plan, index, job, target_plugins),
+                deps=deps,
+            )
+        ]
+
+    def protoc_step(self) -> Step:
+        if self._protoc is None:
+            self._protoc = Step("install protoc", self.install_compiler, install=True)
+        return self._protoc
+
+    def install_compiler(self) -> StepResult:
+        embedded = embedded_compiler(self.toolchain)
+        if embedded is not None:
+            self._compiler = embedded
+            return None
+        executable = install_protoc(self.toolchain, self.cache, self.tmp_dir)
+        self._compiler = protoc_compiler(self.toolchain, executable)
+        return None
+
+    def install_step(self, plugin: ProtocPlugin) -> Step:
+        key = tuple(plugin.cache_key())
+        if key not in self._installs:
+            self._installs[key] = Step(
+                "install " + type(plugin).__name__,
+                functools.partial(self.install_plugin, key, plugin),
+                install=True,
+            )
+        return self._installs[key]
+
+    def install_plugin(
+        self, key: typing.Tuple[str, ...], plugin: ProtocPlugin
+    ) -> StepResult:
+        try:
+            self._installed[key] = install_plugin(plugin, self.cache, evict=False)
+        except NotImplementedError:
+            self._installed[key] = None
+        return None
+
+    def plan(
+        self,
+        index: int,
+        job: CompileJob,
+        target_plugins: typing.List[typing.Optional[ProtocPlugin]],
+    ) -> StepResult:
+        installed_plugins: typing.List[typing.Optional[ProtocPlugin]] = []
+        for plugin in target_plugins:
+            shared = (
+                self._installed[tuple(plugin.cache_key())]
+                if plugin is not None
+                else None
+            )
+            installed_plugins.append(
+                plugin.relocated(shared.dest_dir)
+                if plugin is not None and shared is not None
+                else None
+            )
+        record_versions(job.options, installed_plugins)
+
+        assert self._compiler is not None
+        units = job.units(
+            self._compiler,
+            target_plugins,
+            installed_plugins,
+            self.tmp_dir,
+            self.staging,
+        )
+        generates: typing.List[Step] = []
+        for invocation, arguments in units:
+            generate = Step(
+                "generate {}".format(index),
+                functools.partial(self.generate, invocation, arguments),
+            )
+            with self._lock:
+                self.generates[generate] = invocation.targets
+            generates.append(generate)
+        store = Step(
+            "store {}".format(index),
+            functools.partial(job.store_outputs, self.staging, self.tmp_dir),
+            deps=generates,
+        )
+        return generates + [store]
+
+    def generate(
+        self, invocation: TargetInvocation, arguments: typing.List[str]
+    ) -> StepResult:
+        compile_unit(invocation, arguments, verbosity=self.verbosity)
+        return None
+
+
+def build(
+    batch: typing.List[CompilerOptions], jobs: typing.Optional[int] = None
+) -> CompileResult:
+    """Compiles many options like compile_batch(), scheduled as a build graph.
+
+    All options must agree on the TOOLCHAIN_OPTIONS. At most jobs protoc runs
+    of all options run at once (None uses the cpu count). Failed protoc runs
+    are raised together as a CompilationError, other failures as they are.
+    """
+    if not batch:
+        return CompileResult()
+    check_toolchain(batch)
+    with profiling.profiled(batch[0].profile), result.recording() as compiled:
+        _build(batch, jobs)
+    return compiled
+
+
+def _build(batch: typing.List[CompilerOptions], jobs: typing.Optional[int]) -> None:
+    first = batch[0]
+    verbosity = max(options.verbosity for options in batch)
+    cache = (
+        ToolchainCache(first.cache_dir, verbosity=verbosity)
+        if first.use_cache
+        else None
+    )
+    # allow for a coarse mtime resolution of the cache entries
+    started = time.time() - 2
+    tmp_dir = Path(tempfile.mkdtemp())
+    try:
+        staging = OutputStaging(tmp_dir / "staging")
+        graph = Build(batch, cache, tmp_dir, staging)
+        failures = run_graph(graph.steps(), jobs=jobs)
+        for step, error in failures:
+            if step not in graph.generates:
+                raise error
+        if failures:
+            raise CompilationError(
+                [
+                    (target, error)
+                    for step, error in failures
+                    for target in graph.generates[step]
+                ]
+            )
+        if cache is not None and graph.bootstrapped:
+            evict_unused(cache, started)
+
+        compile_jobs = [job for job in graph.prepared if job is not None]
+        if compile_jobs:
+            reconcile(staging, compile_jobs, verbosity)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
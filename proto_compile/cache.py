@@ -0,0 +1,399 @@
+"""Persistent cache for downloaded and installed toolchains."""
+
+import json
+import logging
+import os
+import platform
+import shutil
+import time
+import typing
+import uuid
+from pathlib import Path
+
+from proto_compile import result as result
+from proto_compile.utils import PathLike, download_executable, file_sha256
+
+CACHE_DIR_ENV = "PROTO_COMPILE_CACHE_DIR"
+
+# entries that were not used for 30 days are evicted
+DEFAULT_MAX_AGE = 30 * 24 * 60 * 60
+# keep the cache below 2 GiB
+DEFAULT_MAX_SIZE = 2 * 1024 * 1024 * 1024
+
+CacheKey = typing.Sequence[str]
+
+log = logging.getLogger(__name__)
+
+
+def default_cache_dir() -> Path:
+    """Returns $PROTO_COMPILE_CACHE_DIR or $XDG_CACHE_HOME/proto-compile"""
+    cache_dir = os.environ.get(CACHE_DIR_ENV)
+    if cache_dir:
+        return Path(cache_dir)
+    xdg_cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.join(
+        os.path.expanduser("~"), ".cache"
+    )
+    return Path(xdg_cache_home) / "proto-compile"
+
+
+# sha256 of executables by path, valid as long as their stat is unchanged,
+# which saves rehashing toolchains in long-running processes (e.g. the daemon)
+_verified: typing.Dict[str, typing.Tuple[typing.Tuple[int, ...], str]] = dict()
+
+
+def _verified_sha256(path: PathLike) -> str:
+    try:
+        st = os.stat(path)
+        stat_key = (st.st_ino, st.st_size, st.st_mtime_ns, st.st_ctime_ns)
+        known = _verified.get(str(path))
+        if known is not None and known[0] == stat_key:
+            return known[1]
+        sha256 = file_sha256(path)
+    except OSError:
+        return ""
+    _verified[str(path)] = (stat_key, sha256)
+    return sha256
+
+
+def platform_key() -> typing.List[str]:
+    return [platform.system().lower(), platform.machine().lower()]
+
+
+def cache_name(key: CacheKey) -> str:
+    """Returns the name of a toolchain entry in CompileResult.cache"""
+    return "toolchain/" + "-".join(key)
+
+
+def dir_size(path: PathLike) -> int:
+    size = 0
+    for root, dirnames, filenames in os.walk(str(path)):
+        for filename in filenames:
+            try:
+                size += os.lstat(os.path.join(root, filename)).st_size
+            except OSError:  # pragma: no cover
+                pass
+    return size
+
+
+def rmtree(path: PathLike) -> None:
+    """Like shutil.rmtree, but also removes read-only files (e.g. go modules)"""
+
+    def make_writable(func: typing.Any, p: str, exc_info: typing.Any) -> None:
+        os.chmod(p, 0o755)
+        func(p)
+
+    shutil.rmtree(str(path), onerror=make_writable)
+
+
+class CacheEntry:
+    def __init__(self, path: Path, metadata: typing.Dict[str, typing.Any]) -> None:
+        self.path = path
+        self.key: typing.List[str] = metadata["key"]
+        self.executable: str = metadata["executable"]
+        self.sha256: str = metadata["sha256"]
+        self.size: int = metadata["size"]
+        self.url: typing.Optional[str] = metadata.get("url")
+        self.created: float = metadata["created"]
+        self.last_used = (path / ToolchainCache.METADATA).stat().st_mtime
+
+    def executable_path(self) -> Path:
+        return self.path / self.executable
+
+    def __repr__(self) -> str:
+        return "CacheEntry(%s)" % "-".join(self.key)
+
+
+class ToolchainCache:
+    """Content verified, persistent cache of toolchain installations.
+
+    Every entry is a directory under ``<root>/toolchains`` that is keyed by
+    e.g. tool name, version, OS and architecture. Entries are installed into
+    a staging directory first and atomically renamed into place, so that
+    concurrent processes never observe partial installations. The sha256 of
+    the executable is recorded on install and verified on every lookup.
+    """
+
+    METADATA = "entry.json"
+
+    def __init__(
+        self,
+        root: typing.Optional[PathLike] = None,
+        max_size: typing.Optional[int] = DEFAULT_MAX_SIZE,
+        max_age: typing.Optional[float] = DEFAULT_MAX_AGE,
+        verbosity: int = 0,
+    ) -> None:
+        self.root = Path(root) if root is not None else default_cache_dir()
+        self.max_size = max_size
+        self.max_age = max_age
+        self.verbosity = verbosity
+
+    @property
+    def toolchains_dir(self) -> Path:
+        return self.root / "toolchains"
+
+    @property
+    def packages_dir(self) -> Path:
+        """Shared package manager caches (e.g. GOCACHE or the npm cache)"""
+        return self.root / "packages"
+
+    @property
+    def blobs(self) -> "BlobStore":
+        """Content addressed store of generated outputs"""
+        return BlobStore(self.root / "blobs")
+
+    @property
+    def manifests_dir(self) -> Path:
+        return self.root / "manifests"
+
+    @property
+    def indexes_dir(self) -> Path:
+        """Indexes of the proto files in source dirs"""
+        return self.root / "indexes"
+
+    @property
+    def descriptors_dir(self) -> Path:
+        """Descriptor sets of parsed proto files"""
+        return self.root / "descriptors"
+
+    @property
+    def staging_dir(self) -> Path:
+        return self.root / "tmp"
+
+    def entry_dir(self, key: CacheKey) -> Path:
+        name = "-".join(part.replace(os.sep, "_") for part in key if part)
+        return self.toolchains_dir / name
+
+    def _load(self, path: Path) -> typing.Optional[CacheEntry]:
+        try:
+            with open(path / self.METADATA) as f:
+                return CacheEntry(path, json.load(f))
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def lookup(self, key: CacheKey) -> typing.Optional[Path]:
+        """Returns the cached executable for key or None on a cache miss"""
+        entry = self._load(self.entry_dir(key))
+        if entry is None:
+            return None
+        executable = entry.executable_path()
+        if _verified_sha256(executable) != entry.sha256:
+            if self.verbosity > 0:
+                log.info("discarding corrupted cache entry %s", entry.path)
+            self.remove(entry.path)
+            return None
+        # mark as recently used
+        os.utime(entry.path / self.METADATA)
+        return executable
+
+    def install(
+        self,
+        key: CacheKey,
+        installer: typing.Callable[[Path], PathLike],
+        url: typing.Optional[str] = None,
+        evict: bool = True,
+    ) -> Path:
+        """Returns the cached executable for key, installing it on a cache miss.
+
+        The installer receives an empty staging directory and must return the
+        path of the installed executable inside of it. Concurrent installs
+        should pass evict=False and evict once all of them finished, so that
+        they do not evict each other's entries.
+        """
+        cached = self.lookup(key)
+        result.record_cache(cache_name(key), cached is not None)
+        if cached is not None:
+            return cached
+
+        self.staging_dir.mkdir(parents=True, exist_ok=True)
+        staging = self.staging_dir / str(uuid.uuid4())
+        staging.mkdir()
+        try:
+            executable = Path(installer(staging)).absolute()
+            metadata = dict(
+                key=list(key),
+                executable=str(executable.relative_to(staging.absolute())),
+                sha256=file_sha256(executable),
+                size=dir_size(staging),
+                url=url,
+                created=time.time(),
+            )
+            with open(staging / self.METADATA, "w") as f:
+                json.dump(metadata, f, indent=2)
+
+            final = self.entry_dir(key)
+            final.parent.mkdir(parents=True, exist_ok=True)
+            try:
+                os.rename(staging, final)
+            except OSError:
+                # another process installed the same entry concurrently
+                if self._load(final) is None:
+                    raise
+        finally:
+            if staging.exists():
+                rmtree(staging)
+
+        if evict:
+            self.evict(keep=[self.entry_dir(key)])
+        installed = self.lookup(key)
+        assert installed is not None
+        return installed
+
+    def fetch(
+        self,
+        key: CacheKey,
+        url: str,
+        executable: PathLike,
+        unarchive_as: typing.Optional[str] = None,
+        sha256: typing.Optional[str] = None,
+        members: typing.Optional[typing.List[str]] = None,
+        evict: bool = True,
+    ) -> Path:
+        """Returns the cached executable for key, downloading url on a cache miss"""
+
+        def download(staging: Path) -> PathLike:
+            return download_executable(
+                url=url,
+                executable=executable,
+                unarchive_as=unarchive_as,
+                dest_dir=staging,
+                sha256=sha256,
+                members=members,
+                verbosity=self.verbosity,
+            )
+
+        return self.install(key, download, url=url, evict=evict)
+
+    def entries(self) -> typing.List[CacheEntry]:
+        entries = []
+        if self.toolchains_dir.is_dir():
+            for path in self.toolchains_dir.iterdir():
+                entry = self._load(path)
+                if entry is not None:
+                    entries.append(entry)
+        return entries
+
+    def remove(self, path: PathLike) -> None:
+        # move the entry out of the way first so that removal appears atomic
+        self.staging_dir.mkdir(parents=True, exist_ok=True)
+        trash = self.staging_dir / ("trash-%s" % uuid.uuid4())
+        try:
+            os.rename(path, trash)
+        except OSError:
+            return
+        rmtree(trash)
+
+    def files(self) -> typing.List[typing.Tuple[Path, os.stat_result]]:
+        """Blobs, build manifests, indexes and descriptor sets, which share the
+        budget of the toolchains"""
+        paths = self.blobs.paths()
+        for json_dir in [self.manifests_dir, self.indexes_dir]:
+            if json_dir.is_dir():
+                paths += list(json_dir.glob("*.json"))
+        if self.descriptors_dir.is_dir():
+            paths += list(self.descriptors_dir.glob("*.pb"))
+        files = []
+        for path in paths:
+            try:
+                files.append((path, path.stat()))
+            except OSError:  # pragma: no cover
+                pass
+        return files
+
+    def evict(
+        self,
+        max_size: typing.Optional[int] = None,
+        max_age: typing.Optional[float] = None,
+        keep: typing.Optional[typing.List[Path]] = None,
+    ) -> typing.List[CacheEntry]:
+        """Evicts entries unused for max_age seconds and the least recently
+        used entries until the cache is smaller than max_size bytes.
+
+        Blobs and build manifests are evicted the same way and count towards
+        max_size, but only the evicted toolchain entries are returned.
+        """
+        max_size = max_size if max_size is not None else self.max_size
+        max_age = max_age if max_age is not None else self.max_age
+        now = time.time()
+        keep = keep or []
+        # (last used, size, path, entry) where entry is None for plain files
+        items: typing.List[
+            typing.Tuple[float, int, Path, typing.Optional[CacheEntry]]
+        ] = [(e.last_used, e.size, e.path, e) for e in self.entries()]
+        items += [(st.st_mtime, st.st_size, path, None) for path, st in self.files()]
+        items.sort(key=lambda item: item[0])
+        candidates = [item for item in items if item[2] not in keep]
+        evicted: typing.List[
+            typing.Tuple[float, int, Path, typing.Optional[CacheEntry]]
+        ] = []
+        if max_age is not None:
+            evicted += [item for item in candidates if now - item[0] > max_age]
+        if max_size is not None:
+            evicted_paths = set(item[2] for item in evicted)
+            total = sum(item[1] for item in items if item[2] not in evicted_paths)
+            for item in candidates:
+                if total <= max_size:
+                    break
+                if item[2] not in evicted_paths:
+                    evicted.append(item)
+                    total -= item[1]
+        for _, _, path, entry in evicted:
+            if entry is None:
+                try:
+                    path.unlink()
+                except OSError:  # pragma: no cover
+                    pass
+                continue
+            if self.verbosity > 0:
+                log.info("evicting %s", entry.path)
+            self.remove(entry.path)
+        return [entry for _, _, _, entry in evicted if entry is not None]
+
+
+class BlobStore:
+    """Content addressed store of files, keyed by their sha256"""
+
+    def __init__(self, root: PathLike) -> None:
+        self.root = Path(root)
+
+    def path(self, digest: str) -> Path:
+        return self.root / digest[:2] / digest
+
+    def contains(self, digest: str) -> bool:
+        return self.path(digest).is_file()
+
+    def put(self, src: PathLike, digest: typing.Optional[str] = None) -> str:
+        digest = digest or file_sha256(src)
+        blob = self.path(digest)
+        if blob.is_file():
+            os.utime(blob)
+            return digest
+        blob.parent.mkdir(parents=True, exist_ok=True)
+        tmp = blob.parent / ("%s.%s.tmp" % (digest, uuid.uuid4()))
+        shutil.copyfile(src, tmp)
+        os.replace(tmp, blob)
+        return digest
+
+    def get(self, digest: str, dest: PathLike) -> None:
+        blob = self.path(digest)
+        Path(dest).parent.mkdir(parents=True, exist_ok=True)
+        tmp = Path(dest).parent / (".%s.%s.tmp" % (Path(dest).name, uuid.uuid4()))
+        shutil.copyfile(blob, tmp)
+        os.replace(tmp, dest)
+        os.utime(blob)
+
+    def touch(self, digest: str) -> None:
+        """Marks a blob as recently used"""
+        try:
+            os.utime(self.path(digest))
+        except OSError:
+            pass
+
+    def paths(self) -> typing.List[Path]:
+        if not self.root.is_dir():
+            return []
+        return [
+            blob
+            for prefix in self.root.iterdir()
+            for blob in prefix.iterdir()
+            if not blob.name.endswith(".tmp")
+        ]
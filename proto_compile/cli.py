@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 
 """Console script for proto_compile."""
+import logging
 import os
 import sys
 import typing
@@ -9,11 +10,43 @@ import click
 
 import proto_compile.proto_compile as compiler
 import proto_compile.versions as versions
+from proto_compile.batch import BatchManifest, load_manifest
+from proto_compile.build import PROJECT_FILE, find_project
+from proto_compile.build import build as project_build
+from proto_compile.daemon import Daemon, default_socket_path
+from proto_compile.mirrors import MIRROR_ENV, OFFLINE_ENV, mirror_url
 from proto_compile.options import BaseCompilerOptions
-from proto_compile.utils import PathLike
+from proto_compile.prefetch import Platform, parse_platform
+from proto_compile.prefetch import prefetch as prefetch_releases
+from proto_compile.remote import REMOTE_CACHE_ENV
+from proto_compile.result import LOGGER_NAME
+from proto_compile.utils import DownloadError, PathLike
 from proto_compile.versions import Target
 
 
+class ConsoleHandler(logging.Handler):
+    """Prints the messages of proto_compile to the current stdout"""
+
+    prefixes = {logging.WARNING: "WARN: ", logging.ERROR: "ERROR: "}
+
+    def emit(self, record: logging.LogRecord) -> None:
+        try:
+            message = self.format(record)
+        except Exception:  # pragma: no cover
+            self.handleError(record)
+            return
+        # stdout is looked up for every record, as the daemon redirects it
+        print(self.prefixes.get(record.levelno, "") + message, flush=True)
+
+
+def configure_logging() -> None:
+    """Prints the messages of proto_compile, which verbosity selects"""
+    logger = logging.getLogger(LOGGER_NAME)
+    logger.setLevel(logging.INFO)
+    if not any(isinstance(h, ConsoleHandler) for h in logger.handlers):
+        logger.addHandler(ConsoleHandler())
+
+
 def assert_valid_dir(
     ctx: click.core.Context, param: click.core.Parameter, value: str
 ) -> str:
@@ -32,6 +65,12 @@ def optional_assert_valid_dir(
     return assert_valid_dir(ctx, param, value)
 
 
+def assert_valid_dirs(
+    ctx: click.core.Context, param: click.core.Parameter, value: typing.Tuple[str, ...]
+) -> typing.List[str]:
+    return [assert_valid_dir(ctx, param, v) for v in value]
+
+
 base_proto_parent_dir_help = (
     "base proto parent dir used for protoc -I=<base_proto_parent_dir>. ",
     "Must be a valid directory that contains the proto files in <proto_source_dir>",
@@ -54,7 +93,10 @@ base_proto_parent_dir_help = (
     "-clear",
     is_flag=True,
     default=False,
-    help=str("whether to clear the output directories before compilation"),
+    help=str(
+        "remove files from the output directories that were not generated,"
+        " unchanged outputs are never rewritten"
+    ),
 )
 @click.option(
     "--verbosity",
@@ -66,6 +108,170 @@ base_proto_parent_dir_help = (
     default=versions.DEFAULT_PROTOC_VERSION,
     help="protoc version to use (default is %s)" % versions.DEFAULT_PROTOC_VERSION,
 )
+@click.option(
+    "--protoc-sha256",
+    default=None,
+    help=str(
+        "expected sha256 of the protoc release archive"
+        " (default is the digest published by github)"
+    ),
+)
+@click.option(
+    "--cache-dir",
+    default=None,
+    type=click.Path(),
+    help=str(
+        "directory used to cache downloaded toolchains"
+        " (default is $XDG_CACHE_HOME/proto-compile)"
+    ),
+)
+@click.option(
+    "--no-cache",
+    is_flag=True,
+    default=False,
+    help=str("always download the toolchain instead of using the cache"),
+)
+@click.option(
+    "--mirror",
+    default=None,
+    envvar=MIRROR_ENV,
+    help=str(
+        "dir, file:// or http(s) URL to download protoc and the plugin releases"
+        " from instead of github (see proto-compile-prefetch)"
+    ),
+)
+@click.option(
+    "--offline",
+    is_flag=True,
+    default=False,
+    envvar=OFFLINE_ENV,
+    help=str("only install the toolchain from the cache or the --mirror"),
+)
+@click.option(
+    "--remote-cache",
+    default=None,
+    envvar=REMOTE_CACHE_ENV,
+    help=str(
+        "dir (e.g. on NFS) or http(s) URL of a cache of generated outputs that"
+        " is shared with other machines"
+    ),
+)
+@click.option(
+    "--remote-cache-read-only",
+    is_flag=True,
+    default=False,
+    help=str("never upload outputs to the --remote-cache"),
+)
+@click.option(
+    "--no-embedded-protoc",
+    is_flag=True,
+    default=False,
+    help=str(
+        "always download protoc instead of using the protoc bundled with"
+        " grpcio-tools for targets that need no plugin"
+    ),
+)
+@click.option(
+    "--no-daemon",
+    is_flag=True,
+    default=False,
+    help=str("compile in this process even if a daemon is running"),
+)
+@click.option(
+    "--source-dir",
+    "extra_source_dirs",
+    multiple=True,
+    callback=assert_valid_dirs,
+    type=click.Path(),
+    help=str("further source dir whose proto files are compiled as well"),
+)
+@click.option(
+    "--include-dir",
+    "-I",
+    "include_dirs",
+    multiple=True,
+    callback=assert_valid_dirs,
+    type=click.Path(),
+    help=str("include dir that is only used to resolve imports"),
+)
+@click.option(
+    "--include",
+    multiple=True,
+    help=str("gitignore style glob of the proto files to compile (default *.proto)"),
+)
+@click.option(
+    "--exclude",
+    multiple=True,
+    help=str("gitignore style glob of files or dirs to skip"),
+)
+@click.option(
+    "--no-gitignore",
+    is_flag=True,
+    default=False,
+    help=str("also compile proto files that are ignored by .gitignore files"),
+)
+@click.option(
+    "--descriptor-set",
+    is_flag=True,
+    default=False,
+    help=str(
+        "parse the proto files once into a cached descriptor set that the"
+        " code generators of all targets read"
+    ),
+)
+@click.option(
+    "--descriptor-set-out",
+    default=None,
+    type=click.Path(dir_okay=False),
+    help=str("write the descriptor set to this file (implies --descriptor-set)"),
+)
+@click.option(
+    "--profile",
+    is_flag=True,
+    default=False,
+    help=str(
+        "print where the time was spent and write a JSON report and a chrome"
+        " trace into --profile-dir"
+    ),
+)
+@click.option(
+    "--profile-dir",
+    default=".",
+    type=click.Path(file_okay=False),
+    help=str("directory of the --profile reports (default is the working dir)"),
+)
+@click.option(
+    "--watch",
+    is_flag=True,
+    default=False,
+    help=str("recompile the changed proto files until interrupted"),
+)
+@click.option(
+    "--incremental",
+    is_flag=True,
+    default=False,
+    help=str("skip protoc if inputs and toolchain did not change since the last run"),
+)
+@click.option(
+    "--jobs",
+    "-j",
+    default=1,
+    type=click.IntRange(min=0),
+    help=str(
+        "number of protoc invocations to run concurrently, with one invocation"
+        " per target and shard (0 uses the number of cpus, default is a single"
+        " invocation for all targets)"
+    ),
+)
+@click.option(
+    "--shards",
+    default=1,
+    type=click.IntRange(min=1),
+    help=str(
+        "split the proto files into this many protoc invocations,"
+        " keeping files that import each other together"
+    ),
+)
 @click.pass_context
 def proto_compile(
     ctx: click.Context,
@@ -75,7 +281,32 @@ def proto_compile(
     clear_output_dirs: bool,
     verbosity: int,
     protoc_version: str,
+    protoc_sha256: typing.Optional[str],
+    cache_dir: typing.Optional[str],
+    no_cache: bool,
+    mirror: typing.Optional[str],
+    offline: bool,
+    remote_cache: typing.Optional[str],
+    remote_cache_read_only: bool,
+    no_embedded_protoc: bool,
+    no_daemon: bool,
+    extra_source_dirs: typing.List[str],
+    include_dirs: typing.List[str],
+    include: typing.Tuple[str, ...],
+    exclude: typing.Tuple[str, ...],
+    no_gitignore: bool,
+    descriptor_set: bool,
+    descriptor_set_out: typing.Optional[str],
+    profile: bool,
+    profile_dir: str,
+    watch: bool,
+    incremental: bool,
+    jobs: int,
+    shards: int,
 ) -> None:
+    configure_logging()
+    if incremental and no_cache:
+        raise click.UsageError("--incremental cannot be used with --no-cache")
     ctx.ensure_object(dict)
     ctx.obj["COMPILER_OPTIONS"] = BaseCompilerOptions(
         proto_source_dir=proto_source_dir,
@@ -84,6 +315,27 @@ def proto_compile(
         clear_output_dirs=clear_output_dirs,
         verbosity=verbosity,
         protoc_version=protoc_version,
+        protoc_sha256=protoc_sha256,
+        use_cache=not no_cache,
+        cache_dir=cache_dir,
+        incremental=incremental,
+        jobs=jobs,
+        shards=shards,
+        embedded_protoc=not no_embedded_protoc,
+        daemon_socket=None if no_daemon else default_socket_path(),
+        watch=watch,
+        include=list(include) or None,
+        exclude=list(exclude) or None,
+        gitignore=not no_gitignore,
+        extra_source_dirs=list(extra_source_dirs),
+        include_dirs=list(include_dirs),
+        descriptor_set=descriptor_set,
+        descriptor_set_out=descriptor_set_out,
+        profile=profile_dir if profile else None,
+        mirror=mirror,
+        offline=offline,
+        remote_cache=remote_cache,
+        remote_cache_read_only=remote_cache_read_only,
     )
 
 
@@ -233,5 +485,255 @@ def python_grpc(
     return 0
 
 
+def manifest_options(f: typing.Callable[..., typing.Any]) -> typing.Any:
+    """Adds the options that override the shared options of a manifest"""
+    decorators = [
+        click.option(
+            "--verbosity",
+            default=None,
+            type=int,
+            help=str(
+                "level of verbosity when printing to stdout"
+                " (the higher the more output)"
+            ),
+        ),
+        click.option(
+            "--jobs",
+            "-j",
+            default=None,
+            type=click.IntRange(min=0),
+            help=str(
+                "number of protoc invocations of all jobs to run concurrently"
+                " (default is the jobs option of the manifest or the number of cpus)"
+            ),
+        ),
+        click.option(
+            "--no-cache",
+            is_flag=True,
+            default=False,
+            help=str("always download the toolchain instead of using the cache"),
+        ),
+        click.option(
+            "--profile",
+            default=None,
+            type=click.Path(file_okay=False),
+            help=str("print a timing summary and write the reports into this dir"),
+        ),
+        click.option(
+            "--mirror",
+            default=None,
+            envvar=MIRROR_ENV,
+            help=str("dir or URL to download the toolchain from instead of github"),
+        ),
+        click.option(
+            "--offline",
+            is_flag=True,
+            default=False,
+            envvar=OFFLINE_ENV,
+            help=str("only install the toolchain from the cache or the --mirror"),
+        ),
+        click.option(
+            "--remote-cache",
+            default=None,
+            envvar=REMOTE_CACHE_ENV,
+            help=str("dir or http(s) URL of a cache of generated outputs"),
+        ),
+        click.option(
+            "--remote-cache-read-only",
+            is_flag=True,
+            default=False,
+            help=str("never upload outputs to the --remote-cache"),
+        ),
+    ]
+    for decorator in reversed(decorators):
+        f = decorator(f)
+    return f
+
+
+def load_cli_manifest(
+    manifest: str,
+    verbosity: typing.Optional[int],
+    no_cache: bool,
+    profile: typing.Optional[str],
+    mirror: typing.Optional[str],
+    offline: bool,
+    remote_cache: typing.Optional[str],
+    remote_cache_read_only: bool,
+) -> BatchManifest:
+    """Loads a manifest with the options of manifest_options()"""
+    try:
+        return load_manifest(
+            manifest,
+            verbosity=verbosity,
+            use_cache=False if no_cache else None,
+            profile=os.path.abspath(profile) if profile is not None else None,
+            mirror=mirror_url(mirror) if mirror is not None else None,
+            offline=True if offline else None,
+            remote_cache=(
+                remote_cache
+                if remote_cache is None or "://" in remote_cache
+                else os.path.abspath(remote_cache)
+            ),
+            remote_cache_read_only=True if remote_cache_read_only else None,
+        )
+    except ValueError as e:
+        raise click.ClickException(str(e))
+
+
+@click.command()
+@click.argument("manifest", type=click.Path(exists=True, dir_okay=False))
+@manifest_options
+def batch(manifest: str, jobs: typing.Optional[int], **overrides: typing.Any) -> None:
+    """compile all jobs of a TOML or YAML batch manifest with one toolchain"""
+    configure_logging()
+    loaded = load_cli_manifest(manifest, **overrides)
+    compiler.compile_batch(
+        loaded.jobs, jobs=jobs if jobs is not None else loaded.workers
+    )
+
+
+@click.command()
+@click.argument("names", nargs=-1)
+@click.option(
+    "--config",
+    "-c",
+    default=None,
+    type=click.Path(exists=True, dir_okay=False),
+    help=str("project file to build (default is the closest %s)" % PROJECT_FILE),
+)
+@manifest_options
+def build(
+    names: typing.Tuple[str, ...],
+    config: typing.Optional[str],
+    jobs: typing.Optional[int],
+    **overrides: typing.Any,
+) -> None:
+    """build the named jobs (default is all jobs) of a project file"""
+    configure_logging()
+    if config is None:
+        config = find_project()
+        if config is None:
+            raise click.ClickException(
+                "no {} found in the current dir or its parents".format(PROJECT_FILE)
+            )
+    loaded = load_cli_manifest(config, **overrides)
+    try:
+        selected = loaded.select(names)
+    except ValueError as e:
+        raise click.ClickException(str(e))
+    project_build(selected, jobs=jobs if jobs is not None else loaded.workers)
+
+
+def parse_platforms(
+    ctx: click.core.Context, param: click.core.Parameter, value: typing.Tuple[str, ...]
+) -> typing.List[Platform]:
+    try:
+        return [parse_platform(v) for v in value]
+    except ValueError as e:
+        raise click.BadParameter(str(e), ctx=ctx, param=param)
+
+
+@click.command()
+@click.argument("mirror-dir", type=click.Path(file_okay=False))
+@click.option(
+    "--protoc-version",
+    "protoc_versions",
+    multiple=True,
+    help="protoc version to mirror (default is %s)" % versions.DEFAULT_PROTOC_VERSION,
+)
+@click.option(
+    "--grpc-web-version",
+    "grpc_web_versions",
+    multiple=True,
+    help="grpc web plugin version to mirror (default is %s)"
+    % versions.DEFAULT_PLUGIN_VERSIONS[Target.GRPC_WEB],
+)
+@click.option(
+    "--platform",
+    "platforms",
+    multiple=True,
+    callback=parse_platforms,
+    help=str(
+        "<system>-<machine> to mirror the releases of, e.g. linux-x86_64 or"
+        " darwin-arm64 (default is this platform)"
+    ),
+)
+@click.option(
+    "--from",
+    "source",
+    default=None,
+    help=str("mirror to copy the releases from (default is github)"),
+)
+@click.option(
+    "--jobs",
+    "-j",
+    default=None,
+    type=click.IntRange(min=1),
+    help=str("number of concurrent downloads (default is the number of cpus)"),
+)
+@click.option(
+    "--verbosity",
+    default=0,
+    help=str("level of verbosity when printing to stdout (the higher the more output)"),
+)
+def prefetch(
+    mirror_dir: str,
+    protoc_versions: typing.Tuple[str, ...],
+    grpc_web_versions: typing.Tuple[str, ...],
+    platforms: typing.List[Platform],
+    source: typing.Optional[str],
+    jobs: typing.Optional[int],
+    verbosity: int,
+) -> None:
+    """download the toolchain releases into a mirror for --mirror and --offline"""
+    configure_logging()
+    try:
+        fetched = prefetch_releases(
+            mirror_dir,
+            protoc_versions=list(protoc_versions)
+            or [versions.DEFAULT_PROTOC_VERSION],
+            grpc_web_versions=list(grpc_web_versions)
+            or [versions.DEFAULT_PLUGIN_VERSIONS[Target.GRPC_WEB]],
+            platforms=platforms,
+            source=source,
+            jobs=jobs,
+            verbosity=verbosity,
+        )
+    except DownloadError as e:
+        raise click.ClickException(str(e))
+    print("mirrored {} new artifact(s) in {}".format(len(fetched), mirror_dir))
+
+
+@click.command()
+@click.option(
+    "--socket",
+    "socket_path",
+    default=None,
+    type=click.Path(),
+    help=str(
+        "unix socket to listen on (default is $PROTO_COMPILE_DAEMON_SOCKET"
+        " or daemon.sock in the cache dir)"
+    ),
+)
+@click.option(
+    "--verbosity",
+    default=0,
+    help=str("level of verbosity when printing to stdout (the higher the more output)"),
+)
+def daemon(socket_path: typing.Optional[str], verbosity: int) -> None:
+    """run a daemon that compiles the requests of proto-compile"""
+    configure_logging()
+    server = Daemon(
+        socket_path or default_socket_path(), compiler.compile, verbosity=verbosity
+    )
+    print("listening on {}".format(server.socket_path))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:  # pragma: no cover
+        pass
+    finally:
+        server.server_close()
+
+
 if __name__ == "__main__":
     sys.exit(proto_compile(obj=dict()))  # pragma: no cover
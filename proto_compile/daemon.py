@@ -0,0 +1,244 @@
+"""Long-running compile daemon that accepts compile requests over a Unix socket.
+
+The daemon keeps the toolchain warm between compilations: verified cache
+entries, resolved plugin versions and parsed imports are kept in memory, so a
+forwarded compilation mostly pays for protoc itself.
+"""
+
+import contextlib
+import io
+import json
+import logging
+import os
+import socket
+import socketserver
+import threading
+import typing
+from pathlib import Path
+
+from proto_compile.cache import default_cache_dir
+from proto_compile.mirrors import mirror_url
+from proto_compile.options import BaseCompilerOptions, CompilerOptions, CompileTarget
+from proto_compile.result import CompileResult, Diagnostic
+from proto_compile.utils import PathLike
+from proto_compile.versions import Target
+
+SOCKET_ENV = "PROTO_COMPILE_DAEMON_SOCKET"
+
+log = logging.getLogger(__name__)
+
+
+class DaemonError(Exception):
+    """Raised when the daemon failed to compile a forwarded request"""
+
+
+def default_socket_path() -> Path:
+    """Returns $PROTO_COMPILE_DAEMON_SOCKET or daemon.sock in the cache dir"""
+    socket_path = os.environ.get(SOCKET_ENV)
+    if socket_path:
+        return Path(socket_path)
+    return default_cache_dir() / "daemon.sock"
+
+
+def _abspath(path: typing.Optional[PathLike]) -> typing.Optional[str]:
+    return os.path.abspath(path) if path is not None else None
+
+
+def encode_options(options: CompilerOptions) -> typing.Dict[str, typing.Any]:
+    """Serializes options with absolute paths, as the daemon has another cwd"""
+    return dict(
+        proto_source_dir=_abspath(options.proto_source_dir),
+        output_dir=_abspath(options.output_dir),
+        minimal_include_dir=options.minimal_include_dir,
+        clear_output_dirs=options.clear_output_dirs,
+        verbosity=options.verbosity,
+        protoc_version=options.protoc_version,
+        protoc_sha256=options.protoc_sha256,
+        use_cache=options.use_cache,
+        cache_dir=_abspath(options.cache_dir),
+        incremental=options.incremental,
+        jobs=options.jobs,
+        shards=options.shards,
+        embedded_protoc=options.embedded_protoc,
+        include=options.include,
+        exclude=options.exclude,
+        gitignore=options.gitignore,
+        extra_source_dirs=[_abspath(d) for d in options.extra_source_dirs],
+        include_dirs=[_abspath(d) for d in options.include_dirs],
+        descriptor_set=options.descriptor_set,
+        descriptor_set_out=_abspath(options.descriptor_set_out),
+        profile=_abspath(options.profile),
+        mirror=mirror_url(options.mirror) if options.mirror is not None else None,
+        offline=options.offline,
+        remote_cache=(
+            options.remote_cache
+            if options.remote_cache is None or "://" in options.remote_cache
+            else os.path.abspath(options.remote_cache)
+        ),
+        remote_cache_read_only=options.remote_cache_read_only,
+        targets=[
+            dict(
+                language=target.language.name,
+                out_options=target.out_options,
+                output_dir=_abspath(target.output_dir),
+                plugin_version=target.plugin_version,
+            )
+            for target in options.targets
+        ],
+    )
+
+
+def decode_options(encoded: typing.Dict[str, typing.Any]) -> CompilerOptions:
+    encoded = dict(encoded)
+    targets = [
+        CompileTarget(
+            Target[target["language"]],
+            out_options=target["out_options"],
+            output_dir=target["output_dir"],
+            plugin_version=target["plugin_version"],
+        )
+        for target in encoded.pop("targets")
+    ]
+    return CompilerOptions(BaseCompilerOptions(**encoded), targets=targets)
+
+
+def encode_result(result: CompileResult) -> typing.Dict[str, typing.Any]:
+    return dict(
+        outputs=result.outputs,
+        written=result.written,
+        removed=result.removed,
+        timings=result.timings,
+        cache=result.cache,
+        versions=result.versions,
+        diagnostics=[d._asdict() for d in result.diagnostics],
+        wall_time=result.wall_time,
+    )
+
+
+def decode_result(encoded: typing.Dict[str, typing.Any]) -> CompileResult:
+    encoded = dict(encoded)
+    diagnostics = [Diagnostic(**d) for d in encoded.pop("diagnostics")]
+    return CompileResult(diagnostics=diagnostics, **encoded)
+
+
+def _request(
+    socket_path: PathLike, request: typing.Dict[str, typing.Any]
+) -> typing.Any:
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(str(socket_path))
+        with sock.makefile("rwb") as stream:
+            stream.write(json.dumps(request).encode("utf-8") + b"\n")
+            stream.flush()
+            response = stream.readline()
+    if not response:
+        raise DaemonError("the daemon closed the connection")
+    return json.loads(response)
+
+
+def forward(
+    options: CompilerOptions, socket_path: PathLike
+) -> typing.Optional[CompileResult]:
+    """Compiles options in the daemon listening on socket_path.
+
+    Returns None if no daemon is running or it cannot be reached, in which
+    case the caller compiles locally. Raises DaemonError if the compilation
+    failed.
+    """
+    try:
+        response = _request(
+            socket_path, dict(command="compile", options=encode_options(options))
+        )
+    except (FileNotFoundError, ConnectionRefusedError):
+        return None
+    except OSError as e:
+        # e.g. timeouts, permissions or a daemon that went away mid request
+        log.warning("compiling locally, the daemon failed: %s", e)
+        return None
+    if response.get("output"):
+        log.info("%s", response["output"].rstrip("\n"))
+    if response.get("error") is not None:
+        raise DaemonError(response["error"])
+    if response.get("result") is None:
+        return CompileResult()
+    return decode_result(response["result"])
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    server: "Daemon"
+
+    def handle(self) -> None:
+        line = self.rfile.readline()
+        if not line:
+            return
+        try:
+            request = json.loads(line)
+            if request.get("command") != "compile":
+                raise ValueError("unknown command {}".format(request.get("command")))
+            response = self.server.compile_request(decode_options(request["options"]))
+        except (ValueError, KeyError, TypeError) as e:
+            response = dict(
+                output="", error="invalid request: {}".format(e), result=None
+            )
+        self.wfile.write(json.dumps(response).encode("utf-8") + b"\n")
+
+
+class Daemon(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """Compiles forwarded requests one at a time with compile_fn"""
+
+    daemon_threads = True
+
+    def __init__(
+        self,
+        socket_path: PathLike,
+        compile_fn: typing.Callable[[CompilerOptions], typing.Optional[CompileResult]],
+        verbosity: int = 0,
+    ) -> None:
+        self.socket_path = Path(socket_path)
+        self.compile_fn = compile_fn
+        self.verbosity = verbosity
+        # output is captured by replacing sys.stdout, which is process wide
+        self.lock = threading.Lock()
+        self.socket_path.parent.mkdir(parents=True, exist_ok=True)
+        if self.socket_path.exists():
+            if _is_listening(self.socket_path):
+                raise DaemonError(
+                    "a daemon is already listening on {}".format(self.socket_path)
+                )
+            # left behind by a daemon that was killed
+            self.socket_path.unlink()
+        super().__init__(str(self.socket_path), _Handler)
+
+    def compile_request(self, options: CompilerOptions) -> typing.Dict[str, typing.Any]:
+        output = io.StringIO()
+        error = None
+        result = None
+        with self.lock, contextlib.redirect_stdout(output):
+            try:
+                result = self.compile_fn(options)
+            except Exception as e:
+                error = "{}: {}".format(type(e).__name__, e)
+        if self.verbosity > 0:
+            log.info(
+                "compiled %s (%s)",
+                options.proto_source_dir,
+                "failed" if error else "ok",
+            )
+        return dict(
+            output=output.getvalue(),
+            error=error,
+            result=encode_result(result) if result is not None else None,
+        )
+
+    def server_close(self) -> None:
+        super().server_close()
+        with contextlib.suppress(FileNotFoundError):
+            self.socket_path.unlink()
+
+
+def _is_listening(socket_path: PathLike) -> bool:
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        try:
+            sock.connect(str(socket_path))
+        except OSError:
+            return False
+    return True
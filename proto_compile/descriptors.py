@@ -0,0 +1,130 @@
+"""Parses the proto files once into a FileDescriptorSet that all targets share.
+
+protoc writes the parsed and linked files with ``--descriptor_set_out`` and
+``--include_imports``. The code generators of the targets then read the set
+with ``--descriptor_set_in`` instead of parsing the proto files again. Sets
+are cached by the hash of all files they contain.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import shutil
+import typing
+import uuid
+from pathlib import Path
+
+from proto_compile import result as result
+from proto_compile.cache import ToolchainCache
+from proto_compile.imports import parse_imports
+from proto_compile.plugins import ProtoCompiler
+from proto_compile.utils import PathLike, file_sha256
+
+log = logging.getLogger(__name__)
+
+
+def proto_name(include_dirs: typing.List[str], path: PathLike) -> str:
+    """Returns the name of a proto file relative to the first include dir"""
+    abs_path = os.path.abspath(path)
+    for include_dir in include_dirs:
+        if os.path.commonpath([include_dir, abs_path]) == include_dir:
+            return Path(os.path.relpath(abs_path, include_dir)).as_posix()
+    raise ValueError("{} is not in any include dir".format(path))
+
+
+def import_closure(
+    include_dirs: typing.List[str], proto_files: typing.Iterable[PathLike]
+) -> typing.Dict[str, str]:
+    """Maps the names of the proto files and of all their imports to paths.
+
+    Imports that are not found in the include dirs (e.g. the well known
+    types bundled with protoc) are left out.
+    """
+    closure: typing.Dict[str, str] = dict()
+    stack = [os.path.abspath(path) for path in proto_files]
+    while stack:
+        path = stack.pop()
+        name = proto_name(include_dirs, path)
+        if name in closure:
+            continue
+        closure[name] = path
+        for imp in parse_imports(path):
+            for include_dir in include_dirs:
+                candidate = os.path.join(include_dir, imp)
+                if os.path.isfile(candidate):
+                    stack.append(candidate)
+                    break
+    return closure
+
+
+def descriptor_set_key(
+    compiler_id: str,
+    include_dirs: typing.List[str],
+    proto_files: typing.Iterable[PathLike],
+) -> str:
+    """Hashes the compiler and the contents of every file in the set"""
+    closure = import_closure(include_dirs, proto_files)
+    key = json.dumps(
+        [
+            compiler_id,
+            sorted(proto_name(include_dirs, path) for path in proto_files),
+            sorted((name, file_sha256(path)) for name, path in closure.items()),
+        ]
+    )
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+
+def build_descriptor_set(
+    compiler: ProtoCompiler,
+    compiler_id: str,
+    include_dirs: typing.List[str],
+    proto_files: typing.List[PathLike],
+    dest_dir: PathLike,
+    cache: typing.Optional[ToolchainCache] = None,
+    verbosity: int = 0,
+) -> Path:
+    """Returns a FileDescriptorSet of proto_files and all their imports.
+
+    compiler_id identifies the protoc version, as the set contains the well
+    known types of the compiler. Cached sets are reused if no file changed.
+    Without a cache, the set is written to dest_dir.
+    """
+    key = descriptor_set_key(compiler_id, include_dirs, proto_files)
+    if cache is not None:
+        path = cache.descriptors_dir / (key + ".pb")
+        cached = path.is_file()
+        result.record_cache("descriptor set", cached)
+        if cached:
+            # mark as recently used
+            os.utime(path)
+            if verbosity > 0:
+                log.info("using cached descriptor set %s", path)
+            return path
+    else:
+        path = Path(dest_dir) / (key + ".pb")
+
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.parent / ("%s.%s.tmp" % (path.name, uuid.uuid4()))
+    try:
+        compiler.compile(
+            ["-I={}".format(include_dir) for include_dir in include_dirs]
+            + [
+                "--descriptor_set_out={}".format(tmp),
+                "--include_imports",
+            ]
+            + [str(f) for f in proto_files],
+            verbosity=verbosity,
+        )
+        os.replace(tmp, path)
+    finally:
+        if tmp.exists():
+            os.remove(tmp)
+    return path
+
+
+def copy_descriptor_set(path: PathLike, out: PathLike) -> None:
+    """Copies a descriptor set for other tools"""
+    out = Path(out)
+    out.parent.mkdir(parents=True, exist_ok=True)
+    shutil.copyfile(path, out)
@@ -0,0 +1,282 @@
+"""Discovery of .proto files with gitignore style rules and a persistent index.
+
+Excluded directories are pruned before they are walked. The index records
+the mtime and the matching entries of every walked directory, so that warm
+runs only list the directories that changed since the last run.
+"""
+
+import hashlib
+import json
+import os
+import re
+import typing
+import uuid
+from pathlib import Path
+
+from proto_compile.utils import PathLike
+
+IGNORE_FILE = ".gitignore"
+INDEX_VERSION = 1
+DEFAULT_INCLUDE = ["*.proto"]
+# never contain protos that should be compiled
+DEFAULT_EXCLUDE = [
+    ".git/",
+    ".hg/",
+    ".svn/",
+    "node_modules/",
+    "__pycache__/",
+    ".mypy_cache/",
+    ".tox/",
+    ".venv/",
+]
+
+
+class Pattern(typing.NamedTuple):
+    # dir (relative to the source dir) the pattern is relative to
+    base: str
+    regex: typing.Pattern[str]
+    negate: bool
+    dir_only: bool
+
+
+def _translate(glob: str) -> str:
+    """Translates a gitignore glob into a regex that matches relative paths"""
+    regex = ""
+    i = 0
+    while i < len(glob):
+        if glob.startswith("**/", i):
+            regex += "(?:.*/)?"
+            i += 3
+        elif glob.startswith("**", i):
+            regex += ".*"
+            i += 2
+        elif glob[i] == "*":
+            regex += "[^/]*"
+            i += 1
+        elif glob[i] == "?":
+            regex += "[^/]"
+            i += 1
+        elif glob[i] == "[" and "]" in glob[i + 2 :]:
+            end = glob.index("]", i + 2)
+            regex += "[" + glob[i + 1 : end].replace("!", "^", 1) + "]"
+            i = end + 1
+        else:
+            regex += re.escape(glob[i])
+            i += 1
+    return regex
+
+
+def compile_pattern(line: str, base: str = "") -> typing.Optional[Pattern]:
+    """Compiles a line of a .gitignore file, returns None for comments"""
+    line = line.rstrip("\n").rstrip()
+    if not line or line.startswith("#"):
+        return None
+    negate = line.startswith("!")
+    if negate:
+        line = line[1:]
+    dir_only = line.endswith("/")
+    line = line.rstrip("/")
+    if not line:
+        return None
+    if "/" in line:
+        # patterns with a slash are relative to the dir of the .gitignore
+        regex = _translate(line.lstrip("/"))
+    else:
+        regex = "(?:.*/)?" + _translate(line)
+    return Pattern(base, re.compile(regex + "$"), negate, dir_only)
+
+
+class IgnoreRules:
+    """Ordered gitignore patterns, where the last matching pattern wins"""
+
+    def __init__(self, patterns: typing.Sequence[Pattern] = ()) -> None:
+        self.patterns = list(patterns)
+
+    def extended(self, lines: typing.Iterable[str], base: str = "") -> "IgnoreRules":
+        patterns = [compile_pattern(line, base) for line in lines]
+        return IgnoreRules(self.patterns + [p for p in patterns if p is not None])
+
+    def matches(self, rel_path: str, is_dir: bool = False) -> bool:
+        matches = False
+        for pattern in self.patterns:
+            if pattern.dir_only and not is_dir:
+                continue
+            if pattern.base:
+                if not rel_path.startswith(pattern.base + "/"):
+                    continue
+                path = rel_path[len(pattern.base) + 1 :]
+            else:
+                path = rel_path
+            if pattern.regex.match(path):
+                matches = not pattern.negate
+        return matches
+
+
+def _read_ignore_file(path: str) -> typing.List[str]:
+    try:
+        with open(path, encoding="utf-8", errors="replace") as f:
+            return f.readlines()
+    except OSError:
+        return []
+
+
+def _mtime(path: str) -> typing.Optional[int]:
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+
+def index_name(
+    source_dir: PathLike,
+    include: typing.Sequence[str],
+    exclude: typing.Sequence[str],
+    gitignore: bool,
+) -> str:
+    """Name of the index, which depends on the source dir and the rules"""
+    key = json.dumps(
+        [os.path.abspath(source_dir), list(include), list(exclude), gitignore]
+    )
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()[:32] + ".json"
+
+
+def _load_index(path: typing.Optional[PathLike]) -> typing.Dict[str, typing.Any]:
+    if path is None:
+        return dict()
+    try:
+        with open(path) as f:
+            index = json.load(f)
+        if index.get("version") == INDEX_VERSION:
+            return dict(index["dirs"])
+    except (OSError, ValueError, KeyError, AttributeError):
+        pass
+    return dict()
+
+
+def _save_index(path: PathLike, dirs: typing.Dict[str, typing.Any]) -> None:
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.parent / ("%s.%s.tmp" % (path.name, uuid.uuid4()))
+    with open(tmp, "w") as f:
+        json.dump(dict(version=INDEX_VERSION, dirs=dirs), f, sort_keys=True)
+    os.replace(tmp, path)
+
+
+def discover(
+    source_dir: PathLike,
+    include: typing.Optional[typing.Sequence[str]] = None,
+    exclude: typing.Optional[typing.Sequence[str]] = None,
+    gitignore: bool = True,
+    index_path: typing.Optional[PathLike] = None,
+) -> typing.List[str]:
+    """Returns the sorted absolute paths of all included files in source_dir.
+
+    include and exclude are gitignore style globs relative to source_dir,
+    e.g. ``api/**/*.proto`` or ``third_party/``. exclude is added to the
+    DEFAULT_EXCLUDE dirs and, with gitignore, to the .gitignore files found
+    in source_dir. With an index_path, unchanged directories are not listed
+    again.
+    """
+    root = os.path.abspath(source_dir)
+    includes = IgnoreRules().extended(include or DEFAULT_INCLUDE)
+    root_rules = IgnoreRules().extended(DEFAULT_EXCLUDE + list(exclude or []))
+    cached = _load_index(index_path)
+    dirs: typing.Dict[str, typing.Any] = dict()
+
+    stack: typing.List[typing.Tuple[str, IgnoreRules, bool]] = [("", root_rules, False)]
+    while stack:
+        rel_dir, rules, rules_changed = stack.pop()
+        abs_dir = os.path.join(root, rel_dir) if rel_dir else root
+        mtime = _mtime(abs_dir)
+        if mtime is None:
+            continue
+        entry = cached.get(rel_dir)
+        ignore_file = os.path.join(abs_dir, IGNORE_FILE)
+        # a new .gitignore changes the mtime of the dir, but edits do not
+        check_ignore_file = gitignore and (
+            entry is None or entry["mtime"] != mtime or entry["ignore"] is not None
+        )
+        ignore_mtime = _mtime(ignore_file) if check_ignore_file else None
+        if entry is None or entry["ignore"] != ignore_mtime:
+            # the subdirs inherit the changed rules
+            rules_changed = True
+        if ignore_mtime is not None:
+            rules = rules.extended(_read_ignore_file(ignore_file), base=rel_dir)
+
+        if entry is None or rules_changed or entry["mtime"] != mtime:
+            entry = dict(mtime=mtime, ignore=ignore_mtime, files=[], dirs=[])
+            with os.scandir(abs_dir) as it:
+                for child in it:
+                    rel_path = rel_dir + "/" + child.name if rel_dir else child.name
+                    if child.is_dir(follow_symlinks=False):
+                        if not rules.matches(rel_path, is_dir=True):
+                            entry["dirs"].append(child.name)
+                    elif child.is_file() and not rules.matches(rel_path):
+                        if includes.matches(rel_path):
+                            entry["files"].append(child.name)
+        dirs[rel_dir] = entry
+        for name in entry["dirs"]:
+            rel_path = rel_dir + "/" + name if rel_dir else name
+            stack.append((rel_path, rules, rules_changed))
+
+    if index_path is not None:
+        if dirs != cached:
+            _save_index(index_path, dirs)
+        else:
+            # mark as recently used
+            os.utime(index_path)
+    return sorted(
+        os.path.join(root, rel_dir, name) if rel_dir else os.path.join(root, name)
+        for rel_dir, entry in dirs.items()
+        for name in entry["files"]
+    )
+
+
+def walk_dirs(
+    source_dir: PathLike,
+    exclude: typing.Optional[typing.Sequence[str]] = None,
+    gitignore: bool = True,
+    start: typing.Optional[PathLike] = None,
+) -> typing.List[str]:
+    """Returns the absolute paths of the dirs that discover() walks.
+
+    With start, a dir below source_dir, only start and the dirs below it are
+    returned, none if start is excluded.
+    """
+    root = os.path.abspath(source_dir)
+    rules = IgnoreRules().extended(DEFAULT_EXCLUDE + list(exclude or []))
+    rel_start = Path(os.path.relpath(start, root)).as_posix() if start else "."
+    if rel_start == ".." or rel_start.startswith("../"):
+        return []
+    parts = [] if rel_start == "." else rel_start.split("/")
+    # the rules of the parents of start apply to it
+    for i in range(len(parts)):
+        parent = "/".join(parts[:i])
+        if gitignore:
+            abs_parent = os.path.join(root, parent) if parent else root
+            rules = rules.extended(
+                _read_ignore_file(os.path.join(abs_parent, IGNORE_FILE)), base=parent
+            )
+        if rules.matches("/".join(parts[: i + 1]), is_dir=True):
+            return []
+
+    dirs: typing.List[str] = []
+    stack = [("/".join(parts), rules)]
+    while stack:
+        rel_dir, rules = stack.pop()
+        abs_dir = os.path.join(root, rel_dir) if rel_dir else root
+        if gitignore:
+            rules = rules.extended(
+                _read_ignore_file(os.path.join(abs_dir, IGNORE_FILE)), base=rel_dir
+            )
+        try:
+            with os.scandir(abs_dir) as it:
+                children = [c.name for c in it if c.is_dir(follow_symlinks=False)]
+        except OSError:
+            continue
+        dirs.append(abs_dir)
+        for name in children:
+            rel_path = rel_dir + "/" + name if rel_dir else name
+            if not rules.matches(rel_path, is_dir=True):
+                stack.append((rel_path, rules))
+    return dirs
@@ -0,0 +1,158 @@
+"""Dependency graph of .proto files based on their import statements."""
+
+import math
+import os
+import re
+import typing
+
+from proto_compile.utils import PathLike
+
+IMPORT_RE = re.compile(r'^\s*import\s+(?:(?:public|weak)\s+)?"([^"]+)"\s*;', re.M)
+# string literals are matched as well, so that e.g. "http://..." is no comment
+COMMENT_RE = re.compile(
+    r'"(?:\\.|[^"\\\n])*"|\'(?:\\.|[^\'\\\n])*\'|//[^\n]*|/\*.*?\*/', re.S
+)
+
+
+def _strip_comment(match: typing.Match[str]) -> str:
+    token = match.group(0)
+    return token if token[0] in "\"'" else ""
+
+
+# parsed imports by path, valid as long as the file is unchanged
+_parsed: typing.Dict[str, typing.Tuple[typing.Tuple[int, int], typing.List[str]]] = (
+    dict()
+)
+
+
+# a single include dir or several include dirs in the order of protoc -I
+IncludeDirs = typing.Union[PathLike, typing.Sequence[PathLike]]
+
+
+def include_dirs(include_dir: IncludeDirs) -> typing.List[str]:
+    """Returns the absolute include dirs"""
+    if isinstance(include_dir, (str, os.PathLike)):
+        return [os.path.abspath(include_dir)]
+    return [os.path.abspath(d) for d in include_dir]
+
+
+def parse_imports(path: PathLike) -> typing.List[str]:
+    """Returns the import paths of a .proto file in the order they appear"""
+    st = os.stat(path)
+    stat_key = (st.st_size, st.st_mtime_ns)
+    parsed = _parsed.get(str(path))
+    if parsed is not None and parsed[0] == stat_key:
+        return list(parsed[1])
+    with open(path, encoding="utf-8", errors="replace") as f:
+        source = COMMENT_RE.sub(_strip_comment, f.read())
+    imports = IMPORT_RE.findall(source)
+    _parsed[str(path)] = (stat_key, imports)
+    return list(imports)
+
+
+class ImportGraph:
+    """Maps every proto file to the files it imports and the files importing it.
+
+    Imports are resolved relative to the include dirs that are passed to
+    protoc, in the order of the include dirs. Imports of files outside of the
+    graph (e.g. google/protobuf/*.proto) are ignored.
+    """
+
+    def __init__(
+        self, include_dir: IncludeDirs, imports: typing.Mapping[str, typing.List[str]]
+    ) -> None:
+        self.include_dirs = include_dirs(include_dir)
+        self.dependencies: typing.Dict[str, typing.Set[str]] = dict()
+        self.dependents: typing.Dict[str, typing.Set[str]] = {
+            path: set() for path in imports
+        }
+        for path, file_imports in imports.items():
+            resolved = set()
+            for imp in file_imports:
+                dep = self.resolve(imp)
+                if dep is not None:
+                    resolved.add(dep)
+                    self.dependents[dep].add(path)
+            self.dependencies[path] = resolved
+
+    def resolve(self, imp: str) -> typing.Optional[str]:
+        """Returns the file of the graph that an import refers to"""
+        for include_dir in self.include_dirs:
+            dep = os.path.normpath(os.path.join(include_dir, imp))
+            if dep in self.dependents:
+                return dep
+        return None
+
+    @classmethod
+    def from_files(
+        cls, include_dir: IncludeDirs, proto_files: typing.Iterable[PathLike]
+    ) -> "ImportGraph":
+        return cls(include_dir, {str(f): parse_imports(f) for f in proto_files})
+
+    def affected(self, changed: typing.Iterable[str]) -> typing.Set[str]:
+        """Returns the changed files and all files that transitively import them"""
+        affected: typing.Set[str] = set()
+        stack = [path for path in changed if path in self.dependents]
+        while stack:
+            path = stack.pop()
+            if path in affected:
+                continue
+            affected.add(path)
+            stack.extend(self.dependents[path] - affected)
+        return affected
+
+    def components(self) -> typing.List[typing.Set[str]]:
+        """Returns the sets of files that are connected by imports"""
+        components = []
+        seen: typing.Set[str] = set()
+        for path in sorted(self.dependents):
+            if path in seen:
+                continue
+            component: typing.Set[str] = set()
+            stack = [path]
+            while stack:
+                current = stack.pop()
+                if current in component:
+                    continue
+                component.add(current)
+                stack.extend(self.dependencies[current] | self.dependents[current])
+            seen |= component
+            components.append(component)
+        return components
+
+
+def partition(
+    graph: ImportGraph, proto_files: typing.Iterable[PathLike], shards: int
+) -> typing.List[typing.List[str]]:
+    """Splits proto_files into at most shards balanced batches.
+
+    Files that are connected by imports are kept in the same batch, so that
+    shared imports are only parsed once. Components that are larger than a
+    balanced batch are split, which is safe because protoc resolves imports
+    through the include dir and only generates code for the given files.
+    """
+    files = set(str(f) for f in proto_files)
+    if not files:
+        return []
+    shards = max(shards, 1)
+    batch_size = math.ceil(len(files) / shards)
+    components = [c & files for c in graph.components()]
+    # files outside of the graph are independent of each other
+    components += [{f} for f in files - set(graph.dependents)]
+
+    items: typing.List[typing.List[str]] = []
+    for component in components:
+        component_files = sorted(component)
+        if len(component_files) <= batch_size:
+            items.append(component_files)
+            continue
+        chunks = min(
+            len(component_files), math.ceil(len(component_files) * shards / len(files))
+        )
+        items += [component_files[i::chunks] for i in range(chunks)]
+
+    batches: typing.List[typing.List[str]] = [[] for _ in range(shards)]
+    for item in sorted((i for i in items if i), key=lambda i: (-len(i), i[0])):
+        smallest = min(batches, key=len)
+        smallest.extend(item)
+    return sorted(sorted(batch) for batch in batches if batch)
@@ -0,0 +1,344 @@
+"""Incremental compilation based on a manifest of inputs, toolchain and outputs."""
+
+import hashlib
+import json
+import logging
+import os
+import typing
+import uuid
+from pathlib import Path
+
+from proto_compile.cache import ToolchainCache
+from proto_compile.imports import ImportGraph, IncludeDirs, include_dirs, parse_imports
+from proto_compile.options import CompilerOptions, source_dirs
+from proto_compile.plugins import PLUGINS
+from proto_compile.utils import PathLike, file_sha256
+
+log = logging.getLogger(__name__)
+
+# path -> {"sha256": ..., "size": ..., "mtime_ns": ..., "imports": [...]}
+FileRecords = typing.Dict[str, typing.Dict[str, typing.Any]]
+
+
+def _stat_record(path: PathLike, sha256: str) -> typing.Dict[str, typing.Any]:
+    stat = os.stat(path)
+    return dict(sha256=sha256, size=stat.st_size, mtime_ns=stat.st_mtime_ns)
+
+
+def _unchanged(path: PathLike, record: typing.Dict[str, typing.Any]) -> bool:
+    """Cheap check if a file still matches its record without hashing it"""
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return False
+    return bool(
+        stat.st_size == record["size"] and stat.st_mtime_ns == record["mtime_ns"]
+    )
+
+
+def hash_files(
+    paths: typing.Iterable[PathLike], previous: typing.Optional[FileRecords] = None
+) -> FileRecords:
+    """Hashes files, reusing previous hashes of files whose stat is unchanged"""
+    previous = previous or dict()
+    records: FileRecords = dict()
+    for path in paths:
+        key = str(path)
+        record = previous.get(key)
+        if record is not None and _unchanged(path, record):
+            records[key] = record
+        else:
+            records[key] = _stat_record(path, file_sha256(path))
+    return records
+
+
+def toolchain_fingerprint(options: CompilerOptions) -> typing.Dict[str, typing.Any]:
+    """Everything besides the inputs that influences the generated outputs"""
+    targets = []
+    for target in options.targets:
+        plugin = PLUGINS.get(target.language)
+        plugin_version = target.plugin_version or (
+            plugin.default_version if plugin is not None else None
+        )
+        targets.append(
+            dict(
+                target=target.language.name,
+                out_options=target.out_options,
+                output_dir=os.path.abspath(target.output_dir or options.output_dir),
+                plugin_version=plugin_version,
+            )
+        )
+    return dict(
+        protoc_version=options.protoc_version,
+        # the bundled protoc of grpcio-tools replaces the downloaded protoc
+        embedded_protoc=options.embedded_protoc,
+        # the descriptor set adds json names to the generated code
+        descriptor_set=bool(options.descriptor_set or options.descriptor_set_out),
+        targets=targets,
+    )
+
+
+def output_dirs(options: CompilerOptions) -> typing.List[str]:
+    return sorted(
+        set(
+            os.path.abspath(target.output_dir or options.output_dir)
+            for target in options.targets
+        )
+    )
+
+
+def snapshot(
+    dirs: typing.Iterable[PathLike],
+) -> typing.Dict[str, typing.Tuple[int, int]]:
+    """Maps every file in dirs to its (size, mtime_ns)"""
+    files = dict()
+    for d in dirs:
+        for root, dirnames, filenames in os.walk(str(d)):
+            for filename in filenames:
+                path = os.path.join(root, filename)
+                stat = os.stat(path)
+                files[path] = (stat.st_size, stat.st_mtime_ns)
+    return files
+
+
+class BuildManifest:
+    def __init__(
+        self,
+        include_dirs: typing.List[str],
+        toolchain: typing.Dict[str, typing.Any],
+        inputs: FileRecords,
+        outputs: FileRecords,
+    ) -> None:
+        self.include_dirs = include_dirs
+        self.toolchain = toolchain
+        self.inputs = inputs
+        self.outputs = outputs
+
+    def to_dict(self) -> typing.Dict[str, typing.Any]:
+        return dict(
+            include_dirs=self.include_dirs,
+            toolchain=self.toolchain,
+            inputs=self.inputs,
+            outputs=self.outputs,
+        )
+
+    @classmethod
+    def from_dict(cls, d: typing.Dict[str, typing.Any]) -> "BuildManifest":
+        return cls(
+            include_dirs=d["include_dirs"],
+            toolchain=d["toolchain"],
+            inputs=d["inputs"],
+            outputs=d["outputs"],
+        )
+
+    @classmethod
+    def load(cls, path: PathLike) -> typing.Optional["BuildManifest"]:
+        try:
+            with open(path) as f:
+                return cls.from_dict(json.load(f))
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def save(self, path: PathLike) -> None:
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.parent / ("%s.%s.tmp" % (path.name, uuid.uuid4()))
+        with open(tmp, "w") as f:
+            json.dump(self.to_dict(), f, indent=2, sort_keys=True)
+        os.replace(tmp, path)
+
+    def input_digests(self) -> typing.Dict[str, str]:
+        return {path: record["sha256"] for path, record in self.inputs.items()}
+
+
+class IncrementalBuild:
+    """Decides what protoc has to compile and restores outputs from the cache.
+
+    The manifest of the previous build is stored in the toolchain cache and
+    keyed by the source and output directories. Generated outputs are kept in
+    the content addressed blob store of the cache, so that missing or
+    modified outputs can be restored without running protoc.
+
+    The manifest also records the imports of every input, so that after a
+    change only the changed files and the files that transitively import
+    them have to be recompiled.
+    """
+
+    def __init__(
+        self,
+        options: CompilerOptions,
+        include_dir: IncludeDirs,
+        proto_files: typing.List[PathLike],
+        cache: ToolchainCache,
+    ) -> None:
+        self.options = options
+        self.include_dirs = include_dirs(include_dir)
+        self.proto_files = proto_files
+        self.cache = cache
+        # whether only some of the proto files are recompiled
+        self.partial = False
+        self.output_dirs = output_dirs(options)
+
+        key = json.dumps(
+            [os.path.abspath(d) for d in source_dirs(options)] + [self.output_dirs]
+        ).encode("utf-8")
+        self.manifest_path = self.cache.manifests_dir / (
+            "%s.json" % hashlib.sha256(key).hexdigest()
+        )
+        self.previous = BuildManifest.load(self.manifest_path)
+        self.toolchain = toolchain_fingerprint(options)
+        self.inputs = self.hash_inputs()
+        self.graph = ImportGraph(
+            self.include_dirs,
+            {path: record["imports"] for path, record in self.inputs.items()},
+        )
+        self.outputs: FileRecords = dict()
+
+    def hash_inputs(self) -> FileRecords:
+        """Hashes the proto files and everything they import from the include dirs.
+
+        Imports that are only found in the include dirs (e.g. vendored protos)
+        are inputs as well, so that changing them recompiles their importers.
+        """
+        previous = self.previous.inputs if self.previous is not None else None
+        inputs: FileRecords = dict()
+        pending = [str(path) for path in self.proto_files]
+        while pending:
+            records = hash_files(
+                [path for path in pending if path not in inputs], previous=previous
+            )
+            pending = []
+            for path, record in records.items():
+                # imports of unchanged files are reused from the previous manifest
+                if "imports" not in record:
+                    record["imports"] = parse_imports(path)
+                inputs[path] = record
+                for imp in record["imports"]:
+                    dep = self.find_import(imp)
+                    if dep is not None and dep not in inputs:
+                        pending.append(dep)
+        return inputs
+
+    def find_import(self, imp: str) -> typing.Optional[str]:
+        """Returns the file that protoc resolves an import to"""
+        for include_dir in self.include_dirs:
+            path = os.path.normpath(os.path.join(include_dir, imp))
+            if os.path.isfile(path):
+                return path
+        return None
+
+    def dirty_files(self) -> typing.Optional[typing.List[str]]:
+        """Returns the files that have to be recompiled since the last build.
+
+        None means that everything has to be recompiled, e.g. because the
+        toolchain changed, inputs were removed or there is no previous build.
+        """
+        previous = self.previous
+        if previous is None:
+            return None
+        if previous.include_dirs != self.include_dirs:
+            return None
+        if previous.toolchain != self.toolchain:
+            return None
+        if not set(previous.inputs).issubset(self.inputs):
+            # outputs of removed inputs are not tracked
+            return None
+        blobs = self.cache.blobs
+        if not all(blobs.contains(r["sha256"]) for r in previous.outputs.values()):
+            return None
+        digests = previous.input_digests()
+        changed = [
+            path
+            for path, record in self.inputs.items()
+            if digests.get(path) != record["sha256"]
+        ]
+        # imports from the include dirs are never compiled themselves
+        compiled = set(str(path) for path in self.proto_files)
+        return sorted(self.graph.affected(changed) & compiled)
+
+    def prepare(self) -> typing.Optional[typing.List[PathLike]]:
+        """Restores the outputs of the previous build where possible.
+
+        Returns the proto files that have to be compiled or None if
+        everything is up to date.
+        """
+        dirty_files = self.dirty_files()
+        if dirty_files is None:
+            return self.proto_files
+        restored = self.restore()
+        verbosity = self.options.verbosity
+        if not dirty_files:
+            self.save()
+            if verbosity > 0:
+                log.info(
+                    "%s is up to date (restored %d outputs). Skipping...",
+                    ", ".join(self.include_dirs),
+                    len(restored),
+                )
+            return None
+        if verbosity > 0:
+            log.info(
+                "recompiling %d of %d proto files",
+                len(dirty_files),
+                len(self.proto_files),
+            )
+        self.partial = True
+        return list(dirty_files)
+
+    def restore(self) -> typing.List[str]:
+        """Restores missing or modified outputs of the previous build"""
+        assert self.previous is not None
+        blobs = self.cache.blobs
+        restored = []
+        self.outputs = dict()
+        for path, record in self.previous.outputs.items():
+            if _unchanged(path, record) or (
+                os.path.isfile(path) and file_sha256(path) == record["sha256"]
+            ):
+                # mark the blob as recently used
+                blobs.touch(record["sha256"])
+            else:
+                blobs.get(record["sha256"], path)
+                restored.append(path)
+            self.outputs[path] = _stat_record(path, record["sha256"])
+
+        if self.options.clear_output_dirs:
+            # a full build would have removed everything else
+            for path in snapshot(self.output_dirs):
+                if path not in self.outputs:
+                    os.remove(path)
+        return restored
+
+    def commit(self, generated: typing.Iterable[str]) -> None:
+        """Records the generated outputs that are in the output dirs.
+
+        Unchanged outputs keep their stat, so their hashes are reused.
+        """
+        outputs = hash_files(
+            [path for path in generated if self.owns(path)],
+            previous=self.previous.outputs if self.previous is not None else None,
+        )
+        blobs = self.cache.blobs
+        for path, record in outputs.items():
+            blobs.put(path, digest=record["sha256"])
+        self.outputs.update(outputs)
+        self.save()
+        self.cache.evict(
+            keep=[blobs.path(r["sha256"]) for r in self.outputs.values()]
+            + [self.manifest_path]
+        )
+
+    def owns(self, path: str) -> bool:
+        """Whether path is in one of the output dirs of this build"""
+        return any(
+            os.path.commonpath([output_dir, path]) == output_dir
+            for output_dir in self.output_dirs
+        )
+
+    def save(self) -> None:
+        BuildManifest(
+            include_dirs=self.include_dirs,
+            toolchain=self.toolchain,
+            inputs=self.inputs,
+            outputs=self.outputs,
+        ).save(self.manifest_path)
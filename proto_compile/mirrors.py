@@ -0,0 +1,63 @@
+"""Resolves release downloads from a mirror instead of the upstream releases.
+
+A mirror is a local dir, a file:// URL or an internal HTTP(S) URL with one
+subdir per artifact that has the layout of the upstream release downloads,
+e.g. ``<mirror>/protoc/v27.2/protoc-27.2-linux-x86_64.zip``. The sha256 of
+an artifact may be stored next to it in ``<artifact>.sha256``, see prefetch.py.
+Offline, nothing is downloaded from the upstream releases.
+"""
+
+import os
+import typing
+from pathlib import Path
+
+from proto_compile.utils import PathLike
+
+PROTOC_DIR = "protoc"
+GRPC_WEB_DIR = "grpc-web"
+SHA256_SUFFIX = ".sha256"
+MIRROR_ENV = "PROTO_COMPILE_MIRROR"
+OFFLINE_ENV = "PROTO_COMPILE_OFFLINE"
+
+
+class OfflineError(Exception):
+    pass
+
+
+def mirror_url(mirror: PathLike) -> str:
+    """Returns the base URL of a mirror, where local dirs become file:// URLs"""
+    mirror = str(mirror)
+    if "://" in mirror:
+        return mirror.rstrip("/")
+    return Path(os.path.abspath(os.path.expanduser(mirror))).as_uri()
+
+
+def base_url(
+    upstream: str,
+    subdir: str,
+    mirror: typing.Optional[PathLike] = None,
+    offline: bool = False,
+) -> str:
+    """Returns the base URL of an artifact in the mirror or upstream.
+
+    Raises an OfflineError if offline and no mirror is configured.
+    """
+    if mirror is not None:
+        return mirror_url(mirror) + "/" + subdir
+    if offline:
+        raise OfflineError(
+            "cannot download from {} when offline, configure a mirror"
+            " or prefetch the toolchain into the cache".format(upstream)
+        )
+    return upstream
+
+
+def mirror_sha256(url: str) -> typing.Optional[str]:
+    """Returns the sha256 stored next to a mirrored artifact or None"""
+    import urllib.request
+
+    try:
+        with urllib.request.urlopen(url + SHA256_SUFFIX, timeout=30) as r:
+            return str(r.read().decode("ascii").split()[0]).lower()
+    except (OSError, ValueError, IndexError):
+        return None
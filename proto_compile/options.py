@@ -1,9 +1,12 @@
+import logging
 import typing
 
 import proto_compile.versions as versions
 from proto_compile.utils import PathLike
 from proto_compile.versions import Target
 
+log = logging.getLogger(__name__)
+
 
 class BaseCompilerOptions:
     def __init__(
@@ -14,6 +17,27 @@ class BaseCompilerOptions:
         clear_output_dirs: bool = False,
         verbosity: typing.Optional[int] = None,
         protoc_version: typing.Optional[str] = None,
+        protoc_sha256: typing.Optional[str] = None,
+        use_cache: bool = True,
+        cache_dir: typing.Optional[PathLike] = None,
+        incremental: bool = False,
+        jobs: typing.Optional[int] = 1,
+        shards: int = 1,
+        embedded_protoc: bool = True,
+        daemon_socket: typing.Optional[PathLike] = None,
+        watch: bool = False,
+        include: typing.Optional[typing.List[str]] = None,
+        exclude: typing.Optional[typing.List[str]] = None,
+        gitignore: bool = True,
+        extra_source_dirs: typing.Optional[typing.List[PathLike]] = None,
+        include_dirs: typing.Optional[typing.List[PathLike]] = None,
+        descriptor_set: bool = False,
+        descriptor_set_out: typing.Optional[PathLike] = None,
+        profile: typing.Optional[PathLike] = None,
+        mirror: typing.Optional[PathLike] = None,
+        offline: bool = False,
+        remote_cache: typing.Optional[str] = None,
+        remote_cache_read_only: bool = False,
     ) -> None:
         self.proto_source_dir = proto_source_dir
         self.output_dir = output_dir
@@ -21,18 +45,63 @@ class BaseCompilerOptions:
         self.clear_output_dirs = clear_output_dirs
         self.verbosity = verbosity or 0
         self.protoc_version = protoc_version or versions.DEFAULT_PROTOC_VERSION
+        # expected sha256 of the protoc release archive
+        self.protoc_sha256 = protoc_sha256
+        self.use_cache = use_cache
+        self.cache_dir = cache_dir
+        self.incremental = incremental
+        # 1 runs a single protoc invocation for all targets, otherwise one
+        # invocation per target (and shard) runs on up to jobs workers,
+        # where 0 or None uses the cpu count
+        self.jobs = jobs
+        # number of protoc invocations the proto files are split into
+        self.shards = shards
+        # use the protoc bundled with grpc_tools if its version matches
+        self.embedded_protoc = embedded_protoc
+        # compilations are forwarded to a daemon listening on this socket
+        self.daemon_socket = daemon_socket
+        # recompile whenever a .proto file in proto_source_dir changes
+        self.watch = watch
+        # gitignore style globs that select the proto files in proto_source_dir
+        # (default *.proto) and exclude files and dirs in addition to the
+        # .gitignore files if gitignore is set
+        self.include = include
+        self.exclude = exclude
+        self.gitignore = gitignore
+        # further source roots, whose proto files are compiled as well
+        self.extra_source_dirs = extra_source_dirs or []
+        # include dirs that are only used to resolve imports (e.g. vendored
+        # googleapis), passed to protoc -I after the source roots
+        self.include_dirs = include_dirs or []
+        # parse the proto files once into a cached descriptor set that all
+        # targets read, descriptor_set_out also copies the set there
+        self.descriptor_set = descriptor_set
+        self.descriptor_set_out = descriptor_set_out
+        # log a timing summary and write the JSON report and the chrome
+        # trace into this dir
+        self.profile = profile
+        # dir or URL that protoc and the plugin releases are downloaded from
+        # instead of github, see mirrors.py
+        self.mirror = mirror
+        # only use the toolchain cache and the mirror
+        self.offline = offline
+        # dir or http(s) URL of a cache of generated outputs that is shared
+        # by many workers, see remote.py
+        self.remote_cache = remote_cache
+        # only fetch outputs from the remote cache but never upload them
+        self.remote_cache_read_only = remote_cache_read_only
 
 
 class CompileTarget:
     def __init__(
         self,
         language: Target,
-        # out_options: typing.Optional[str] = None,
-        # output_dir: typing.Optional[PathLike] = None,
-        # plugin_version: typing.Optional[str] = None,
+        out_options: typing.Optional[str] = None,
+        output_dir: typing.Optional[PathLike] = None,
+        plugin_version: typing.Optional[str] = None,
     ):
         if language == Target.IMPROBABLE_GRPC_WEB:
-            print("WARN: improbable-eng/grpc-web is in maintenance mode only")
+            log.warning("improbable-eng/grpc-web is in maintenance mode only")
         self.language = language
         self.out_options = out_options
         self.output_dir = output_dir
@@ -59,4 +128,32 @@ class CompilerOptions:
         self.protoc_version = (
             base_options.protoc_version or versions.DEFAULT_PROTOC_VERSION
         )
+        self.protoc_sha256 = base_options.protoc_sha256
+        self.use_cache = base_options.use_cache
+        self.cache_dir = base_options.cache_dir
+        self.incremental = base_options.incremental
+        self.jobs = base_options.jobs
+        self.shards = base_options.shards
+        self.embedded_protoc = base_options.embedded_protoc
+        self.daemon_socket = base_options.daemon_socket
+        self.watch = base_options.watch
+        self.include = base_options.include
+        self.exclude = base_options.exclude
+        self.gitignore = base_options.gitignore
+        self.extra_source_dirs = base_options.extra_source_dirs
+        self.include_dirs = base_options.include_dirs
+        self.descriptor_set = base_options.descriptor_set
+        self.descriptor_set_out = base_options.descriptor_set_out
+        self.profile = base_options.profile
+        self.mirror = base_options.mirror
+        self.offline = base_options.offline
+        self.remote_cache = base_options.remote_cache
+        self.remote_cache_read_only = base_options.remote_cache_read_only
         self.targets = targets
+
+
+def source_dirs(
+    options: typing.Union[BaseCompilerOptions, CompilerOptions]
+) -> typing.List[PathLike]:
+    """Returns all source roots, starting with proto_source_dir"""
+    return [options.proto_source_dir] + list(options.extra_source_dirs)
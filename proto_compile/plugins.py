@@ -1,37 +1,194 @@
 import abc
+import functools
+import json
+import logging
 import os
 import platform
 import subprocess
+import sys
+import tempfile
+import threading
+import time
 import typing
 import uuid
 from pathlib import Path
 
-import pkg_resources
-from grpc_tools.protoc import main as _compile_python_grpc
-
-from proto_compile.utils import PathLike, download_executable, print_command
+from proto_compile import mirrors as mirrors
+from proto_compile.cache import platform_key
+from proto_compile.process import (
+    STDOUT,
+    EventSink,
+    OutputEvent,
+    ProcessError,
+    default_sink,
+    run,
+)
+from proto_compile.utils import PathLike, download_executable, to_thread
 from proto_compile.versions import DEFAULT_PLUGIN_VERSIONS, Target
 
+log = logging.getLogger(__name__)
+
 PROTOC_RELEASE_BASE_URL = (
     "https://github.com/protocolbuffers/protobuf/releases/download"
 )
+PROTOC_RELEASE_API_URL = (
+    "https://api.github.com/repos/protocolbuffers/protobuf/releases/tags"
+)
+
+
+def protoc_release_url(
+    version: str,
+    base_url: str = PROTOC_RELEASE_BASE_URL,
+    system: typing.Optional[str] = None,
+    machine: typing.Optional[str] = None,
+) -> str:
+    """Returns the URL of the protoc release of a platform (default is this one)"""
+    system = system or platform.system().lower()  # darwin
+    system_alias = "osx" if system == "darwin" else system  # osx for darwin
+    system_alias = "win64" if system == "windows" else system_alias  # windows
+    machine_arch = "" if system == "windows" else machine or platform.machine()
+
+    protoc_release_url = base_url
+    protoc_release_url += "/v" + version
+    protoc_release_url += (
+        "/protoc-"
+        + version
+        + "-"
+        + system_alias
+        + ("" if system == "windows" else "-")
+        + machine_arch
+        + ".zip"
+    )
+    return protoc_release_url
+
+
+def protoc_release_sha256(
+    version: str, url: str, api_url: typing.Optional[str] = None
+) -> typing.Optional[str]:
+    """Looks up the sha256 digest github publishes for the protoc release asset.
+
+    Returns None if the digest is unknown or cannot be fetched.
+    """
+    import urllib.request
+
+    api_url = api_url or PROTOC_RELEASE_API_URL
+    try:
+        with urllib.request.urlopen("%s/v%s" % (api_url, version), timeout=30) as r:
+            release = json.load(r)
+    except (OSError, ValueError):
+        return None
+    asset_name = url.rsplit("/", 1)[-1]
+    for asset in release.get("assets", []):
+        digest = asset.get("digest") or ""
+        if asset.get("name") == asset_name and digest.startswith("sha256:"):
+            return str(digest[len("sha256:") :])
+    return None
+
+
+GRPC_WEB_PLUGIN_RELEASE_BASE_URL = "https://github.com/grpc/grpc-web/releases/download"
+
+
+def grpc_web_release_url(
+    version: str,
+    base_url: str = GRPC_WEB_PLUGIN_RELEASE_BASE_URL,
+    system: typing.Optional[str] = None,
+    machine: typing.Optional[str] = None,
+) -> str:
+    """Returns the URL of the protoc-gen-grpc-web release of a platform"""
+    system = system or platform.system().lower()
+    machine_arch = "x86_64" if system == "windows" else machine or platform.machine()
+    return (
+        base_url
+        + "/"
+        + version
+        + "/protoc-gen-grpc-web-"
+        + version
+        + "-"
+        + system
+        + "-"
+        + machine_arch
+        + (".exe" if system == "windows" else "")
+    )
 
 
 class ProtoCompiler:
     def compile(self, arguments: typing.List[str], verbosity: int = 0) -> None:
         raise NotImplementedError()
 
+    async def compile_async(
+        self, arguments: typing.List[str], verbosity: int = 0
+    ) -> None:
+        """Compiles on the running event loop, by default in a worker thread"""
+        await to_thread(self.compile, arguments, verbosity=verbosity)
+
 
 class ProtocPlugin(abc.ABC):
+    # whether installations can be reused across compilations
+    cacheable = False
+    default_version: typing.Optional[str] = None
+    # plugins installing the same package share their installation
+    package: typing.Optional[str] = None
+
     def __init__(
         self,
         dest_dir: PathLike,
         version: typing.Optional[str] = None,
         verbosity: int = 0,
+        cache_dir: typing.Optional[PathLike] = None,
+        mirror: typing.Optional[PathLike] = None,
+        offline: bool = False,
     ) -> None:
         self.dest_dir: Path = Path(dest_dir)
         self.version = version
         self.verbosity = verbosity
+        # shared directory for package manager caches (e.g. GOCACHE)
+        self.cache_dir = Path(cache_dir) if cache_dir is not None else None
+        # release downloads are resolved from the mirror, see mirrors.py
+        self.mirror = mirror
+        # package managers only install from their caches
+        self.offline = offline
+
+    def resolved_version(self) -> str:
+        return self.version or self.default_version or "latest"
+
+    def cache_key(self) -> typing.List[str]:
+        name = self.package or type(self).__name__
+        return [name, self.resolved_version()] + platform_key()
+
+    def relocated(self, dest_dir: PathLike) -> "ProtocPlugin":
+        """Returns the same plugin installed into dest_dir"""
+        return type(self)(
+            dest_dir,
+            version=self.version,
+            verbosity=self.verbosity,
+            cache_dir=self.cache_dir,
+            mirror=self.mirror,
+            offline=self.offline,
+        )
+
+    def latest_version(self) -> typing.Optional[str]:
+        """Resolves "latest" to a concrete version or None if it cannot be resolved"""
+        return None
+
+    def pinned(self) -> typing.Optional["ProtocPlugin"]:
+        """Returns the plugin with a concrete version instead of "latest".
+
+        Returns None if the latest version cannot be resolved.
+        """
+        version: typing.Optional[str] = self.resolved_version()
+        if version == "latest":
+            # the latest version cannot be looked up offline
+            version = None if self.offline else self.latest_version()
+            if version is None:
+                return None
+        return type(self)(
+            self.dest_dir,
+            version=version,
+            verbosity=self.verbosity,
+            cache_dir=self.cache_dir,
+            mirror=self.mirror,
+            offline=self.offline,
+        )
 
     def install(self) -> None:
         pass
@@ -82,21 +239,74 @@ class MyPyPlugin(ProtocPlugin):
         )
 
 
-class PythonGrpcProtoCompiler(ProtoCompiler):
+# grpc_tools runs protoc in-process, which is not safe to call concurrently
+_python_grpc_lock = threading.Lock()
+
+
+def _run_grpc_tools_protoc(arguments: typing.List[str]) -> int:
+    # grpc_tools loads a large C extension, so it is only imported when needed
+    from grpc_tools.protoc import main
+
+    return int(main(arguments))
+
+
+def grpc_tools_include_dir() -> str:
+    """Returns the dir of the well known protos bundled with grpc_tools"""
+    if sys.version_info >= (3, 9):
+        from importlib import resources
+
+        return str(resources.files("grpc_tools") / "_proto")
+    import grpc_tools  # pragma: no cover
+
+    return os.path.join(os.path.dirname(grpc_tools.__file__), "_proto")
+
+
+# grpc_tools only bundles the python code generators of protoc
+EMBEDDED_TARGETS = {Target.PYTHON, Target.PYTHON_GRPC}
+
+
+@functools.lru_cache(maxsize=None)
+def embedded_protoc_version() -> typing.Optional[str]:
+    """Returns the version of the protoc bundled with grpc_tools, e.g. 27.2"""
+    # protoc writes the version to the stdout file descriptor
+    with tempfile.TemporaryFile() as output, _python_grpc_lock:
+        sys.stdout.flush()
+        stdout = os.dup(1)
+        try:
+            os.dup2(output.fileno(), 1)
+            return_code = _run_grpc_tools_protoc(["", "--version"])
+        finally:
+            os.dup2(stdout, 1)
+            os.close(stdout)
+        output.seek(0)
+        version = output.read().decode(errors="replace").split()
+    if return_code != 0 or not version:
+        return None
+    return version[-1]
+
+
+class EmbeddedProtoCompiler(ProtoCompiler):
+    """Runs the protoc bundled with grpc_tools in-process"""
+
     def compile(self, arguments: typing.List[str], verbosity: int = 0) -> None:
-        proto_include = pkg_resources.resource_filename("grpc_tools", "_proto")
+        proto_include = grpc_tools_include_dir()
         arguments = [""] + arguments + ["-I{}".format(proto_include)]
         command = "python -m grpc_tools.protoc {}".format(
             " ".join([str(arg) for arg in arguments[1:]])
         )
 
         if verbosity > 0:
-            print(command)
-        return_code = int(_compile_python_grpc(arguments))
+            log.info("%s", command)
+        with _python_grpc_lock:
+            return_code = _run_grpc_tools_protoc(arguments)
         if return_code != 0:
             raise subprocess.CalledProcessError(cmd=command, returncode=return_code)
 
 
+class PythonGrpcProtoCompiler(EmbeddedProtoCompiler):
+    pass
+
+
 class PythonGrpcPlugin(ProtocPlugin):
     def executable(self) -> typing.Optional[PathLike]:
         return "grpc_node_plugin"
@@ -121,80 +331,138 @@ class TypescriptPlugin(ProtocPlugin):
         )
 
 
+def _go_env(plugin: ProtocPlugin) -> typing.Dict[str, str]:
+    if plugin.cache_dir is not None:
+        # the go build and module caches are safe for concurrent use
+        go_cache = plugin.cache_dir / "go-build"
+        go_mod_cache = plugin.cache_dir / "go-mod"
+    else:
+        go_cache = plugin.dest_dir / ("cache-%s" % uuid.uuid4())
+        go_mod_cache = plugin.dest_dir / "pkg" / "mod"
+    return {
+        **os.environ,
+        **{
+            "GOPATH": str(plugin.dest_dir.absolute()),
+            "GOBIN": str((plugin.dest_dir / "bin").absolute()),
+            "GOCACHE": str(go_cache.absolute()),
+            "GOMODCACHE": str(go_mod_cache.absolute()),
+            # only the module cache is used offline
+            **({"GOPROXY": "off"} if plugin.offline else {}),
+        },
+    }
+
+
+# seconds a resolved latest version is reused within the same process
+LATEST_VERSION_TTL = 300
+_latest_versions: typing.Dict[typing.Tuple[str, ...], typing.Tuple[float, str]] = (
+    dict()
+)
+
+
+def _query_version(
+    command: typing.List[str], env: typing.Optional[typing.Dict[str, str]] = None
+) -> typing.Optional[str]:
+    known = _latest_versions.get(tuple(command))
+    if known is not None and time.time() - known[0] < LATEST_VERSION_TTL:
+        return known[1]
+    stdout: typing.List[str] = []
+
+    def collect(event: OutputEvent) -> None:
+        # warnings are written to stderr
+        if event.stream == STDOUT:
+            stdout.append(event.line)
+
+    try:
+        run(command, env=env, sink=EventSink(collect))
+    except (OSError, ProcessError):
+        return None
+    version = "\n".join(stdout).strip()
+    if not version:
+        return None
+    _latest_versions[tuple(command)] = (time.time(), version)
+    return version
+
+
+def _go_latest_version(plugin: ProtocPlugin, module: str) -> typing.Optional[str]:
+    return _query_version(
+        ["go", "list", "-m", "-f", "{{.Version}}", "%s@latest" % module],
+        env=_go_env(plugin),
+    )
+
+
+def _npm_latest_version(plugin: ProtocPlugin, package: str) -> typing.Optional[str]:
+    return _query_version(["npm", "view", package, "version"] + _npm_cache_args(plugin))
+
+
+def _npm_cache_args(plugin: ProtocPlugin) -> typing.List[str]:
+    args = ["--offline"] if plugin.offline else []
+    if plugin.cache_dir is None:
+        return args
+    return args + ["--cache", str((plugin.cache_dir / "npm").absolute())]
+
+
 class GolangPlugin(ProtocPlugin):
+    cacheable = True
+    default_version = DEFAULT_PLUGIN_VERSIONS[Target.GO]
+
     def executable(self) -> typing.Optional[PathLike]:
         return self.dest_dir / "bin" / "protoc-gen-go"
 
     def install_hint(self) -> typing.Optional[str]:
         return "install golang"
 
+    def latest_version(self) -> typing.Optional[str]:
+        return _go_latest_version(self, "google.golang.org/protobuf")
+
     def install(self) -> None:
-        plugin_version = self.version or DEFAULT_PLUGIN_VERSIONS[Target.GO]
-        install_command = str(" ").join(
-            [
-                "go",
-                "install",
-                "google.golang.org/protobuf/cmd/protoc-gen-go@%s" % plugin_version,
-            ]
-        )
+        plugin_version = self.resolved_version()
+        install_command = [
+            "go",
+            "install",
+            "google.golang.org/protobuf/cmd/protoc-gen-go@%s" % plugin_version,
+        ]
         if self.verbosity > 0:
-            print(install_command)
-        print_command(
+            log.info("%s", " ".join(install_command))
+        run(
             install_command,
-            stderr=subprocess.STDOUT,
-            shell=True,
-            env={
-                **os.environ,
-                **{
-                    "GOPATH": str(self.dest_dir.absolute()),
-                    "GOCACHE": str(
-                        (self.dest_dir / ("cache-%s" % uuid.uuid4())).absolute()
-                    ),
-                },
-            },
+            env=_go_env(self),
             cwd=self.dest_dir,
-            verbosity=self.verbosity,
+            sink=default_sink(self.verbosity),
         )
 
 
 class GolangGrpcPlugin(ProtocPlugin):
+    cacheable = True
+    default_version = DEFAULT_PLUGIN_VERSIONS[Target.GO_GRPC]
+
     def executable(self) -> typing.Optional[PathLike]:
         return self.dest_dir / "bin" / "protoc-gen-go-grpc"
 
     def install_hint(self) -> typing.Optional[str]:
         return "install golang"
 
+    def latest_version(self) -> typing.Optional[str]:
+        return _go_latest_version(self, "google.golang.org/grpc/cmd/protoc-gen-go-grpc")
+
     def install(self) -> None:
-        plugin_version = self.version or DEFAULT_PLUGIN_VERSIONS[Target.GO_GRPC]
+        plugin_version = self.resolved_version()
         for pkg in [
             "google.golang.org/protobuf/cmd/protoc-gen-go@%s"
             % DEFAULT_PLUGIN_VERSIONS[Target.GO_GRPC],
             "google.golang.org/grpc/cmd/protoc-gen-go-grpc@%s" % plugin_version,
         ]:
-            install_command = str(" ").join(
-                [
-                    "go",
-                    "install",
-                    pkg,
-                ]
-            )
+            install_command = [
+                "go",
+                "install",
+                pkg,
+            ]
             if self.verbosity > 0:
-                print(install_command)
-            print_command(
+                log.info("%s", " ".join(install_command))
+            run(
                 install_command,
-                stderr=subprocess.STDOUT,
-                shell=True,
-                env={
-                    **os.environ,
-                    **{
-                        "GOPATH": str(self.dest_dir.absolute()),
-                        "GOCACHE": str(
-                            (self.dest_dir / ("cache-%s" % uuid.uuid4())).absolute()
-                        ),
-                    },
-                },
+                env=_go_env(self),
                 cwd=self.dest_dir,
-                verbosity=self.verbosity,
+                sink=default_sink(self.verbosity),
             )
 
 
@@ -215,6 +483,9 @@ class PHPGrpcPlugin(ProtocPlugin):
 
 
 class JavascriptGrpcPlugin(ProtocPlugin):
+    cacheable = True
+    package = "npm-grpc-tools"
+
     def executable(self) -> typing.Optional[PathLike]:
         return (
             self.dest_dir / "node_modules" / "grpc-tools" / "bin" / "grpc_node_plugin"
@@ -231,25 +502,30 @@ class JavascriptGrpcPlugin(ProtocPlugin):
             self.executable
         )
 
+    def latest_version(self) -> typing.Optional[str]:
+        return _npm_latest_version(self, "grpc-tools")
+
     def install(self) -> None:
-        install_command = str(" ").join(
+        install_command = (
             [
                 "npm",
                 "install",
-                "grpc-tools",
+                "grpc-tools@%s" % self.resolved_version(),
             ]
+            + _npm_cache_args(self)
         )
         if self.verbosity > 0:
-            print(install_command)
-        print_command(
+            log.info("%s", " ".join(install_command))
+        run(
             install_command,
-            stderr=subprocess.STDOUT,
-            shell=True,
             cwd=self.dest_dir,
-            verbosity=self.verbosity,
+            sink=default_sink(self.verbosity),
         )
 
 class NodeGrpcPlugin(ProtocPlugin):
+    cacheable = True
+    package = "npm-grpc-tools"
+
     def executable(self) -> typing.Optional[PathLike]:
         return (
             self.dest_dir / "node_modules" / "grpc-tools" / "bin" / "grpc_tools_node_protoc"
@@ -266,53 +542,46 @@ class NodeGrpcPlugin(ProtocPlugin):
             self.executable
         )
 
+    def latest_version(self) -> typing.Optional[str]:
+        return _npm_latest_version(self, "grpc-tools")
+
     def install(self) -> None:
-        install_command = str(" ").join(
+        install_command = (
             [
                 "npm",
                 "install",
-                "grpc-tools",
+                "grpc-tools@%s" % self.resolved_version(),
             ]
+            + _npm_cache_args(self)
         )
         if self.verbosity > 0:
-            print(install_command)
-        print_command(
+            log.info("%s", " ".join(install_command))
+        run(
             install_command,
-            stderr=subprocess.STDOUT,
-            shell=True,
             cwd=self.dest_dir,
-            verbosity=self.verbosity,
+            sink=default_sink(self.verbosity),
         )
 
 
 
 class GrpcWebPlugin(ProtocPlugin):
-    GRPC_WEB_PLUGIN_RELEASE_BASE_URL = (
-        "https://github.com/grpc/grpc-web/releases/download"
-    )
+    cacheable = True
+    default_version = DEFAULT_PLUGIN_VERSIONS[Target.GRPC_WEB]
+
+    GRPC_WEB_PLUGIN_RELEASE_BASE_URL = GRPC_WEB_PLUGIN_RELEASE_BASE_URL
 
     def executable(self) -> PathLike:
         return self.dest_dir / "protoc-gen-grpc-web"
 
     def install(self) -> None:
-        system = platform.system().lower()  # darwin
-        system_alias = "osx" if system == "darwin" else system  # osx for darwin
-        system_alias = "win64" if system == "windows" else system_alias  # windows
-        machine_arch = "x86_64" if system == "windows" else platform.machine()
-
-        grpc_web_plugin_version = (
-            self.version or DEFAULT_PLUGIN_VERSIONS[Target.GRPC_WEB]
-        )
-        grpc_web_plugin_release_url = GrpcWebPlugin.GRPC_WEB_PLUGIN_RELEASE_BASE_URL
-        grpc_web_plugin_release_url += "/" + grpc_web_plugin_version
-        grpc_web_plugin_release_url += (
-            "/protoc-gen-grpc-web-"
-            + grpc_web_plugin_version
-            + "-"
-            + system
-            + "-"
-            + machine_arch
-            + (".exe" if system == "windows" else "")
+        grpc_web_plugin_release_url = grpc_web_release_url(
+            self.resolved_version(),
+            base_url=mirrors.base_url(
+                GrpcWebPlugin.GRPC_WEB_PLUGIN_RELEASE_BASE_URL,
+                mirrors.GRPC_WEB_DIR,
+                mirror=self.mirror,
+                offline=self.offline,
+            ),
         )
         download_executable(
             # self.executable(),
@@ -324,6 +593,9 @@ class GrpcWebPlugin(ProtocPlugin):
 
 
 class ImprobableGrpcWebPlugin(ProtocPlugin):
+    cacheable = True
+    default_version = DEFAULT_PLUGIN_VERSIONS[Target.IMPROBABLE_GRPC_WEB]
+
     def executable(self) -> typing.Optional[PathLike]:
         return (
             self.dest_dir / "node_modules" / "ts-protoc-gen" / "bin" / "protoc-gen-ts"
@@ -332,22 +604,24 @@ class ImprobableGrpcWebPlugin(ProtocPlugin):
     def install_hint(self) -> typing.Optional[str]:
         return "install npm"
 
+    def latest_version(self) -> typing.Optional[str]:
+        return _npm_latest_version(self, "ts-protoc-gen")
+
     def install(self) -> None:
-        install_command = str(" ").join(
+        install_command = (
             [
                 "npm",
                 "install",
-                "ts-protoc-gen",
+                "ts-protoc-gen@%s" % self.resolved_version(),
             ]
+            + _npm_cache_args(self)
         )
         if self.verbosity > 0:
-            print(install_command)
-        print_command(
+            log.info("%s", " ".join(install_command))
+        run(
             install_command,
-            stderr=subprocess.STDOUT,
-            shell=True,
             cwd=self.dest_dir,
-            verbosity=self.verbosity,
+            sink=default_sink(self.verbosity),
         )
 
 
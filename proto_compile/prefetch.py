@@ -0,0 +1,175 @@
+"""Fills a mirror dir with the toolchain releases of many versions and platforms.
+
+The releases are downloaded concurrently from github or from another mirror
+into the layout that mirrors.py reads. The sha256 of every artifact is stored
+next to it, so that offline installs from the mirror can be verified.
+"""
+
+import concurrent.futures
+import functools
+import logging
+import os
+import platform
+import typing
+from pathlib import Path
+
+from proto_compile import mirrors as mirrors
+from proto_compile import plugins as plugins
+from proto_compile.utils import (
+    DownloadError,
+    PathLike,
+    download,
+    file_sha256,
+    verify_sha256,
+)
+
+log = logging.getLogger(__name__)
+
+
+class Platform(typing.NamedTuple):
+    # as returned by platform.system().lower(), e.g. linux, darwin or windows
+    system: str
+    # as returned by platform.machine(), e.g. x86_64 or arm64
+    machine: str
+
+    def __str__(self) -> str:
+        return "{}-{}".format(self.system, self.machine)
+
+
+def current_platform() -> Platform:
+    return Platform(platform.system().lower(), platform.machine())
+
+
+def parse_platform(value: str) -> Platform:
+    """Parses <system>-<machine>, e.g. linux-x86_64 or darwin-arm64"""
+    system, sep, machine = value.partition("-")
+    if not sep or not system or not machine:
+        raise ValueError(
+            "invalid platform {}, expected <system>-<machine>".format(value)
+        )
+    return Platform(system.lower(), machine)
+
+
+class Artifact(typing.NamedTuple):
+    # path below the mirror dir
+    path: str
+    url: str
+    # looks up the expected sha256 of the url, None if it is unknown
+    lookup_sha256: typing.Callable[[str], typing.Optional[str]]
+
+
+def _no_sha256(url: str) -> typing.Optional[str]:
+    return None
+
+
+def artifacts(
+    protoc_versions: typing.List[str],
+    grpc_web_versions: typing.List[str],
+    platforms: typing.List[Platform],
+    source: typing.Optional[PathLike] = None,
+) -> typing.List[Artifact]:
+    """Lists the releases to prefetch from source (default is github)"""
+    protoc_base_url = mirrors.base_url(
+        plugins.PROTOC_RELEASE_BASE_URL, mirrors.PROTOC_DIR, mirror=source
+    )
+    grpc_web_base_url = mirrors.base_url(
+        plugins.GRPC_WEB_PLUGIN_RELEASE_BASE_URL, mirrors.GRPC_WEB_DIR, mirror=source
+    )
+    listed = []
+    for p in platforms:
+        for version in protoc_versions:
+            url = plugins.protoc_release_url(
+                version, base_url=protoc_base_url, system=p.system, machine=p.machine
+            )
+            listed.append(
+                Artifact(
+                    mirrors.PROTOC_DIR + url[len(protoc_base_url) :],
+                    url,
+                    (
+                        mirrors.mirror_sha256
+                        if source is not None
+                        else functools.partial(plugins.protoc_release_sha256, version)
+                    ),
+                )
+            )
+        for version in grpc_web_versions:
+            url = plugins.grpc_web_release_url(
+                version, base_url=grpc_web_base_url, system=p.system, machine=p.machine
+            )
+            listed.append(
+                Artifact(
+                    mirrors.GRPC_WEB_DIR + url[len(grpc_web_base_url) :],
+                    url,
+                    # github publishes no digests of the grpc-web releases
+                    mirrors.mirror_sha256 if source is not None else _no_sha256,
+                )
+            )
+    return listed
+
+
+def fetch(artifact: Artifact, mirror_dir: Path, verbosity: int = 0) -> bool:
+    """Downloads an artifact into the mirror, returns False if it was mirrored"""
+    dest = mirror_dir / artifact.path
+    digest = dest.parent / (dest.name + mirrors.SHA256_SUFFIX)
+    if dest.is_file() and digest.is_file():
+        return False
+    if verbosity > 0:
+        log.info("downloading %s", artifact.url)
+    tmp = dest.parent / (dest.name + ".tmp")
+    try:
+        download(artifact.url, tmp, verbosity=verbosity)
+        expected = artifact.lookup_sha256(artifact.url)
+        if expected is not None:
+            verify_sha256(tmp, expected)
+        elif verbosity > 0:
+            log.warning("no sha256 is known for %s", artifact.url)
+        digest.write_text(file_sha256(tmp) + "\n")
+        os.replace(tmp, dest)
+    finally:
+        if tmp.exists():
+            os.remove(tmp)
+    return True
+
+
+def prefetch(
+    mirror_dir: PathLike,
+    protoc_versions: typing.List[str],
+    grpc_web_versions: typing.List[str],
+    platforms: typing.Optional[typing.List[Platform]] = None,
+    source: typing.Optional[PathLike] = None,
+    jobs: typing.Optional[int] = None,
+    verbosity: int = 0,
+) -> typing.List[Path]:
+    """Downloads the releases into mirror_dir and returns the new artifacts.
+
+    Artifacts that are already mirrored are skipped. All downloads run on a
+    pool of jobs workers (None uses the cpu count), failures are collected
+    and raised together as a DownloadError.
+    """
+    mirror_dir = Path(mirror_dir)
+    listed = artifacts(
+        protoc_versions,
+        grpc_web_versions,
+        platforms or [current_platform()],
+        source=source,
+    )
+    fetched: typing.List[Path] = []
+    failures: typing.List[str] = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs or None) as pool:
+        futures = [
+            pool.submit(fetch, artifact, mirror_dir, verbosity=verbosity)
+            for artifact in listed
+        ]
+        for artifact, future in zip(listed, futures):
+            try:
+                if future.result():
+                    fetched.append(mirror_dir / artifact.path)
+            except Exception as e:
+                failures.append("  {}: {}".format(artifact.url, e))
+    if failures:
+        raise DownloadError(
+            "{} artifact(s) failed to prefetch:\n{}".format(
+                len(failures), "\n".join(failures)
+            )
+        )
+    return fetched
@@ -0,0 +1,276 @@
+"""Runs subprocesses and streams their output line by line into sinks."""
+
+import collections
+import os
+import queue
+import signal
+import subprocess
+import sys
+import threading
+import time
+import typing
+
+from proto_compile.utils import PathLike
+
+if typing.TYPE_CHECKING:  # pragma: no cover
+    import asyncio
+
+STDOUT = "stdout"
+STDERR = "stderr"
+
+
+class OutputEvent(typing.NamedTuple):
+    time: float
+    pid: int
+    stream: str
+    line: str
+
+
+SinkT = typing.TypeVar("SinkT", bound="Sink")
+
+
+class Sink:
+    """Receives the output of a process line by line.
+
+    Sinks are owned by their creator, who closes them (e.g. with a with
+    block), run() and run_async() never do.
+    """
+
+    def write(self, event: OutputEvent) -> None:
+        raise NotImplementedError()
+
+    def close(self) -> None:
+        pass
+
+    def __enter__(self: SinkT) -> SinkT:
+        return self
+
+    def __exit__(self, *exc_info: typing.Any) -> None:
+        self.close()
+
+
+class NullSink(Sink):
+    def write(self, event: OutputEvent) -> None:
+        pass
+
+
+class ConsoleSink(Sink):
+    def __init__(self, prefix: str = "") -> None:
+        self.prefix = prefix
+
+    def write(self, event: OutputEvent) -> None:
+        stream = sys.stderr if event.stream == STDERR else sys.stdout
+        print(self.prefix + event.line, file=stream, flush=True)
+
+
+class FileSink(Sink):
+    """Appends the output to a log file"""
+
+    def __init__(self, path: PathLike) -> None:
+        self.file = open(path, "a", encoding="utf-8")
+
+    def write(self, event: OutputEvent) -> None:
+        self.file.write("[{}] {}\n".format(event.stream, event.line))
+
+    def close(self) -> None:
+        self.file.close()
+
+
+class EventSink(Sink):
+    """Passes every line to a callback as an OutputEvent"""
+
+    def __init__(self, callback: typing.Callable[[OutputEvent], None]) -> None:
+        self.callback = callback
+
+    def write(self, event: OutputEvent) -> None:
+        self.callback(event)
+
+
+def default_sink(verbosity: int) -> Sink:
+    """Streams the output to the console if verbosity > 1"""
+    return ConsoleSink() if verbosity > 1 else NullSink()
+
+
+class ProcessError(subprocess.CalledProcessError):
+    """Raised for a non-zero exit code, output is the tail of the process output"""
+
+    def __str__(self) -> str:
+        message = super().__str__()
+        if self.output:
+            message += "\n" + str(self.output).rstrip()
+        return message
+
+
+class ProcessCancelledError(Exception):
+    def __init__(self, cmd: typing.Any, output: str) -> None:
+        super().__init__("{} was cancelled".format(cmd))
+        self.cmd = cmd
+        self.output = output
+
+
+def _read_lines(
+    pipe: typing.IO[bytes], stream: str, lines: "queue.Queue[typing.Any]"
+) -> None:
+    try:
+        for raw in iter(pipe.readline, b""):
+            lines.put((stream, raw.decode("utf-8", errors="replace").rstrip("\r\n")))
+    finally:
+        pipe.close()
+        lines.put((stream, None))
+
+
+def _kill(
+    process: typing.Union["subprocess.Popen[bytes]", "asyncio.subprocess.Process"]
+) -> None:
+    try:
+        if os.name == "posix":
+            # also kill the children, e.g. of a shell
+            os.killpg(process.pid, signal.SIGKILL)
+        else:  # pragma: no cover
+            process.kill()
+    except OSError:  # pragma: no cover
+        pass
+
+
+def run(
+    cmd: typing.Union[str, typing.Sequence[PathLike]],
+    sink: typing.Optional[Sink] = None,
+    cwd: typing.Optional[PathLike] = None,
+    env: typing.Optional[typing.Mapping[str, str]] = None,
+    shell: bool = False,
+    timeout: typing.Optional[float] = None,
+    cancel: typing.Optional[threading.Event] = None,
+    tail: int = 200,
+    buffer: int = 1024,
+) -> str:
+    """Runs cmd and streams its stdout and stderr line by line into sink.
+
+    At most buffer lines are held in memory, a slow sink blocks the process
+    instead. Only the last tail lines are kept and returned, they are also
+    the output of the ProcessError raised for a non-zero exit code. The
+    process is killed when it runs longer than timeout seconds
+    (subprocess.TimeoutExpired) or when cancel is set (ProcessCancelledError).
+    The sink is left open, so it can be shared by many runs.
+    """
+    sink = sink or NullSink()
+    lines: "queue.Queue[typing.Any]" = queue.Queue(maxsize=buffer)
+    captured: typing.Deque[str] = collections.deque(maxlen=tail)
+    deadline = time.monotonic() + timeout if timeout is not None else None
+    process = subprocess.Popen(
+        cmd,
+        cwd=cwd,
+        env=env,
+        shell=shell,
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        start_new_session=os.name == "posix",
+    )
+    assert process.stdout is not None and process.stderr is not None
+    readers = [
+        threading.Thread(target=_read_lines, args=(pipe, stream, lines), daemon=True)
+        for pipe, stream in [(process.stdout, STDOUT), (process.stderr, STDERR)]
+    ]
+    for reader in readers:
+        reader.start()
+
+    open_streams = len(readers)
+    try:
+        while open_streams > 0:
+            if cancel is not None and cancel.is_set():
+                _kill(process)
+                raise ProcessCancelledError(cmd, "\n".join(captured))
+            if deadline is not None and time.monotonic() > deadline:
+                _kill(process)
+                raise subprocess.TimeoutExpired(
+                    cmd, typing.cast(float, timeout), output="\n".join(captured)
+                )
+            try:
+                stream, line = lines.get(timeout=0.05)
+            except queue.Empty:
+                continue
+            if line is None:
+                open_streams -= 1
+                continue
+            captured.append(line)
+            sink.write(OutputEvent(time.time(), process.pid, stream, line))
+        returncode = process.wait(
+            timeout=max(deadline - time.monotonic(), 0) if deadline else None
+        )
+    except BaseException:
+        _kill(process)
+        # unblock the readers so that they can finish
+        while any(reader.is_alive() for reader in readers):
+            try:
+                lines.get(timeout=0.05)
+            except queue.Empty:
+                pass
+        process.wait()
+        raise
+
+    output = "\n".join(captured)
+    if returncode != 0:
+        raise ProcessError(returncode, cmd, output=output)
+    return output
+
+
+async def run_async(
+    cmd: typing.Sequence[PathLike],
+    sink: typing.Optional[Sink] = None,
+    cwd: typing.Optional[PathLike] = None,
+    env: typing.Optional[typing.Mapping[str, str]] = None,
+    timeout: typing.Optional[float] = None,
+    tail: int = 200,
+) -> str:
+    """Runs cmd like run(), but as a subprocess of the running event loop.
+
+    Cancelling the calling task kills the process, which is awaited before
+    the cancellation is raised.
+    """
+    import asyncio
+
+    sink = sink or NullSink()
+    captured: typing.Deque[str] = collections.deque(maxlen=tail)
+    process = await asyncio.create_subprocess_exec(
+        *[str(arg) for arg in cmd],
+        cwd=cwd,
+        env=env,
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        start_new_session=os.name == "posix",
+    )
+    assert process.stdout is not None and process.stderr is not None
+
+    async def read_lines(pipe: asyncio.StreamReader, stream: str) -> None:
+        async for raw in pipe:
+            line = raw.decode("utf-8", errors="replace").rstrip("\r\n")
+            captured.append(line)
+            sink.write(OutputEvent(time.time(), process.pid, stream, line))
+
+    try:
+        returncode = (
+            await asyncio.wait_for(
+                asyncio.gather(
+                    read_lines(process.stdout, STDOUT),
+                    read_lines(process.stderr, STDERR),
+                    process.wait(),
+                ),
+                timeout,
+            )
+        )[2]
+    except asyncio.TimeoutError:
+        _kill(process)
+        await process.wait()
+        raise subprocess.TimeoutExpired(
+            cmd, typing.cast(float, timeout), output="\n".join(captured)
+        )
+    except BaseException:
+        _kill(process)
+        await process.wait()
+        raise
+
+    output = "\n".join(captured)
+    if returncode != 0:
+        raise ProcessError(returncode, cmd, output=output)
+    return output
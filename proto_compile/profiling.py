@@ -0,0 +1,184 @@
+"""Records timed spans of a compilation and reports where the time went.
+
+Spans are recorded while a Profiler is active (see profiled()). The report is
+logged as a summary and written as JSON and in the Chrome trace event format,
+which chrome://tracing and https://ui.perfetto.dev can open.
+"""
+
+import contextlib
+import contextvars
+import json
+import logging
+import os
+import threading
+import time
+import typing
+from pathlib import Path
+
+REPORT_FILE = "proto-compile-profile.json"
+TRACE_FILE = "proto-compile-trace.json"
+
+log = logging.getLogger(__name__)
+
+
+class Span(typing.NamedTuple):
+    name: str
+    category: str
+    # seconds since the profiler started
+    start: float
+    duration: float
+    thread: int
+    args: typing.Dict[str, typing.Any]
+
+
+class Profiler:
+    def __init__(self) -> None:
+        self.started = time.perf_counter()
+        self.spans: typing.List[Span] = []
+        self.lock = threading.Lock()
+
+    def record(
+        self,
+        name: str,
+        category: str,
+        start: float,
+        end: float,
+        args: typing.Dict[str, typing.Any],
+    ) -> None:
+        span = Span(
+            name,
+            category,
+            start - self.started,
+            end - start,
+            threading.get_ident(),
+            args,
+        )
+        with self.lock:
+            self.spans.append(span)
+
+    def totals(self) -> typing.List[typing.Dict[str, typing.Any]]:
+        """Returns the count, total and max duration of the spans of each name"""
+        totals: typing.Dict[typing.Tuple[str, str], typing.Dict[str, typing.Any]] = (
+            dict()
+        )
+        for span in self.spans:
+            total = totals.setdefault(
+                (span.category, span.name),
+                dict(name=span.name, category=span.category, count=0, total=0.0),
+            )
+            total["count"] += 1
+            total["total"] += span.duration
+            total["max"] = max(total.get("max", 0.0), span.duration)
+        return sorted(totals.values(), key=lambda t: -t["total"])
+
+    def summary(self) -> str:
+        lines = ["{:<40} {:>6} {:>10} {:>10}".format("span", "count", "total", "max")]
+        for total in self.totals():
+            lines.append(
+                "{:<40} {:>6} {:>9.3f}s {:>9.3f}s".format(
+                    total["name"][:40], total["count"], total["total"], total["max"]
+                )
+            )
+        lines.append(
+            "{:<40} {:>6} {:>9.3f}s".format(
+                "wall time", "", time.perf_counter() - self.started
+            )
+        )
+        return "\n".join(lines)
+
+    def report(self) -> typing.Dict[str, typing.Any]:
+        return dict(
+            wall_time=time.perf_counter() - self.started,
+            totals=self.totals(),
+            spans=[span._asdict() for span in self.spans],
+        )
+
+    def chrome_trace(self) -> typing.Dict[str, typing.Any]:
+        """Returns the spans as complete events of the trace event format"""
+        threads: typing.Dict[int, int] = dict()
+        events = []
+        for span in sorted(self.spans, key=lambda s: s.start):
+            events.append(
+                dict(
+                    name=span.name,
+                    cat=span.category,
+                    ph="X",
+                    ts=round(span.start * 1e6),
+                    dur=round(span.duration * 1e6),
+                    pid=os.getpid(),
+                    tid=threads.setdefault(span.thread, len(threads)),
+                    args=span.args,
+                )
+            )
+        return dict(traceEvents=events, displayTimeUnit="ms")
+
+    def write(
+        self, out_dir: "typing.Union[str, os.PathLike[typing.Any]]"
+    ) -> typing.List[Path]:
+        """Writes the JSON report and the trace into out_dir"""
+        out_dir = Path(out_dir)
+        out_dir.mkdir(parents=True, exist_ok=True)
+        paths = [out_dir / REPORT_FILE, out_dir / TRACE_FILE]
+        for path, content in zip(paths, [self.report(), self.chrome_trace()]):
+            with open(path, "w") as f:
+                json.dump(content, f, indent=2, default=str)
+        return paths
+
+
+# spans are recorded into every profiler of the current context, see
+# utils.submit() for threads
+_active: "contextvars.ContextVar[typing.Tuple[Profiler, ...]]" = (
+    contextvars.ContextVar("profilers", default=())
+)
+# whether the current context is profiled already
+_profiled: "contextvars.ContextVar[bool]" = contextvars.ContextVar(
+    "profiled", default=False
+)
+
+
+@contextlib.contextmanager
+def span(
+    name: str, category: str = "compile", **args: typing.Any
+) -> typing.Iterator[None]:
+    """Records the duration of the block if a profiler is active"""
+    profilers = _active.get()
+    if not profilers:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        end = time.perf_counter()
+        for profiler in profilers:
+            profiler.record(name, category, start, end, args)
+
+
+@contextlib.contextmanager
+def recorded(profiler: Profiler) -> typing.Iterator[Profiler]:
+    """Records the spans of the block into profiler"""
+    token = _active.set(_active.get() + (profiler,))
+    try:
+        yield profiler
+    finally:
+        _active.reset(token)
+
+
+@contextlib.contextmanager
+def profiled(
+    out_dir: "typing.Optional[typing.Union[str, os.PathLike[typing.Any]]]",
+) -> typing.Iterator[None]:
+    """Profiles the block and reports into out_dir, a no-op for None"""
+    if out_dir is None or _profiled.get():
+        yield
+        return
+    profiler = Profiler()
+    token = _profiled.set(True)
+    try:
+        with recorded(profiler):
+            yield
+    finally:
+        _profiled.reset(token)
+        log.info("%s", profiler.summary())
+        for path in profiler.write(out_dir):
+            log.info("wrote %s", path)
@@ -2,167 +2,991 @@
 
 """Main module."""
 
+import concurrent.futures
+import contextlib
+import copy
+import logging
 import os
-import platform
 import shutil
 import subprocess
 import tempfile
+import time
 import typing
 from pathlib import Path
 
+from proto_compile import daemon as daemon
+from proto_compile import descriptors as descriptors
+from proto_compile import discovery as discovery
+from proto_compile import mirrors as mirrors
+from proto_compile import plugins as plugins
+from proto_compile import profiling as profiling
+from proto_compile import remote as remote
+from proto_compile import result as result
 from proto_compile import versions as versions
-from proto_compile.options import BaseCompilerOptions, CompilerOptions, CompileTarget
-from proto_compile.plugins import PLUGINS, PROTOC_RELEASE_BASE_URL, ProtoCompiler
-from proto_compile.utils import PathLike, download_executable, print_command, rglob
+from proto_compile import watch as watch
+from proto_compile.cache import ToolchainCache, cache_name, platform_key
+from proto_compile.imports import ImportGraph, IncludeDirs, partition
+from proto_compile.incremental import IncrementalBuild
+from proto_compile.options import (
+    BaseCompilerOptions,
+    CompilerOptions,
+    CompileTarget,
+    source_dirs,
+)
+from proto_compile.plugins import PLUGINS, ProtoCompiler, ProtocPlugin
+from proto_compile.process import default_sink, run, run_async
+from proto_compile.result import CompileResult
+from proto_compile.staging import OutputStaging, Reconciled
+from proto_compile.utils import PathLike, download_executable, submit
 from proto_compile.versions import Target
 
+log = logging.getLogger(__name__)
+
+# only the compiler and the well known types are needed from a protoc release
+PROTOC_ARCHIVE_MEMBERS = ["bin/protoc", "include/"]
+
 
 class DefaultProtoCompiler(ProtoCompiler):
+    # longer command lines are passed to protoc in an @argfile, which stays
+    # well below the limits of windows (32k) and of a single linux argument
+    max_command_length = 32 * 1024
+
     def __init__(self, executable: PathLike) -> None:
         self.executable = executable
 
-    def compile(self, arguments: typing.List[str], verbosity: int = 0) -> None:
-        protoc_command_str = str(" ").join([str(self.executable)] + arguments)
+    @contextlib.contextmanager
+    def command(
+        self, arguments: typing.List[str], verbosity: int = 0
+    ) -> typing.Iterator[typing.List[str]]:
+        """Yields the protoc command, long arguments are passed in an @argfile"""
+        command = [str(self.executable)] + [str(arg) for arg in arguments]
         if verbosity > 0:
-            print(protoc_command_str)
-        print_command(
-            protoc_command_str,
-            stderr=subprocess.STDOUT,
-            shell=True,
-            verbosity=verbosity,
-        )
+            log.info("%s", " ".join(command))
+        if sum(len(arg) + 1 for arg in command) <= self.max_command_length:
+            yield command
+            return
 
+        # protoc reads one argument per line from @argfile
+        fd, argfile = tempfile.mkstemp(prefix="protoc-", suffix=".args")
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                f.write("\n".join(command[1:]) + "\n")
+            yield command[:1] + ["@" + argfile]
+        finally:
+            os.remove(argfile)
 
-def compile(options: CompilerOptions) -> None:
-    abs_source = os.path.abspath(options.proto_source_dir)
+    def compile(self, arguments: typing.List[str], verbosity: int = 0) -> None:
+        with self.command(arguments, verbosity) as command:
+            output = run(command, sink=default_sink(verbosity))
+        log_warnings(output, verbosity)
 
-    proto_files = rglob(abs_source, match="*.proto", absolute=True)
-    if not len(proto_files) > 0:
-        print("{} does not contain any .proto files. Skipping...".format(abs_source))
-        return
+    async def compile_async(
+        self, arguments: typing.List[str], verbosity: int = 0
+    ) -> None:
+        with self.command(arguments, verbosity) as command:
+            output = await run_async(command, sink=default_sink(verbosity))
+        log_warnings(output, verbosity)
 
-    if options.minimal_include_dir:
-        abs_source = os.path.abspath(os.path.dirname(os.path.commonpath(proto_files)))
 
-    tmp_dir = Path(tempfile.mkdtemp())
+def log_warnings(output: str, verbosity: int) -> None:
+    # protoc reports warnings (e.g. unused imports) on success, which were
+    # streamed to the console already for verbosity > 1
+    if verbosity < 2:
+        for line in output.splitlines():
+            log.warning("%s", line)
 
-    def show_temp_dir() -> None:
-        print_command(
-            " ".join(["tree", str(tmp_dir.absolute())]),
-            stderr=subprocess.STDOUT,
-            shell=True,
-            verbosity=options.verbosity,
+
+def install_plugin(
+    plugin: ProtocPlugin,
+    cache: typing.Optional[ToolchainCache] = None,
+    evict: bool = True,
+) -> ProtocPlugin:
+    """Installs the plugin or reuses a cached installation of it"""
+    # "latest" would pin the first installed version forever, so only
+    # concrete versions are cached
+    pinned = plugin.pinned() if cache is not None and plugin.cacheable else None
+    if cache is None or pinned is None:
+        if cache is not None and plugin.cacheable and plugin.verbosity > 0:
+            log.info("not caching %s: latest version is unknown", type(plugin).__name__)
+        plugin.dest_dir.mkdir(parents=True, exist_ok=True)
+        with profiling.span("install " + type(plugin).__name__, "install"):
+            plugin.install()
+        return plugin
+    plugin = pinned
+
+    def _install(staging: Path) -> PathLike:
+        staged = plugin.relocated(staging)
+        staged.install()
+        executable = staged.executable()
+        assert executable is not None
+        return executable
+
+    key = plugin.cache_key()
+    with profiling.span("install " + type(plugin).__name__, "install"):
+        cache.install(key, _install, evict=evict)
+    return plugin.relocated(cache.entry_dir(key))
+
+
+def bootstrap(
+    install_protoc: typing.Optional[typing.Callable[[], PathLike]],
+    plugins: typing.List[typing.Optional[ProtocPlugin]],
+    cache: typing.Optional[ToolchainCache] = None,
+) -> typing.Tuple[
+    typing.Optional[PathLike], typing.List[typing.Optional[ProtocPlugin]]
+]:
+    """Installs protoc and all plugins concurrently.
+
+    Plugins with the same cache key (e.g. plugins that share an npm package)
+    are only installed once. Returns the protoc executable and the installed
+    plugins, where None marks plugins that cannot be installed automatically.
+    install_protoc must not evict cache entries, the cache is evicted once
+    after all installs finished. Without install_protoc, no protoc executable
+    is returned.
+    """
+    # allow for a coarse mtime resolution of the cache entries
+    started = time.time() - 2
+    unique: typing.Dict[typing.Tuple[str, ...], ProtocPlugin] = dict()
+    for plugin in plugins:
+        if plugin is not None:
+            unique.setdefault(tuple(plugin.cache_key()), plugin)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(unique) + 1) as pool:
+        protoc = submit(pool, install_protoc) if install_protoc is not None else None
+        installs = {
+            key: submit(pool, install_plugin, plugin, cache, evict=False)
+            for key, plugin in unique.items()
+        }
+        installed: typing.List[typing.Optional[ProtocPlugin]] = []
+        for plugin in plugins:
+            if plugin is None:
+                installed.append(None)
+                continue
+            try:
+                shared = installs[tuple(plugin.cache_key())].result()
+                installed.append(plugin.relocated(shared.dest_dir))
+            except NotImplementedError:
+                installed.append(None)
+        protoc_executable = protoc.result() if protoc is not None else None
+
+    if cache is not None:
+        evict_unused(cache, started)
+    return protoc_executable, installed
+
+
+def evict_unused(cache: ToolchainCache, started: float) -> None:
+    """Evicts the cache, keeping everything that was used since started"""
+    cache.evict(keep=[e.path for e in cache.entries() if e.last_used >= started])
+
+
+class TargetInvocation:
+    """The compiler and protoc arguments that generate one or more targets"""
+
+    def __init__(
+        self,
+        targets: typing.List[CompileTarget],
+        compiler: ProtoCompiler,
+        arguments: typing.List[str],
+    ) -> None:
+        self.targets = targets
+        self.compiler = compiler
+        self.arguments = arguments
+
+
+class CompilationError(Exception):
+    """Raised when one or more targets failed to compile"""
+
+    def __init__(
+        self, failures: typing.List[typing.Tuple[CompileTarget, Exception]]
+    ) -> None:
+        super().__init__(
+            "{} target(s) failed to compile:\n{}".format(
+                len(failures),
+                "\n".join(_describe_failure(target, e) for target, e in failures),
+            )
         )
+        self.failures = failures
 
-    try:
-        system = platform.system().lower()  # darwin
-        system_alias = "osx" if system == "darwin" else system  # osx for darwin
-        system_alias = "win64" if system == "windows" else system_alias  # windows
-        machine_arch = "" if system == "windows" else platform.machine()
 
-        if options.verbosity > 0:
-            print(system_alias)
-        protoc_release_url = PROTOC_RELEASE_BASE_URL
-        protoc_release_url += "/v" + options.protoc_version
-        protoc_release_url += (
-            "/protoc-"
-            + options.protoc_version
-            + "-"
-            + system_alias
-            + ("" if system == "windows" else "-")
-            + machine_arch
-            + ".zip"
+def _describe_failure(target: CompileTarget, error: Exception) -> str:
+    message = (
+        # the output is added below
+        subprocess.CalledProcessError.__str__(error)
+        if isinstance(error, subprocess.CalledProcessError)
+        else str(error)
+    )
+    description = "  {}: {}".format(target, message)
+    output = getattr(error, "output", None)
+    if isinstance(output, bytes):
+        output = output.decode("utf-8", errors="replace")
+    if output:
+        # include the diagnostics of protoc
+        description += "\n" + "\n".join(
+            "    " + line for line in str(output).rstrip().splitlines()
         )
+    return description
+
+
+def compile_targets(
+    invocations: typing.List[TargetInvocation],
+    base_arguments: typing.List[str],
+    shards: typing.Optional[typing.List[typing.List[str]]] = None,
+    jobs: typing.Optional[int] = None,
+    verbosity: int = 0,
+) -> None:
+    """Runs every invocation for every shard of files on a pool of jobs workers.
 
-        protoc_executable = download_executable(
+    All invocations are attempted, failures are collected and raised together
+    as a CompilationError.
+    """
+    compile_units(
+        [
+            (invocation, base_arguments + shard + invocation.arguments)
+            for invocation in invocations
+            for shard in shards or [[]]
+        ],
+        jobs=jobs,
+        verbosity=verbosity,
+    )
+
+
+# an invocation and the complete protoc arguments of one protoc run
+CompileUnit = typing.Tuple[TargetInvocation, typing.List[str]]
+
+
+def compile_unit(
+    invocation: TargetInvocation, arguments: typing.List[str], verbosity: int = 0
+) -> None:
+    name = "compile " + ", ".join(t.language.name.lower() for t in invocation.targets)
+    with profiling.span(name, "protoc", arguments=len(arguments)):
+        invocation.compiler.compile(arguments, verbosity=verbosity)
+
+
+def compile_units(
+    units: typing.List[CompileUnit],
+    jobs: typing.Optional[int] = None,
+    verbosity: int = 0,
+) -> None:
+    """Runs every unit on a pool of jobs workers, see compile_targets()"""
+    failures: typing.List[typing.Tuple[CompileTarget, Exception]] = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs or None) as pool:
+        futures = [
+            submit(pool, compile_unit, invocation, arguments, verbosity=verbosity)
+            for invocation, arguments in units
+        ]
+        for (invocation, _), future in zip(units, futures):
+            try:
+                future.result()
+            except Exception as e:
+                failures += [(target, e) for target in invocation.targets]
+    if failures:
+        raise CompilationError(failures)
+
+
+def install_protoc(
+    options: CompilerOptions,
+    cache: typing.Optional[ToolchainCache],
+    dest_dir: PathLike,
+) -> PathLike:
+    """Returns the protoc executable, downloading it on a cache miss.
+
+    Cached installs are not evicted, see bootstrap().
+    """
+    key = ["protoc", options.protoc_version] + platform_key()
+    if cache is not None:
+        cached = cache.lookup(key)
+        if cached is not None:
+            result.record_cache(cache_name(key), True)
+            return cached
+
+    protoc_release_url = plugins.protoc_release_url(
+        options.protoc_version,
+        base_url=mirrors.base_url(
+            plugins.PROTOC_RELEASE_BASE_URL,
+            mirrors.PROTOC_DIR,
+            mirror=options.mirror,
+            offline=options.offline,
+        ),
+    )
+    if options.verbosity > 0:
+        log.info("%s", protoc_release_url)
+
+    def protoc_sha256() -> typing.Optional[str]:
+        sha256 = options.protoc_sha256
+        if sha256 is None and options.mirror is not None:
+            sha256 = mirrors.mirror_sha256(protoc_release_url)
+        if sha256 is None and not options.offline:
+            sha256 = plugins.protoc_release_sha256(
+                options.protoc_version, protoc_release_url
+            )
+        if sha256 is None:
+            log.warning(
+                "no sha256 is known for %s, the download cannot be "
+                "verified (use --protoc-sha256)",
+                protoc_release_url,
+            )
+        return sha256
+
+    if cache is not None:
+        with profiling.span("install protoc", "install"):
+            return cache.fetch(
+                key=key,
+                url=protoc_release_url,
+                executable="bin/protoc",
+                unarchive_as="protoc",
+                sha256=protoc_sha256(),
+                members=PROTOC_ARCHIVE_MEMBERS,
+                evict=False,
+            )
+    with profiling.span("install protoc", "install"):
+        return download_executable(
             url=protoc_release_url,
             executable="bin/protoc",
             unarchive_as="protoc",
-            dest_dir=tmp_dir,
+            dest_dir=dest_dir,
+            sha256=protoc_sha256(),
+            members=PROTOC_ARCHIVE_MEMBERS,
             verbosity=options.verbosity,
         )
 
-        show_temp_dir()
 
-        print_command(
-            " ".join([str((tmp_dir / "protoc/bin/protoc").absolute()), "--version"]),
-            stderr=subprocess.STDOUT,
-            shell=True,
+def resolve_plugins(
+    options: CompilerOptions,
+    dest_dir: Path,
+    cache: typing.Optional[ToolchainCache] = None,
+) -> typing.List[typing.Optional[ProtocPlugin]]:
+    """Returns the plugin required by each target or None"""
+    target_plugins: typing.List[typing.Optional[ProtocPlugin]] = []
+    for target in options.targets:
+        if target.language not in PLUGINS:
+            target_plugins.append(None)
+            continue
+        plugin = PLUGINS[target.language](
+            dest_dir,
+            version=target.plugin_version,
             verbosity=options.verbosity,
+            cache_dir=cache.packages_dir if cache is not None else None,
+            mirror=options.mirror,
+            offline=options.offline,
+        )
+        # uncached plugins must not install into the same directory
+        target_plugins.append(plugin.relocated(dest_dir / "-".join(plugin.cache_key())))
+    return target_plugins
+
+
+def target_invocations(
+    options: CompilerOptions,
+    proto_compiler: ProtoCompiler,
+    target_plugins: typing.List[typing.Optional[ProtocPlugin]],
+    installed_plugins: typing.List[typing.Optional[ProtocPlugin]],
+    staging: OutputStaging,
+) -> typing.List[TargetInvocation]:
+    """Builds the compiler invocation of every target, which writes to staging"""
+    invocations: typing.List[TargetInvocation] = []
+    for target, target_plugin, installed_plugin in zip(
+        options.targets, target_plugins, installed_plugins
+    ):
+        target_compiler: typing.Optional[ProtoCompiler] = None
+        target_arguments: typing.List[str] = []
+        staged_output = staging.stage(
+            target.output_dir or options.output_dir, owner=target
+        )
+        language = str(target.language.value)
+
+        # get the required plugin
+        if target_plugin is not None:
+            target_compiler = target_plugin.compiler()
+            if installed_plugin is not None:
+                target_arguments.append(
+                    "--plugin=protoc-gen-{}={}".format(
+                        language,
+                        installed_plugin.executable(),
+                    )
+                )
+            else:
+                # show installation hints
+                try:
+                    hint = target_plugin.install_hint()
+                    if hint is not None:
+                        log.warning("%s", hint)
+                except NotImplementedError:
+                    pass
+
+        target_arguments.append(
+            "--{}_out={}{}".format(
+                str(target.language.value),
+                str((target.out_options + ":") if target.out_options else ""),
+                staged_output,
+            )
         )
+        invocations.append(
+            TargetInvocation(
+                [target], target_compiler or proto_compiler, target_arguments
+            )
+        )
+
+    if options.jobs == 1:
+        # a single invocation for all targets, where a plugin provided
+        # compiler replaces protoc for all of them
+        compiler = proto_compiler
+        arguments: typing.List[str] = []
+        for invocation in invocations:
+            if invocation.compiler is not proto_compiler:
+                compiler = invocation.compiler
+            arguments += invocation.arguments
+        invocations = [TargetInvocation(options.targets, compiler, arguments)]
+    return invocations
+
+
+def embedded_compiler(options: CompilerOptions) -> typing.Optional[ProtoCompiler]:
+    """Returns the protoc bundled with grpc_tools if it can compile all targets.
+
+    This avoids the download of protoc and a process per invocation, but is
+    only used if the bundled version matches the requested protoc version.
+    """
+    if not options.embedded_protoc:
+        return None
+    for target in options.targets:
+        if target.language not in plugins.EMBEDDED_TARGETS:
+            return None
+    version = plugins.embedded_protoc_version()
+    if version != options.protoc_version:
+        if options.verbosity > 0:
+            log.info(
+                "bundled protoc %s does not match protoc %s, using the protoc release",
+                version,
+                options.protoc_version,
+            )
+        return None
+    if options.verbosity > 0:
+        log.info("using the bundled protoc %s", version)
+    return plugins.EmbeddedProtoCompiler()
+
+
+def install_toolchain(
+    options: CompilerOptions,
+    target_plugins: typing.List[typing.Optional[ProtocPlugin]],
+    cache: typing.Optional[ToolchainCache],
+    dest_dir: Path,
+) -> typing.Tuple[ProtoCompiler, typing.List[typing.Optional[ProtocPlugin]]]:
+    """Installs protoc (unless the bundled protoc is used) and all plugins"""
+    embedded = embedded_compiler(options)
+    with profiling.span("bootstrap", "install"):
+        protoc_executable, installed_plugins = bootstrap(
+            None if embedded else lambda: install_protoc(options, cache, dest_dir),
+            target_plugins,
+            cache=cache,
+        )
+    if embedded is not None:
+        return embedded, installed_plugins
+
+    assert protoc_executable is not None
+    return protoc_compiler(options, protoc_executable), installed_plugins
 
-        # eventually clear the output dirs
-        # also find the correct compiler
-        proto_compiler: ProtoCompiler = DefaultProtoCompiler(protoc_executable)
-        for target in options.targets:
-            abs_output = os.path.abspath(target.output_dir or options.output_dir)
-            if os.path.exists(abs_output) and options.clear_output_dirs:
-                shutil.rmtree(abs_output, ignore_errors=True)
+
+def protoc_compiler(options: CompilerOptions, executable: PathLike) -> ProtoCompiler:
+    """Checks that an installed protoc runs and returns its compiler"""
+    with profiling.span("protoc --version", "install"):
+        run([str(executable), "--version"], sink=default_sink(options.verbosity))
+    return DefaultProtoCompiler(executable)
+
+
+def shard_files(
+    options: CompilerOptions,
+    include_dir: IncludeDirs,
+    proto_files: typing.List[PathLike],
+    graph: typing.Optional[ImportGraph] = None,
+) -> typing.List[typing.List[str]]:
+    """Splits the proto files into options.shards batches"""
+    if options.shards <= 1:
+        return [[str(f) for f in proto_files]]
+    graph = graph or ImportGraph.from_files(include_dir, proto_files)
+    shards = partition(graph, proto_files, options.shards)
+    if options.verbosity > 0:
+        log.info("compiling %d proto files in %d shards", len(proto_files), len(shards))
+    return shards
+
+
+def discover_protos(
+    options: CompilerOptions,
+    cache: typing.Optional[ToolchainCache] = None,
+    source_dir: typing.Optional[PathLike] = None,
+) -> typing.List[str]:
+    """Returns the proto files in a source dir, indexed in the cache.
+
+    The source dir defaults to options.proto_source_dir.
+    """
+    source_dir = source_dir or options.proto_source_dir
+    index_path = None
+    if cache is not None:
+        index_path = cache.indexes_dir / discovery.index_name(
+            source_dir,
+            options.include or [],
+            options.exclude or [],
+            options.gitignore,
+        )
+    return discovery.discover(
+        source_dir,
+        include=options.include,
+        exclude=options.exclude,
+        gitignore=options.gitignore,
+        index_path=index_path,
+    )
+
+
+class CompileJob:
+    """The proto files of one CompilerOptions and the include dirs to compile them"""
+
+    def __init__(
+        self,
+        options: CompilerOptions,
+        include_dirs: typing.List[str],
+        proto_files: typing.List[PathLike],
+        incremental: typing.Optional[IncrementalBuild] = None,
+        cache: typing.Optional[ToolchainCache] = None,
+    ) -> None:
+        self.options = options
+        self.include_dirs = include_dirs
+        self.proto_files = proto_files
+        self.incremental = incremental
+        self.cache = cache
+        # the staging dir of every target, see stage_outputs()
+        self.staged: typing.List[str] = []
+        self._remote_key: typing.Optional[str] = None
+
+    @classmethod
+    def prepare(
+        cls, options: CompilerOptions, cache: typing.Optional[ToolchainCache] = None
+    ) -> typing.Optional["CompileJob"]:
+        """Discovers the proto files of every source root.
+
+        Returns None if there is nothing to compile, because the source roots
+        contain no proto files or because the incremental build is up to date.
+        """
+        include_dirs: typing.List[str] = []
+        proto_files: typing.List[PathLike] = []
+        for source_dir in source_dirs(options):
+            abs_source = os.path.abspath(source_dir)
+            with profiling.span("discover", source_dir=abs_source):
+                root_files = discover_protos(options, cache, source_dir=abs_source)
+            if not len(root_files) > 0:
+                log.warning(
+                    "%s does not contain any .proto files. Skipping...", abs_source
+                )
+                continue
+            if options.minimal_include_dir:
+                abs_source = os.path.abspath(
+                    os.path.dirname(os.path.commonpath(root_files))
+                )
+            include_dirs.append(abs_source)
+            proto_files += root_files
+        if not len(proto_files) > 0:
+            return None
+        include_dirs += [os.path.abspath(d) for d in options.include_dirs]
+
+        incremental: typing.Optional[IncrementalBuild] = None
+        if options.incremental:
+            if cache is None:
+                raise ValueError("incremental compilation requires the cache")
+            with profiling.span("check incremental build"):
+                incremental = IncrementalBuild(
+                    options, include_dirs, proto_files, cache=cache
+                )
+                dirty_files = incremental.prepare()
+            result.record_cache("incremental", dirty_files is None)
+            if dirty_files is None:
+                return None
+            proto_files = list(dirty_files)
+        return cls(
+            options, include_dirs, proto_files, incremental=incremental, cache=cache
+        )
+
+    def units(
+        self,
+        proto_compiler: ProtoCompiler,
+        target_plugins: typing.List[typing.Optional[ProtocPlugin]],
+        installed_plugins: typing.List[typing.Optional[ProtocPlugin]],
+        work_dir: PathLike,
+        staging: OutputStaging,
+    ) -> typing.List[CompileUnit]:
+        """Returns the protoc runs, which write the outputs to staging.
+
+        With options.descriptor_set, the proto files are parsed into a
+        descriptor set first, which the protoc runs read instead.
+        """
+        options = self.options
+        incremental = self.incremental
+        self.stage_outputs(staging)
 
         # construct protoc compiler command
-        proto_arguments: typing.List[str] = ["-I={}".format(abs_source)] + [
-            str(f) for f in proto_files
+        proto_arguments: typing.List[str] = [
+            "-I={}".format(include_dir) for include_dir in self.include_dirs
+        ]
+        invocations = target_invocations(
+            options,
+            proto_compiler,
+            target_plugins,
+            installed_plugins,
+            staging,
+        )
+        shards = shard_files(
+            options,
+            self.include_dirs,
+            self.proto_files,
+            graph=incremental.graph if incremental is not None else None,
+        )
+        if options.descriptor_set or options.descriptor_set_out:
+            with profiling.span("descriptor set", "protoc"):
+                descriptor_set = descriptors.build_descriptor_set(
+                    proto_compiler,
+                    "{}-{}".format(
+                        type(proto_compiler).__name__, options.protoc_version
+                    ),
+                    self.include_dirs,
+                    self.proto_files,
+                    dest_dir=work_dir,
+                    cache=self.cache,
+                    verbosity=options.verbosity,
+                )
+            if options.descriptor_set_out:
+                descriptors.copy_descriptor_set(
+                    descriptor_set, options.descriptor_set_out
+                )
+            proto_arguments = ["--descriptor_set_in={}".format(descriptor_set)]
+            shards = [
+                [descriptors.proto_name(self.include_dirs, f) for f in shard]
+                for shard in shards
+            ]
+        return [
+            (invocation, proto_arguments + shard + invocation.arguments)
+            for invocation in invocations
+            for shard in shards
         ]
 
-        for target in options.targets:
-            abs_output = os.path.abspath(target.output_dir or options.output_dir)
-            language = str(target.language.value)
+    def output_dirs(self) -> typing.List[str]:
+        """Returns the distinct output dirs of the targets in target order"""
+        return list(
+            dict.fromkeys(
+                os.path.abspath(target.output_dir or self.options.output_dir)
+                for target in self.options.targets
+            )
+        )
 
-            # get the required plugin
-            if target.language in PLUGINS:
-                plugin = PLUGINS[target.language](
-                    tmp_dir,
-                    version=target.plugin_version,
-                    verbosity=options.verbosity,
+    def stage_outputs(self, staging: OutputStaging) -> typing.List[str]:
+        """Returns the staging dir of every target"""
+        # eventually clear the output dirs when reconciling the staged outputs
+        # partial builds keep the outputs of the unchanged files
+        clear = self.options.clear_output_dirs and not (
+            self.incremental is not None and self.incremental.partial
+        )
+        self.staged = [
+            staging.stage(
+                target.output_dir or self.options.output_dir, clear=clear, owner=target
+            )
+            for target in self.options.targets
+        ]
+        return self.staged
+
+    def remote_key(self) -> typing.Optional[str]:
+        """Returns the key of the outputs in the remote cache.
+
+        None if there is no remote cache or the outputs cannot be shared,
+        because the build is partial or a plugin version is not pinned.
+        """
+        options = self.options
+        if options.remote_cache is None:
+            return None
+        if self.incremental is not None and self.incremental.partial:
+            return None
+        if self._remote_key is None:
+            try:
+                self._remote_key = remote.outputs_key(
+                    options, self.include_dirs, self.proto_files, self.output_dirs()
                 )
-                plugin_compiler = plugin.compiler()
-                proto_compiler = plugin_compiler or proto_compiler
+            except ValueError as e:
+                if options.verbosity > 0:
+                    log.info("not using the remote cache: %s", e)
+                return None
+        return self._remote_key
 
-                try:
-                    # attempt to install the plugin
-                    # plugin_executable = plugin.installed()
-                    # if plugin_executable is None:
-                    #     plugin_executable = plugin.install()
-                    plugin.install()
-                    # plugin_executable = plugin.install()
-                    # if plugin_executable is not None:
-                    proto_arguments.append(
-                        "--plugin=protoc-gen-{}={}".format(
-                            language,
-                            plugin.executable(),
-                        )
-                    )
+    def fetch_outputs(self, staging: OutputStaging, work_dir: PathLike) -> bool:
+        """Stages the outputs of the same compilation from the remote cache.
 
-                    show_temp_dir()
+        Returns False on a cache miss. Errors of the remote cache are only
+        reported, as the outputs can be compiled instead.
+        """
+        key = self.remote_key()
+        if key is None:
+            return False
+        assert self.options.remote_cache is not None
+        bundle = Path(work_dir) / (key + remote.BUNDLE_SUFFIX)
+        with profiling.span("fetch outputs", "remote"):
+            try:
+                hit = remote.remote_cache(self.options.remote_cache).get(key, bundle)
+                if hit:
+                    remote.unpack(bundle, self.stage_outputs(staging), work_dir)
+            except remote.RemoteCacheError as e:
+                log.warning("%s", e)
+                return False
+            finally:
+                if bundle.exists():
+                    os.remove(bundle)
+        result.record_cache("remote", hit)
+        if self.options.verbosity > 0:
+            log.info("remote cache %s for %s", "hit" if hit else "miss", key)
+        return hit
 
-                except NotImplementedError:
-                    # show installation hints
-                    try:
-                        hint = plugin.install_hint()
-                        if hint is not None:
-                            print(hint)
-                    except NotImplementedError:
-                        pass
-
-            proto_arguments.append(
-                "--{}_out={}{}".format(
-                    str(target.language.value),
-                    str((target.out_options + ":") if target.out_options else ""),
-                    abs_output,
+    def store_outputs(self, staging: OutputStaging, work_dir: PathLike) -> None:
+        """Uploads the staged outputs to the remote cache"""
+        key = self.remote_key()
+        if key is None or self.options.remote_cache_read_only:
+            return
+        assert self.options.remote_cache is not None
+        bundle = Path(work_dir) / (key + remote.BUNDLE_SUFFIX)
+        with profiling.span("store outputs", "remote"):
+            try:
+                remote.pack(self.stage_outputs(staging), bundle)
+                remote.remote_cache(self.options.remote_cache).put(key, bundle)
+            except remote.RemoteCacheError as e:
+                log.warning("%s", e)
+            finally:
+                if bundle.exists():
+                    os.remove(bundle)
+
+    def commit(self, reconciled: Reconciled) -> None:
+        """Records the outputs in the result and of an incremental build"""
+        compiled = result.current()
+        if compiled is not None:
+            for target, staged in zip(self.options.targets, self.staged):
+                compiled.outputs.setdefault(target.language.name, []).extend(
+                    reconciled.generated.get(staged, [])
                 )
+        if self.incremental is not None:
+            with profiling.span("record outputs"):
+                self.incremental.commit(reconciled.outputs)
+
+
+def run_units(
+    units: typing.List[CompileUnit],
+    jobs: typing.Optional[int] = None,
+    verbosity: int = 0,
+) -> None:
+    """Runs a single unit directly and multiple units on a pool"""
+    if len(units) == 1:
+        invocation, arguments = units[0]
+        compile_unit(invocation, arguments, verbosity=verbosity)
+        return
+    compile_units(units, jobs=jobs, verbosity=verbosity)
+
+
+def show_temp_dir(tmp_dir: Path, verbosity: int) -> None:
+    # the output of tree is only shown for verbosity > 1
+    if verbosity < 2:
+        return
+    run(["tree", str(tmp_dir.absolute())], sink=default_sink(verbosity))
+
+
+def record_versions(
+    options: CompilerOptions,
+    installed_plugins: typing.Optional[typing.List[typing.Optional[ProtocPlugin]]],
+) -> None:
+    """Records the versions of protoc and of the pinned plugins in the result"""
+    compiled = result.current()
+    if compiled is None:
+        return
+    compiled.versions["protoc"] = options.protoc_version
+    for index, target in enumerate(options.targets):
+        if target.language not in PLUGINS:
+            continue
+        plugin = installed_plugins[index] if installed_plugins is not None else None
+        try:
+            compiled.versions[target.language.name] = remote.target_version(
+                target.language,
+                plugin.version if plugin is not None else target.plugin_version,
             )
+        except ValueError:
+            pass
 
-            # make sure the output path exists
-            if not os.path.exists(abs_output):
-                os.makedirs(abs_output)
 
-        proto_compiler.compile(proto_arguments, verbosity=options.verbosity)
+def compile(options: CompilerOptions) -> CompileResult:
+    """Compiles the proto files of options into the output dirs.
+
+    Returns what was generated, see result.py. Watching for changes returns
+    the result of the watcher itself once it stops.
+    """
+    if options.watch:
+        with result.recording() as watched:
+            watch.watch(options, compile)
+        return watched
+    if options.daemon_socket is not None:
+        forwarded = daemon.forward(options, options.daemon_socket)
+        if forwarded is not None:
+            return forwarded
+    with profiling.profiled(options.profile), result.recording() as compiled:
+        _compile(options)
+    return compiled
+
+
+def _compile(options: CompilerOptions) -> None:
+    cache = (
+        ToolchainCache(options.cache_dir, verbosity=options.verbosity)
+        if options.use_cache
+        else None
+    )
+    job = CompileJob.prepare(options, cache)
+    if job is None:
+        return
+
+    tmp_dir = Path(tempfile.mkdtemp())
+    try:
+        staging = OutputStaging(tmp_dir / "staging")
+        if job.fetch_outputs(staging, tmp_dir):
+            record_versions(options, None)
+        else:
+            # resolve all required plugins up front to install them concurrently
+            target_plugins = resolve_plugins(options, tmp_dir, cache=cache)
+            proto_compiler, installed_plugins = install_toolchain(
+                options, target_plugins, cache, tmp_dir
+            )
+            record_versions(options, installed_plugins)
+            show_temp_dir(tmp_dir, options.verbosity)
+
+            units = job.units(
+                proto_compiler, target_plugins, installed_plugins, tmp_dir, staging
+            )
+            run_units(units, jobs=options.jobs, verbosity=options.verbosity)
+            job.store_outputs(staging, tmp_dir)
+        reconcile(staging, [job], options.verbosity)
     finally:
         # Remove temporary directory
         shutil.rmtree(tmp_dir, ignore_errors=True)
 
 
-def compile_grpc_web(
+def reconcile(
+    staging: OutputStaging, compile_jobs: typing.List[CompileJob], verbosity: int
+) -> None:
+    """Moves the staged outputs into the output dirs and commits all jobs"""
+    with profiling.span("reconcile outputs"):
+        reconciled = staging.reconcile(verbosity=verbosity)
+    compiled = result.current()
+    if compiled is not None:
+        compiled.written += reconciled.written
+        compiled.removed += reconciled.removed
+    for job in compile_jobs:
+        job.commit(reconciled)
+
+
+# options that configure the toolchain, which is shared by all jobs of a batch
+TOOLCHAIN_OPTIONS = [
+    "protoc_version",
+    "protoc_sha256",
+    "use_cache",
+    "cache_dir",
+    "embedded_protoc",
+    "mirror",
+    "offline",
+]
+
+
+def check_toolchain(batch: typing.List[CompilerOptions]) -> None:
+    """Raises a ValueError unless all options agree on the TOOLCHAIN_OPTIONS"""
+    for options in batch[1:]:
+        for name in TOOLCHAIN_OPTIONS:
+            if getattr(options, name) != getattr(batch[0], name):
+                raise ValueError(
+                    "all jobs of a batch must use the same {}".format(name)
+                )
+
+
+def compile_batch(
+    batch: typing.List[CompilerOptions], jobs: typing.Optional[int] = None
+) -> CompileResult:
+    """Compiles many options with one toolchain bootstrap and one worker pool.
+
+    All options must agree on the TOOLCHAIN_OPTIONS. The protoc runs of all
+    options are scheduled on a pool of jobs workers (None uses the cpu count),
+    failures are collected and raised together as a CompilationError. A single
+    result covers all options.
+    """
+    if not batch:
+        return CompileResult()
+    check_toolchain(batch)
+    first = batch[0]
+    with profiling.profiled(first.profile), result.recording() as compiled:
+        _compile_batch(batch, jobs)
+    return compiled
+
+
+def _compile_batch(
+    batch: typing.List[CompilerOptions], jobs: typing.Optional[int]
+) -> None:
+    first = batch[0]
+    verbosity = max(options.verbosity for options in batch)
+    cache = (
+        ToolchainCache(first.cache_dir, verbosity=verbosity)
+        if first.use_cache
+        else None
+    )
+    prepared = [CompileJob.prepare(options, cache) for options in batch]
+    compile_jobs = [job for job in prepared if job is not None]
+    if not compile_jobs:
+        return
+
+    tmp_dir = Path(tempfile.mkdtemp())
+    try:
+        # jobs may share output dirs, so all outputs are reconciled at once
+        staging = OutputStaging(tmp_dir / "staging")
+        missed: typing.List[CompileJob] = []
+        for job in compile_jobs:
+            if job.fetch_outputs(staging, tmp_dir):
+                record_versions(job.options, None)
+            else:
+                missed.append(job)
+        if missed:
+            _compile_jobs(missed, first, verbosity, cache, staging, tmp_dir, jobs)
+            for job in missed:
+                job.store_outputs(staging, tmp_dir)
+        reconcile(staging, compile_jobs, verbosity)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def _compile_jobs(
+    compile_jobs: typing.List[CompileJob],
+    first: CompilerOptions,
+    verbosity: int,
+    cache: typing.Optional[ToolchainCache],
+    staging: OutputStaging,
+    tmp_dir: Path,
+    jobs: typing.Optional[int],
+) -> None:
+    """Compiles the jobs of a batch with a single toolchain into staging"""
+    toolchain = copy.copy(first)
+    toolchain.verbosity = verbosity
+    toolchain.targets = [t for job in compile_jobs for t in job.options.targets]
+
+    target_plugins = resolve_plugins(toolchain, tmp_dir, cache=cache)
+    proto_compiler, installed_plugins = install_toolchain(
+        toolchain, target_plugins, cache, tmp_dir
+    )
+    record_versions(toolchain, installed_plugins)
+    show_temp_dir(tmp_dir, verbosity)
+
+    units: typing.List[CompileUnit] = []
+    offset = 0
+    for job in compile_jobs:
+        count = len(job.options.targets)
+        units += job.units(
+            proto_compiler,
+            target_plugins[offset : offset + count],
+            installed_plugins[offset : offset + count],
+            tmp_dir,
+            staging,
+        )
+        offset += count
+    run_units(units, jobs=jobs, verbosity=verbosity)
+
+
+def grpc_web_options(
     options: BaseCompilerOptions,
     js_out_options: typing.Optional[str] = "import_style=commonjs,binary",
     js_output_dir: typing.Optional[PathLike] = None,
@@ -172,28 +996,51 @@ def compile_grpc_web(
     ],
     grpc_web_output_dir: typing.Optional[PathLike] = None,
     improbable: bool = False,
-) -> None:
+) -> CompilerOptions:
+    """Returns the options of the javascript and the grpc web targets"""
     grpc_web_target = Target.IMPROBABLE_GRPC_WEB if improbable else Target.GRPC_WEB
     grpc_web_out_options = grpc_web_out_options or (
         "service=grpc-web" if improbable else "import_style=typescript,mode=grpcwebtext"
     )
 
+    return CompilerOptions(
+        base_options=options,
+        targets=[
+            CompileTarget(
+                Target.JAVASCRIPT,
+                output_dir=js_output_dir,
+                out_options=js_out_options,
+            ),
+            CompileTarget(
+                grpc_web_target,
+                out_options=grpc_web_out_options,
+                output_dir=grpc_web_output_dir,
+                plugin_version=grpc_web_plugin_version,
+            ),
+        ],
+    )
+
+
+def compile_grpc_web(
+    options: BaseCompilerOptions,
+    js_out_options: typing.Optional[str] = "import_style=commonjs,binary",
+    js_output_dir: typing.Optional[PathLike] = None,
+    grpc_web_out_options: typing.Optional[str] = None,
+    grpc_web_plugin_version: typing.Optional[str] = versions.DEFAULT_PLUGIN_VERSIONS[
+        Target.GRPC_WEB
+    ],
+    grpc_web_output_dir: typing.Optional[PathLike] = None,
+    improbable: bool = False,
+) -> CompileResult:
     return compile(
-        CompilerOptions(
-            base_options=options,
-            targets=[
-                CompileTarget(
-                    Target.JAVASCRIPT,
-                    output_dir=js_output_dir,
-                    out_options=js_out_options,
-                ),
-                CompileTarget(
-                    grpc_web_target,
-                    out_options=grpc_web_out_options,
-                    output_dir=grpc_web_output_dir,
-                    plugin_version=grpc_web_plugin_version,
-                ),
-            ],
+        grpc_web_options(
+            options,
+            js_out_options=js_out_options,
+            js_output_dir=js_output_dir,
+            grpc_web_out_options=grpc_web_out_options,
+            grpc_web_plugin_version=grpc_web_plugin_version,
+            grpc_web_output_dir=grpc_web_output_dir,
+            improbable=improbable,
         )
     )
 
@@ -201,7 +1048,7 @@ def compile_grpc_web(
 NodeGrpcOptions = typing.TypedDict(
         'NodeGrpcOptions', {'js': str, 'grpc': int})
 
-def compile_node_grpc(
+def node_grpc_options(
     options: BaseCompilerOptions,
     out_options: typing.Optional[NodeGrpcOptions] = None,
     out_dirs: typing.Optional[NodeGrpcOptions] = None,
@@ -211,7 +1058,8 @@ def compile_node_grpc(
     # ],
     # grpc_web_output_dir: typing.Optional[PathLike] = None,
     # improbable: bool = False,
-) -> None:
+) -> CompilerOptions:
+    """Returns the options of the node grpc target"""
     # grpc_web_target = Target.IMPROBABLE_GRPC_WEB if improbable else Target.GRPC_WEB
     # grpc_web_out_options = grpc_web_out_options or (
     #     "service=grpc-web" if improbable else "import_style=typescript,mode=grpcwebtext"
@@ -220,49 +1068,74 @@ def compile_node_grpc(
     # grpc_tools_node_protoc --js_out=import_style=commonjs,binary:../routeguide/static_codegen/ --grpc_out=grpc_js:../routeguide/static_codegen/ route_guide.proto
     valid_out_options = out_options or dict(js="import_style=commonjs,binary", grpc="grpc_js")
     # valid_out_dirs = out_dirs
+    return CompilerOptions(
+        base_options=options,
+        targets=[
+            CompileTarget(
+                Target.NODE_GRPC,
+                out_dirs=out_dirs,
+                out_options=valid_out_options,
+            ),
+            # CompileTarget(
+            #     grpc_web_target,
+            #     out_options=grpc_web_out_options,
+            #     output_dir=grpc_web_output_dir,
+            #     plugin_version=grpc_web_plugin_version,
+            # ),
+        ],
+    )
+
+
+def compile_node_grpc(
+    options: BaseCompilerOptions,
+    out_options: typing.Optional[NodeGrpcOptions] = None,
+    out_dirs: typing.Optional[NodeGrpcOptions] = None,
+) -> CompileResult:
     return compile(
-        CompilerOptions(
-            base_options=options,
-            targets=[
-                CompileTarget(
-                    Target.NODE_GRPC,
-                    out_dirs=out_dirs,
-                    out_options=valid_out_options,
-                ),
-                # CompileTarget(
-                #     grpc_web_target,
-                #     out_options=grpc_web_out_options,
-                #     output_dir=grpc_web_output_dir,
-                #     plugin_version=grpc_web_plugin_version,
-                # ),
-            ],
-        )
+        node_grpc_options(options, out_options=out_options, out_dirs=out_dirs)
     )
 
 
 
 
+def python_grpc_options(
+    options: BaseCompilerOptions,
+    py_out_options: typing.Optional[str] = None,
+    py_output_dir: typing.Optional[PathLike] = None,
+    py_grpc_out_options: typing.Optional[str] = None,
+    py_grpc_output_dir: typing.Optional[PathLike] = None,
+) -> CompilerOptions:
+    """Returns the options of the python and the python grpc targets"""
+    return CompilerOptions(
+        base_options=options,
+        targets=[
+            CompileTarget(
+                Target.PYTHON,
+                output_dir=py_output_dir,
+                out_options=py_out_options,
+            ),
+            CompileTarget(
+                Target.PYTHON_GRPC,
+                out_options=py_grpc_out_options,
+                output_dir=py_grpc_output_dir,
+            ),
+        ],
+    )
+
+
 def compile_python_grpc(
     options: BaseCompilerOptions,
     py_out_options: typing.Optional[str] = None,
     py_output_dir: typing.Optional[PathLike] = None,
     py_grpc_out_options: typing.Optional[str] = None,
     py_grpc_output_dir: typing.Optional[PathLike] = None,
-) -> None:
+) -> CompileResult:
     return compile(
-        CompilerOptions(
-            base_options=options,
-            targets=[
-                CompileTarget(
-                    Target.PYTHON,
-                    output_dir=py_output_dir,
-                    out_options=py_out_options,
-                ),
-                CompileTarget(
-                    Target.PYTHON_GRPC,
-                    out_options=py_grpc_out_options,
-                    output_dir=py_grpc_output_dir,
-                ),
-            ],
+        python_grpc_options(
+            options,
+            py_out_options=py_out_options,
+            py_output_dir=py_output_dir,
+            py_grpc_out_options=py_grpc_out_options,
+            py_grpc_output_dir=py_grpc_output_dir,
         )
     )
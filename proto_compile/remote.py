@@ -0,0 +1,236 @@
+"""Shares the generated outputs of compilations through a remote cache.
+
+The outputs of a compilation are keyed by the content of the proto files and
+their imports, the protoc version and the version and out options of every
+target. They are stored as one compressed bundle, so that a worker with a
+cache hit neither installs the toolchain nor runs protoc. The cache is a
+local or network mounted (e.g. NFS) dir or an HTTP server that answers GET
+and PUT requests for ``<url>/<key[:2]>/<key>.tar.gz``.
+"""
+
+import abc
+import hashlib
+import json
+import os
+import shutil
+import tarfile
+import typing
+import uuid
+import zlib
+from pathlib import Path
+
+from proto_compile import descriptors as descriptors
+from proto_compile.options import CompilerOptions
+from proto_compile.plugins import PLUGINS
+from proto_compile.utils import PathLike, extract
+from proto_compile.versions import Target
+
+REMOTE_CACHE_ENV = "PROTO_COMPILE_REMOTE_CACHE"
+BUNDLE_SUFFIX = ".tar.gz"
+# changes whenever the key or the layout of the bundles change
+BUNDLE_FORMAT = 2
+
+
+class RemoteCacheError(Exception):
+    pass
+
+
+class RemoteCache(abc.ABC):
+    @abc.abstractmethod
+    def get(self, key: str, dest: Path) -> bool:
+        """Downloads the bundle of key to dest, returns False on a cache miss"""
+
+    @abc.abstractmethod
+    def put(self, key: str, src: Path) -> None:
+        """Uploads the bundle of key"""
+
+
+class DirectoryRemoteCache(RemoteCache):
+    """Bundles in a local or network mounted dir"""
+
+    def __init__(self, root: PathLike) -> None:
+        self.root = Path(root)
+
+    def path(self, key: str) -> Path:
+        return self.root / key[:2] / (key + BUNDLE_SUFFIX)
+
+    def get(self, key: str, dest: Path) -> bool:
+        try:
+            shutil.copyfile(self.path(key), dest)
+        except FileNotFoundError:
+            return False
+        except OSError as e:
+            raise RemoteCacheError("reading {} failed: {}".format(self.path(key), e))
+        return True
+
+    def put(self, key: str, src: Path) -> None:
+        path = self.path(key)
+        # renames within a dir are atomic, also on NFS
+        tmp = path.parent / (".%s.%s.tmp" % (path.name, uuid.uuid4()))
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            shutil.copyfile(src, tmp)
+            os.replace(tmp, path)
+        except OSError as e:
+            raise RemoteCacheError("writing {} failed: {}".format(path, e))
+        finally:
+            if tmp.exists():
+                os.remove(tmp)
+
+
+class HTTPRemoteCache(RemoteCache):
+    """Bundles on an HTTP server that answers GET and PUT requests"""
+
+    def __init__(self, url: str, timeout: float = 60) -> None:
+        self.url = url.rstrip("/")
+        self.timeout = timeout
+
+    def bundle_url(self, key: str) -> str:
+        return "{}/{}/{}{}".format(self.url, key[:2], key, BUNDLE_SUFFIX)
+
+    def get(self, key: str, dest: Path) -> bool:
+        import urllib.error
+        import urllib.request
+
+        url = self.bundle_url(key)
+        try:
+            with urllib.request.urlopen(url, timeout=self.timeout) as response:
+                with open(dest, "wb") as f:
+                    shutil.copyfileobj(response, f)
+        except urllib.error.HTTPError as e:
+            if e.code == 404:
+                return False
+            raise RemoteCacheError("downloading {} failed: {}".format(url, e))
+        except OSError as e:
+            raise RemoteCacheError("downloading {} failed: {}".format(url, e))
+        return True
+
+    def put(self, key: str, src: Path) -> None:
+        import urllib.request
+
+        url = self.bundle_url(key)
+        try:
+            with open(src, "rb") as f:
+                request = urllib.request.Request(
+                    url,
+                    data=f,
+                    method="PUT",
+                    headers={
+                        "Content-Length": str(os.path.getsize(src)),
+                        "Content-Type": "application/gzip",
+                    },
+                )
+                with urllib.request.urlopen(request, timeout=self.timeout):
+                    pass
+        except OSError as e:
+            raise RemoteCacheError("uploading {} failed: {}".format(url, e))
+
+
+def remote_cache(location: PathLike) -> RemoteCache:
+    """Returns the backend of an http(s) URL, a file:// URL or a dir"""
+    location = str(location)
+    if location.startswith(("http://", "https://")):
+        return HTTPRemoteCache(location)
+    if location.startswith("file://"):
+        import urllib.parse
+        import urllib.request
+
+        return DirectoryRemoteCache(
+            urllib.request.url2pathname(urllib.parse.urlparse(location).path)
+        )
+    return DirectoryRemoteCache(os.path.expanduser(location))
+
+
+def target_version(target: Target, plugin_version: typing.Optional[str]) -> str:
+    """Returns the version of the code generator of a target.
+
+    Raises a ValueError if the version is unknown, e.g. "latest".
+    """
+    if target not in PLUGINS:
+        # generated by protoc itself
+        return "protoc"
+    version = plugin_version or PLUGINS[target].default_version
+    if version is None and target == Target.PYTHON_GRPC:
+        try:
+            from importlib import metadata
+
+            version = metadata.version("grpcio-tools")
+        except ImportError:  # pragma: no cover
+            pass
+    if version is None or version == "latest":
+        raise ValueError("the version of the {} plugin is not pinned".format(target))
+    return version
+
+
+def outputs_key(
+    options: CompilerOptions,
+    include_dirs: typing.List[str],
+    proto_files: typing.Iterable[PathLike],
+    output_dirs: typing.List[str],
+) -> str:
+    """Hashes everything that determines the generated outputs.
+
+    Output dirs are only identified by their index in output_dirs, so that
+    workers with different checkout paths share the outputs. Raises a
+    ValueError if a plugin version is not pinned.
+    """
+    targets = [
+        dict(
+            target=target.language.name,
+            version=target_version(target.language, target.plugin_version),
+            out_options=target.out_options,
+            output_dir=output_dirs.index(
+                os.path.abspath(target.output_dir or options.output_dir)
+            ),
+        )
+        for target in options.targets
+    ]
+    key = json.dumps(
+        [
+            BUNDLE_FORMAT,
+            descriptors.descriptor_set_key(
+                "protoc-" + options.protoc_version, include_dirs, proto_files
+            ),
+            targets,
+            # the descriptor set adds json names to the generated code
+            bool(options.descriptor_set or options.descriptor_set_out),
+        ]
+    )
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+
+def pack(dirs: typing.Sequence[PathLike], bundle: PathLike) -> None:
+    """Writes the files of dirs into a bundle, the files of dirs[i] below i/"""
+    with tarfile.open(bundle, "w:gz") as tf:
+        for index, d in enumerate(dirs):
+            for root, dirnames, filenames in os.walk(str(d)):
+                dirnames.sort()
+                for filename in sorted(filenames):
+                    path = os.path.join(root, filename)
+                    name = Path(os.path.relpath(path, d)).as_posix()
+                    tf.add(path, arcname="{}/{}".format(index, name))
+
+
+def unpack(
+    bundle: PathLike, dirs: typing.Sequence[PathLike], work_dir: PathLike
+) -> None:
+    """Extracts the files of a bundle into dirs, see pack().
+
+    The bundle is extracted completely before any file is moved into dirs.
+    """
+    unpacked = Path(work_dir) / ("bundle-%s" % uuid.uuid4())
+    try:
+        try:
+            extract(bundle, unpacked)
+        except (tarfile.TarError, EOFError, OSError, zlib.error) as e:
+            raise RemoteCacheError("corrupt bundle {}: {}".format(bundle, e))
+        for index, d in enumerate(dirs):
+            src_dir = unpacked / str(index)
+            for root, dirnames, filenames in os.walk(str(src_dir)):
+                for filename in filenames:
+                    src = os.path.join(root, filename)
+                    dest = os.path.join(str(d), os.path.relpath(src, src_dir))
+                    os.makedirs(os.path.dirname(dest), exist_ok=True)
+                    os.replace(src, dest)
+    finally:
+        shutil.rmtree(unpacked, ignore_errors=True)
@@ -0,0 +1,110 @@
+"""Structured results of compilations.
+
+Every compilation returns a CompileResult with the generated files of each
+target, the time spent in each phase, which caches were hit, the versions of
+the toolchain and the diagnostics that were logged. Messages are logged to the
+proto_compile logger instead of being printed, the console scripts write them
+to stdout. Diagnostics are the records that pass the level of that logger,
+which are the warnings unless the level is lowered.
+"""
+
+import contextlib
+import contextvars
+import logging
+import time
+import typing
+
+from proto_compile import profiling as profiling
+
+LOGGER_NAME = "proto_compile"
+
+
+class Diagnostic(typing.NamedTuple):
+    # the name of the level, e.g. "WARNING"
+    level: str
+    logger: str
+    message: str
+
+
+class CompileResult:
+    def __init__(
+        self,
+        outputs: typing.Optional[typing.Dict[str, typing.List[str]]] = None,
+        written: typing.Optional[typing.List[str]] = None,
+        removed: typing.Optional[typing.List[str]] = None,
+        timings: typing.Optional[typing.Dict[str, float]] = None,
+        cache: typing.Optional[typing.Dict[str, bool]] = None,
+        versions: typing.Optional[typing.Dict[str, str]] = None,
+        diagnostics: typing.Optional[typing.List[Diagnostic]] = None,
+        wall_time: float = 0.0,
+    ) -> None:
+        # the files generated for each target by target name, e.g. "PYTHON"
+        self.outputs = outputs or dict()
+        # the generated files whose content changed
+        self.written = written or []
+        # the stale files that were removed from cleared output dirs
+        self.removed = removed or []
+        # the total seconds spent in each phase, e.g. "bootstrap"
+        self.timings = timings or dict()
+        # whether each cache was hit, e.g. "remote" or "toolchain/<key>"
+        self.cache = cache or dict()
+        # the versions of protoc and of the plugins by target name
+        self.versions = versions or dict()
+        self.diagnostics = diagnostics or []
+        self.wall_time = wall_time
+
+    def __repr__(self) -> str:
+        return "CompileResult(outputs={}, wall_time={:.3f}s, diagnostics={})".format(
+            sum(len(files) for files in self.outputs.values()),
+            self.wall_time,
+            len(self.diagnostics),
+        )
+
+
+# the result of the compilation running in the current context, see
+# utils.submit() for threads
+_current: "contextvars.ContextVar[typing.Optional[CompileResult]]" = (
+    contextvars.ContextVar("result", default=None)
+)
+
+
+def current() -> typing.Optional[CompileResult]:
+    return _current.get()
+
+
+@contextlib.contextmanager
+def recording() -> typing.Iterator[CompileResult]:
+    """Records the timings and diagnostics of the block into a new result"""
+    result = CompileResult()
+    profiler = profiling.Profiler()
+    token = _current.set(result)
+    try:
+        with profiling.recorded(profiler):
+            yield result
+    finally:
+        _current.reset(token)
+        result.timings = {t["name"]: t["total"] for t in profiler.totals()}
+        result.wall_time = time.perf_counter() - profiler.started
+
+
+def record_cache(name: str, hit: bool) -> None:
+    """Records whether a cache was hit in the current result"""
+    result = _current.get()
+    if result is not None:
+        result.cache[name] = hit
+
+
+class _DiagnosticsHandler(logging.Handler):
+    """Adds the log records to the result of the current context"""
+
+    def emit(self, record: logging.LogRecord) -> None:
+        result = _current.get()
+        if result is not None:
+            result.diagnostics.append(
+                Diagnostic(record.levelname, record.name, record.getMessage())
+            )
+
+
+# also keeps the records from the last resort handler, which prints warnings
+# of libraries to stderr if logging is not configured
+logging.getLogger(LOGGER_NAME).addHandler(_DiagnosticsHandler())
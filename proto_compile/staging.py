@@ -0,0 +1,141 @@
+"""Stages generated files and reconciles them into the output dirs.
+
+protoc writes the outputs of every target into its own staging dir. Once all
+protoc runs succeeded, only files whose content changed are swapped into the
+output dir, each with an atomic rename. Unchanged files keep their mtimes, so
+downstream builds (go, tsc, webpack, bazel) do not rebuild them. Output dirs
+that are cleared lose the files that were not generated again.
+"""
+
+import errno
+import logging
+import os
+import shutil
+import threading
+import typing
+import uuid
+from pathlib import Path
+
+from proto_compile.utils import PathLike
+
+log = logging.getLogger(__name__)
+
+
+def same_content(a: PathLike, b: PathLike, chunk_size: int = 1 << 16) -> bool:
+    """Compares two files byte by byte, a missing b is never the same"""
+    try:
+        if os.path.getsize(a) != os.path.getsize(b):
+            return False
+    except OSError:
+        return False
+    with open(a, "rb") as fa, open(b, "rb") as fb:
+        while True:
+            chunk = fa.read(chunk_size)
+            if chunk != fb.read(chunk_size):
+                return False
+            if not chunk:
+                return True
+
+
+def replace(src: PathLike, dest: PathLike) -> None:
+    """Atomically replaces dest with src, which is moved or copied"""
+    os.makedirs(os.path.dirname(dest), exist_ok=True)
+    try:
+        os.replace(src, dest)
+        return
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+    # the staging dir is on another file system
+    tmp = "%s.%s.tmp" % (dest, uuid.uuid4())
+    try:
+        shutil.copyfile(src, tmp)
+        shutil.copymode(src, tmp)
+        os.replace(tmp, dest)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+class Reconciled(typing.NamedTuple):
+    # every generated file in the output dirs
+    outputs: typing.List[str]
+    # the generated files whose content changed
+    written: typing.List[str]
+    # the stale files that were removed from cleared output dirs
+    removed: typing.List[str]
+    # staging dir -> the generated files that were staged in it
+    generated: typing.Dict[str, typing.List[str]]
+
+
+class OutputStaging:
+    def __init__(self, staging_dir: PathLike) -> None:
+        self.staging_dir = Path(staging_dir)
+        # (output dir, owner) -> staging dir
+        self.dirs: typing.Dict[typing.Tuple[str, typing.Hashable], str] = dict()
+        # output dirs whose files are removed unless they are generated again
+        self.cleared: typing.Set[str] = set()
+        # jobs of a build stage their outputs concurrently
+        self._lock = threading.Lock()
+
+    def stage(
+        self,
+        output_dir: PathLike,
+        clear: bool = False,
+        owner: typing.Hashable = None,
+    ) -> str:
+        """Returns the dir that protoc writes the outputs of output_dir to.
+
+        Every owner (e.g. a target) of the same output dir gets its own staging
+        dir, so that the outputs can be told apart after reconciling.
+        """
+        output_dir = os.path.abspath(output_dir)
+        with self._lock:
+            staged = self.dirs.get((output_dir, owner))
+            if staged is None:
+                staged = str(self.staging_dir / str(len(self.dirs)))
+                os.makedirs(staged, exist_ok=True)
+                self.dirs[(output_dir, owner)] = staged
+            if clear:
+                self.cleared.add(output_dir)
+        return staged
+
+    def reconcile(self, verbosity: int = 0) -> Reconciled:
+        """Moves the changed files into the output dirs and removes stale files"""
+        outputs: typing.List[str] = []
+        written: typing.List[str] = []
+        generated: typing.Dict[str, typing.List[str]] = dict()
+        for (output_dir, _), staged in self.dirs.items():
+            os.makedirs(output_dir, exist_ok=True)
+            generated[staged] = []
+            for root, dirnames, filenames in os.walk(staged):
+                for filename in filenames:
+                    src = os.path.join(root, filename)
+                    dest = os.path.join(output_dir, os.path.relpath(src, staged))
+                    outputs.append(dest)
+                    generated[staged].append(dest)
+                    if not same_content(src, dest):
+                        replace(src, dest)
+                        written.append(dest)
+
+        # output dirs may be nested, so the outputs of all dirs are kept
+        kept = set(outputs)
+        output_dirs = {output_dir for output_dir, _ in self.dirs}
+        removed: typing.List[str] = []
+        for output_dir in sorted(self.cleared):
+            for root, dirnames, filenames in os.walk(output_dir, topdown=False):
+                for filename in filenames:
+                    path = os.path.join(root, filename)
+                    if path not in kept:
+                        os.remove(path)
+                        removed.append(path)
+                if root not in output_dirs and not os.listdir(root):
+                    os.rmdir(root)
+        if verbosity > 0:
+            log.info(
+                "updated %d of %d outputs, removed %d stale files",
+                len(written),
+                len(outputs),
+                len(removed),
+            )
+        return Reconciled(outputs, written, removed, generated)
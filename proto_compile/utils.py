@@ -1,29 +1,171 @@
 from __future__ import annotations
+import concurrent.futures
+import contextlib
+import contextvars
 import fnmatch
+import functools
+import hashlib
+import logging
 import os
-import subprocess
+import shutil
+import stat
+import time
 import typing
 import uuid
 from pathlib import Path
 
+from proto_compile import profiling
+
 PathLike = typing.Union[str, os.PathLike[typing.Any]]
 
+T = typing.TypeVar("T")
+
+log = logging.getLogger(__name__)
+
+
+class ChecksumMismatchError(Exception):
+    def __init__(self, path: PathLike, expected: str, actual: str) -> None:
+        super().__init__(
+            "sha256 of {} is {} (expected {})".format(path, actual, expected)
+        )
+        self.path = path
+        self.expected = expected
+        self.actual = actual
+
+
+def file_sha256(path: PathLike, chunk_size: int = 1 << 20) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def verify_sha256(path: PathLike, expected: str) -> None:
+    actual = file_sha256(path)
+    if actual != expected.lower():
+        raise ChecksumMismatchError(path, expected=expected, actual=actual)
+
+
+class DownloadError(Exception):
+    pass
+
+
+# http status codes that are worth retrying
+RETRY_STATUS_CODES = (408, 429, 500, 502, 503, 504)
+
+
+def download(
+    url: str,
+    dest: PathLike,
+    retries: int = 3,
+    backoff: float = 1.0,
+    timeout: float = 60,
+    chunk_size: int = 1 << 16,
+    verbosity: int = 0,
+) -> Path:
+    """Streams url into dest with bounded memory.
+
+    The response is written to ``<dest>.part`` first. Failed attempts are
+    retried with exponential backoff and resume from the partial download if
+    the server supports range requests.
+    """
+    # imported lazily to keep the startup of the cli fast
+    import urllib.error
+    import urllib.request
+
+    dest = Path(dest)
+    partial = dest.parent / (dest.name + ".part")
+    dest.parent.mkdir(parents=True, exist_ok=True)
+    for attempt in range(retries + 1):
+        offset = partial.stat().st_size if partial.exists() else 0
+        request = urllib.request.Request(url)
+        if offset > 0:
+            request.add_header("Range", "bytes=%d-" % offset)
+        try:
+            with urllib.request.urlopen(request, timeout=timeout) as response:
+                # servers without range support send the whole file again
+                mode = "ab" if response.status == 206 else "wb"
+                with open(partial, mode) as f:
+                    shutil.copyfileobj(response, f, chunk_size)
+            os.replace(partial, dest)
+            return dest
+        except urllib.error.HTTPError as e:
+            if e.code == 416 and offset > 0 and attempt < retries:
+                # the partial download is invalid, start over
+                partial.unlink(missing_ok=True)
+            elif e.code not in RETRY_STATUS_CODES or attempt == retries:
+                raise DownloadError("downloading {} failed: {}".format(url, e)) from e
+        except OSError as e:
+            # missing local files (e.g. of a file:// mirror) are not retried
+            if attempt == retries or url.startswith("file:"):
+                raise DownloadError("downloading {} failed: {}".format(url, e)) from e
+        delay = backoff * 2**attempt
+        if verbosity > 0:
+            log.info("retrying download of %s in %.1fs", url, delay)
+        time.sleep(delay)
+    raise DownloadError("downloading {} failed".format(url))  # pragma: no cover
+
+
+def _selected(name: str, members: typing.Optional[typing.List[str]]) -> bool:
+    """Members ending with / select a directory and everything inside of it"""
+    if members is None:
+        return True
+    return any(name.startswith(m) if m.endswith("/") else name == m for m in members)
+
+
+def _safe_path(dest_dir: Path, name: str) -> Path:
+    root = os.path.realpath(dest_dir)
+    path = os.path.realpath(os.path.join(root, name))
+    if os.path.commonpath([root, path]) != root:
+        raise ValueError("archive member {} escapes {}".format(name, dest_dir))
+    return Path(path)
 
-def print_command(
-    *cmd_args: typing.Any, verbosity: int = 0, **cmd_kwargs: typing.Any
+
+def extract(
+    archive: PathLike,
+    dest_dir: PathLike,
+    members: typing.Optional[typing.List[str]] = None,
 ) -> None:
-    try:
-        output = subprocess.check_output(*cmd_args, **cmd_kwargs).decode("utf-8")
-        if verbosity > 1:
-            print(output)
-    except subprocess.CalledProcessError as e:  # pragma: no cover
-        print(e.returncode)
-        print(e.output.decode("utf-8"))
-        raise
+    """Extracts the selected members of a zip or tar archive into dest_dir"""
+    import tarfile
+    import zipfile
+
+    dest_dir = Path(dest_dir)
+    dest_dir.mkdir(parents=True, exist_ok=True)
+    if zipfile.is_zipfile(archive):
+        with zipfile.ZipFile(archive) as zf:
+            for info in zf.infolist():
+                if info.is_dir() or not _selected(info.filename, members):
+                    continue
+                path = _safe_path(dest_dir, info.filename)
+                path.parent.mkdir(parents=True, exist_ok=True)
+                with zf.open(info) as src, open(path, "wb") as dst:
+                    shutil.copyfileobj(src, dst)
+                # zip files store unix permissions in the upper bits
+                mode = (info.external_attr >> 16) & 0o777
+                if mode:
+                    os.chmod(path, mode)
+        return
+    with tarfile.open(archive) as tf:
+        for tar_info in tf.getmembers():
+            if not tar_info.isfile() or not _selected(tar_info.name, members):
+                continue
+            path = _safe_path(dest_dir, tar_info.name)
+            path.parent.mkdir(parents=True, exist_ok=True)
+            extracted = tf.extractfile(tar_info)
+            assert extracted is not None
+            with extracted as src, open(path, "wb") as dst:
+                shutil.copyfileobj(src, dst)
+            os.chmod(path, tar_info.mode & 0o777)
+
 
+def make_executable(path: PathLike) -> None:
+    mode = os.stat(path).st_mode
+    os.chmod(path, mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
 
-def quote(s: str) -> str:
-    return '"' + s + '"'
+
+ARCHIVE_SUFFIXES = [".zip", ".tar", ".tar.gz", ".tgz", ".gz"]
 
 
 def download_executable(
@@ -31,63 +173,73 @@ def download_executable(
     executable: PathLike,
     dest_dir: PathLike,
     unarchive_as: typing.Optional[str] = None,
+    sha256: typing.Optional[str] = None,
+    members: typing.Optional[typing.List[str]] = None,
     verbosity: int = 0,
 ) -> PathLike:
-    # filename = Path(os.path.basename(url)
-    # filename = Path(url).name
-    is_zip = Path(url).suffix.lower() in [".zip", ".tar", ".tar.gz", ".gz"]
-    # is_zip = os.path.splitext(filename)[1].lower() in [".zip", ".tar", ".tar.gz", ".gz"]
-    archive = Path(dest_dir) / (str(uuid.uuid4()) if is_zip else executable)
-    download_command = str(" ").join(
-        [
-            "wget",
-            "-q",
-            "-O",
-            str(archive),
-            # os.path.join(dest_dir, filename if is_zip else executable),
-            quote(url),
-        ]
-    )
+    """Downloads url into dest_dir and returns the path of the executable.
+
+    Archives are extracted into ``dest_dir/<unarchive_as>``, optionally only
+    the given members (e.g. ``["bin/protoc", "include/"]``).
+    """
+    is_archive = Path(url).suffix.lower() in ARCHIVE_SUFFIXES
+    archive = Path(dest_dir) / (str(uuid.uuid4()) if is_archive else executable)
     if verbosity > 0:
-        print(download_command)
-    print_command(
-        download_command,
-        stderr=subprocess.STDOUT,
-        shell=True,
-        verbosity=verbosity,
-    )
+        log.info("downloading %s", url)
+    with profiling.span("download", url=url):
+        download(url, archive, verbosity=verbosity)
+    if sha256 is not None:
+        with profiling.span("verify sha256", url=url):
+            verify_sha256(archive, sha256)
     executable_path = Path(dest_dir)
-    if is_zip:
+    if is_archive:
         unarchived_name = unarchive_as or Path(url).stem
-        unzip_command = str(" ").join(
-            [
-                "unzip",
-                # str((dest_dir / Path(url).name).absolute()),
-                str(archive),
-                "-d",
-                # str((Path(dest_dir) / unarchived_name).absolute()),
-                str(Path(dest_dir) / unarchived_name),
-            ]
-        )
         executable_path = executable_path / unarchived_name
         if verbosity > 0:
-            print(unzip_command)
-        print_command(
-            unzip_command,
-            stderr=subprocess.STDOUT,
-            shell=True,
-            verbosity=verbosity,
-        )
+            log.info("extracting %s to %s", url, executable_path)
+        with profiling.span("extract", url=url):
+            extract(archive, executable_path, members=members)
+        archive.unlink()
     executable_path = executable_path / Path(executable)
-    chmod_command = str(" ").join(["chmod", "+x", str(executable_path)])
-    if verbosity > 0:
-        print(chmod_command)
-    print_command(
-        chmod_command, stderr=subprocess.STDOUT, shell=True, verbosity=verbosity
-    )
+    make_executable(executable_path)
     return executable_path
 
 
+def submit(
+    pool: concurrent.futures.Executor,
+    fn: typing.Callable[..., T],
+    *args: typing.Any,
+    **kwargs: typing.Any,
+) -> concurrent.futures.Future[T]:
+    """Submits fn to pool in a copy of the current context.
+
+    The spans and diagnostics of fn are recorded into the compilation that
+    submitted it, see profiling.py and result.py.
+    """
+    return pool.submit(contextvars.copy_context().run, fn, *args, **kwargs)
+
+
+async def to_thread(
+    fn: typing.Callable[..., T], *args: typing.Any, **kwargs: typing.Any
+) -> T:
+    """Runs fn on the default executor of the running loop, see submit().
+
+    Threads cannot be interrupted, so a cancelled caller waits for fn to
+    finish before the cancellation is raised.
+    """
+    import asyncio
+
+    future = asyncio.get_running_loop().run_in_executor(
+        None, functools.partial(contextvars.copy_context().run, fn, *args, **kwargs)
+    )
+    try:
+        return await asyncio.shield(future)
+    except asyncio.CancelledError:
+        with contextlib.suppress(Exception):
+            await future
+        raise
+
+
 def rglob(
     folder: PathLike, absolute: bool = False, match: str = "*"
 ) -> typing.List[PathLike]:
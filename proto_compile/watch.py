@@ -0,0 +1,289 @@
+"""Recompiles the proto source dirs whenever a .proto file changes."""
+
+import copy
+import logging
+import os
+import select
+import struct
+import threading
+import time
+import typing
+from pathlib import Path
+
+from proto_compile.discovery import (
+    DEFAULT_INCLUDE,
+    IgnoreRules,
+    discover,
+    walk_dirs,
+)
+from proto_compile.options import CompilerOptions, source_dirs
+from proto_compile.utils import PathLike
+
+log = logging.getLogger(__name__)
+
+Snapshot = typing.Dict[str, typing.Tuple[int, int]]
+
+# inotify(7) event masks
+IN_MODIFY = 0x002
+IN_ATTRIB = 0x004
+IN_CLOSE_WRITE = 0x008
+IN_MOVED_FROM = 0x040
+IN_MOVED_TO = 0x080
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_DELETE_SELF = 0x400
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = os.O_CLOEXEC
+WATCH_MASK = (
+    IN_MODIFY
+    | IN_ATTRIB
+    | IN_CLOSE_WRITE
+    | IN_MOVED_FROM
+    | IN_MOVED_TO
+    | IN_CREATE
+    | IN_DELETE
+    | IN_DELETE_SELF
+)
+# struct inotify_event without the trailing name
+INOTIFY_EVENT = struct.Struct("iIII")
+
+
+class WatchedDir(typing.NamedTuple):
+    """A dir tree and the rules that select its proto files, see discover()"""
+
+    path: str
+    include: typing.Optional[typing.List[str]] = None
+    exclude: typing.Optional[typing.List[str]] = None
+    gitignore: bool = True
+
+    def files(self) -> typing.List[str]:
+        return discover(
+            self.path,
+            include=self.include,
+            exclude=self.exclude,
+            gitignore=self.gitignore,
+        )
+
+    def includes(self, path: PathLike) -> bool:
+        """Whether the include rules select a file below the dir"""
+        rel_path = Path(os.path.relpath(path, self.path)).as_posix()
+        return IgnoreRules().extended(self.include or DEFAULT_INCLUDE).matches(rel_path)
+
+
+def watched_dirs(options: CompilerOptions) -> typing.List[WatchedDir]:
+    """Returns the source roots and include dirs of options"""
+    dirs = [
+        WatchedDir(
+            os.path.abspath(source_dir),
+            include=options.include,
+            exclude=options.exclude,
+            gitignore=options.gitignore,
+        )
+        for source_dir in source_dirs(options)
+    ]
+    # the include and exclude globs are relative to the source roots
+    dirs += [
+        WatchedDir(os.path.abspath(include_dir), gitignore=options.gitignore)
+        for include_dir in options.include_dirs
+    ]
+    return list(dict.fromkeys(dirs))
+
+
+def proto_snapshot(dirs: typing.Iterable[WatchedDir]) -> Snapshot:
+    """Stats the proto files of dirs"""
+    snapshot: Snapshot = dict()
+    for watched in dirs:
+        for path in watched.files():
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            snapshot[str(path)] = (st.st_mtime_ns, st.st_size)
+    return snapshot
+
+
+class Watcher:
+    def wait(self, timeout: float) -> bool:
+        """Returns True if files below the watched dirs might have changed"""
+        raise NotImplementedError()
+
+    def close(self) -> None:
+        pass
+
+
+class PollingWatcher(Watcher):
+    def __init__(
+        self, dirs: typing.Sequence[WatchedDir], interval: float = 0.5
+    ) -> None:
+        self.dirs = list(dirs)
+        self.interval = interval
+        self.snapshot = proto_snapshot(self.dirs)
+
+    def wait(self, timeout: float) -> bool:
+        time.sleep(min(timeout, self.interval))
+        snapshot = proto_snapshot(self.dirs)
+        changed = snapshot != self.snapshot
+        self.snapshot = snapshot
+        return changed
+
+
+class InotifyWatcher(Watcher):
+    """Watches directory trees with inotify (linux only).
+
+    Only the dirs that discover() walks are watched, so excluded dirs such as
+    node_modules/ or .git/ never use up inotify watches. Dirs that are created
+    later are added from their events instead of walking the trees again.
+    Changes of files that are not included (e.g. generated files) are ignored.
+    """
+
+    def __init__(self, dirs: typing.Sequence[WatchedDir]) -> None:
+        import ctypes
+        import ctypes.util
+
+        self.dirs = list(dirs)
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        # watch descriptor -> the watched dir and the dir below it
+        self.watches: typing.Dict[int, typing.Tuple[WatchedDir, str]] = dict()
+        for watched in self.dirs:
+            self.add_watches(watched)
+
+    def add_watches(
+        self, watched: WatchedDir, start: typing.Optional[str] = None
+    ) -> typing.List[str]:
+        """Watches start (default is the whole tree) and the dirs below it"""
+        # adding a watch to an already watched dir returns the same descriptor
+        added = walk_dirs(
+            watched.path,
+            exclude=watched.exclude,
+            gitignore=watched.gitignore,
+            start=start,
+        )
+        for path in added:
+            wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), WATCH_MASK)
+            if wd >= 0:
+                self.watches[wd] = (watched, path)
+        return added
+
+    def remove_watches(self, path: str) -> None:
+        """Stops watching path and the dirs below it, e.g. after a move"""
+        for wd, (_, watched_path) in list(self.watches.items()):
+            if watched_path == path or watched_path.startswith(path + os.sep):
+                self.libc.inotify_rm_watch(self.fd, wd)
+                del self.watches[wd]
+
+    def read_events(self) -> typing.Iterator[typing.Tuple[int, int, str]]:
+        """Yields the (watch descriptor, mask, name) of the pending events"""
+        data = b""
+        try:
+            while True:
+                chunk = os.read(self.fd, 1 << 16)
+                if not chunk:
+                    break
+                data += chunk
+        except BlockingIOError:
+            pass
+        offset = 0
+        while offset + INOTIFY_EVENT.size <= len(data):
+            wd, mask, _, length = INOTIFY_EVENT.unpack_from(data, offset)
+            offset += INOTIFY_EVENT.size
+            name = os.fsdecode(data[offset : offset + length].rstrip(b"\0"))
+            offset += length
+            yield wd, mask, name
+
+    def wait(self, timeout: float) -> bool:
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return False
+        changed = False
+        for wd, mask, name in self.read_events():
+            if mask & IN_Q_OVERFLOW:
+                # events were lost
+                for watched in self.dirs:
+                    self.add_watches(watched)
+                changed = True
+                continue
+            if mask & IN_IGNORED:
+                self.watches.pop(wd, None)
+                continue
+            if wd not in self.watches or not name:
+                continue
+            watched, parent = self.watches[wd]
+            path = os.path.join(parent, name)
+            if not mask & IN_ISDIR:
+                changed = changed or watched.includes(path)
+            elif mask & (IN_CREATE | IN_MOVED_TO):
+                # dirs that are excluded are not watched and do not count
+                changed = bool(self.add_watches(watched, start=path)) or changed
+            else:
+                if mask & IN_MOVED_FROM:
+                    self.remove_watches(path)
+                changed = True
+        return changed
+
+    def close(self) -> None:
+        os.close(self.fd)
+
+
+def watcher(dirs: typing.Sequence[WatchedDir], poll_interval: float = 0.5) -> Watcher:
+    """Returns an inotify watcher if available, otherwise a polling watcher"""
+    try:
+        return InotifyWatcher(dirs)
+    except (OSError, AttributeError, TypeError):
+        return PollingWatcher(dirs, interval=poll_interval)
+
+
+def watch(
+    options: CompilerOptions,
+    compile_fn: typing.Callable[[CompilerOptions], typing.Any],
+    debounce: float = 0.1,
+    poll_interval: float = 0.5,
+    stop: typing.Optional[threading.Event] = None,
+) -> None:
+    """Compiles options and recompiles them after every change of a .proto file.
+
+    The source roots and the include dirs are watched. Bursts of changes within debounce seconds trigger a single compilation.
+    With the cache, compilations are incremental, so only the changed files
+    and the files importing them are recompiled with the cached toolchain.
+    Runs until interrupted or until stop is set.
+    """
+    once = copy.copy(options)
+    once.watch = False
+    once.incremental = once.use_cache
+    dirs = watched_dirs(options)
+
+    def build() -> None:
+        started = time.time()
+        try:
+            compile_fn(once)
+        except Exception as e:
+            log.error("compilation failed: %s", e)
+            return
+        if options.verbosity > 0:
+            log.info("compiled in %.2fs", time.time() - started)
+
+    build()
+    snapshot = proto_snapshot(dirs)
+    files = watcher(dirs, poll_interval=poll_interval)
+    log.info("watching %s for changes", ", ".join(d.path for d in dirs))
+    try:
+        while stop is None or not stop.is_set():
+            if not files.wait(timeout=poll_interval):
+                continue
+            while files.wait(timeout=debounce):
+                pass
+            current = proto_snapshot(dirs)
+            if current == snapshot:
+                continue
+            snapshot = current
+            build()
+    except KeyboardInterrupt:  # pragma: no cover
+        pass
+    finally:
+        files.close()
@@ -22,7 +22,9 @@ try:
 except (ImportError, AssertionError):
     long_description = short_description
 
-requirements = ["Click>=6.0", "grpcio-tools"]
+requirements = ["Click>=6.0", "grpcio-tools", 'tomli; python_version < "3.11"']
+# yaml batch manifests
+yaml_requirements = ["PyYAML"]
 test_requirements = [
     "tox",
     "pytest",
@@ -31,6 +33,7 @@ test_requirements = [
     "pytest-sugar",
     "mypy",
     "types-setuptools",
+    "PyYAML",
 ]
 coverage_requirements = ["coverage"]
 formatting_requirements = ["flake8", "black", "isort"]
@@ -64,12 +67,22 @@ setup(
         "Programming Language :: Python :: 3.7",
         "Programming Language :: Python :: 3.8",
     ],
-    entry_points={"console_scripts": ["proto-compile=proto_compile.cli:proto_compile"]},
+    entry_points={
+        "console_scripts": [
+            "proto-compile=proto_compile.cli:proto_compile",
+            "proto-compile-daemon=proto_compile.cli:daemon",
+            "proto-compile-batch=proto_compile.cli:batch",
+            "proto-compile-build=proto_compile.cli:build",
+            "proto-compile-prefetch=proto_compile.cli:prefetch",
+        ]
+    },
     python_requires=">=3.6",
     install_requires=requirements,
     setup_requires=tool_requirements,
     tests_require=test_requirements,
-    extras_require=dict(dev=dev_requirements, test=test_requirements),
+    extras_require=dict(
+        dev=dev_requirements, test=test_requirements, yaml=yaml_requirements
+    ),
     license="MIT",
     description=short_description,
     long_description=long_description,
@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+
+"""Shared fixtures for `proto_compile` tests."""
+
+import functools
+import http.server
+import logging
+import os
+import shutil
+import sys
+import threading
+import typing
+import zipfile
+from pathlib import Path
+
+import pytest
+
+from proto_compile.cache import ToolchainCache, platform_key
+from proto_compile.options import BaseCompilerOptions, CompilerOptions, CompileTarget
+from proto_compile.plugins import embedded_protoc_version, protoc_release_url
+from proto_compile.result import LOGGER_NAME
+from proto_compile.versions import Target
+
+TEST_DIR = os.path.dirname(os.path.realpath(__file__))
+PROTO_DIR = os.path.join(TEST_DIR, "protos")
+SYSTEM_PROTOC = shutil.which("protoc")
+EMBEDDED_VERSION = embedded_protoc_version()
+
+
+class ReleaseServer:
+    """Local HTTP server that serves fake release artifacts from a directory"""
+
+    def __init__(self, root: Path) -> None:
+        self.root = root
+        self.requests: typing.List[str] = []
+        self.ranges: typing.List[typing.Optional[str]] = []
+        # number of upcoming requests that fail with failure_status
+        self.failures = 0
+        self.failure_status = 503
+        server = self
+
+        class Handler(http.server.SimpleHTTPRequestHandler):
+            def do_GET(self) -> None:
+                server.requests.append(self.path)
+                server.ranges.append(self.headers.get("Range"))
+                if server.failures > 0:
+                    server.failures -= 1
+                    self.send_error(server.failure_status)
+                    return
+                range_header = self.headers.get("Range")
+                if range_header is None:
+                    super().do_GET()
+                    return
+                path = Path(self.translate_path(self.path))
+                content = path.read_bytes()
+                start = int(range_header[len("bytes=") :].rstrip("-"))
+                if start >= len(content):
+                    self.send_error(416)
+                    return
+                self.send_response(206)
+                self.send_header("Content-Length", str(len(content) - start))
+                self.end_headers()
+                self.wfile.write(content[start:])
+
+            def log_message(self, format: str, *args: typing.Any) -> None:
+                pass
+
+        self.httpd = http.server.ThreadingHTTPServer(
+            ("127.0.0.1", 0),
+            functools.partial(Handler, directory=str(root)),
+        )
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    @property
+    def url(self) -> str:
+        port = self.httpd.server_address[1]
+        return "http://127.0.0.1:%d" % port
+
+    def add_protoc_release(
+        self, version: str, protoc: str, subdir: typing.Optional[str] = None
+    ) -> str:
+        """Adds a protoc release zip with the given bin/protoc script"""
+        base_url = self.url + ("/" + subdir if subdir is not None else "")
+        url = protoc_release_url(version, base_url=base_url)
+        archive = self.root / url[len(self.url) + 1 :]
+        archive.parent.mkdir(parents=True, exist_ok=True)
+        with zipfile.ZipFile(archive, "w") as zf:
+            info = zipfile.ZipInfo("bin/protoc")
+            info.external_attr = 0o755 << 16
+            zf.writestr(info, protoc)
+            zf.writestr("include/google/protobuf/empty.proto", 'syntax = "proto3";\n')
+        return url
+
+
+def install_protoc(
+    server: ReleaseServer, cache_dir: Path, version: str, protoc: str
+) -> None:
+    """Installs a fake protoc release into the toolchain cache"""
+    url = server.add_protoc_release(version, protoc)
+    ToolchainCache(cache_dir).fetch(
+        key=["protoc", version] + platform_key(),
+        url=url,
+        executable="bin/protoc",
+        unarchive_as="protoc",
+    )
+
+
+def fake_protoc(version: str) -> str:
+    """A protoc wrapper that forwards to the system protoc if available"""
+    if SYSTEM_PROTOC is None:
+        return "#!/bin/sh\necho libprotoc %s\n" % version
+    return '#!/bin/sh\nexec %s "$@"\n' % SYSTEM_PROTOC
+
+
+def python(code: str) -> typing.List[str]:
+    """The command that runs code with the current interpreter"""
+    return [sys.executable, "-c", code]
+
+
+def make_base_options(tmp_path: Path, **kwargs: typing.Any) -> BaseCompilerOptions:
+    """Options for tmp_path/protos that use the embedded protoc and no cache"""
+    kwargs.setdefault("proto_source_dir", tmp_path / "protos")
+    kwargs.setdefault("output_dir", tmp_path / "out")
+    kwargs.setdefault("use_cache", False)
+    kwargs.setdefault("protoc_version", EMBEDDED_VERSION)
+    return BaseCompilerOptions(**kwargs)
+
+
+def make_options(
+    tmp_path: Path,
+    targets: typing.Sequence[typing.Union[Target, CompileTarget]] = (Target.PYTHON,),
+    **kwargs: typing.Any,
+) -> CompilerOptions:
+    """make_base_options() with targets"""
+    return CompilerOptions(
+        make_base_options(tmp_path, **kwargs),
+        targets=[
+            target if isinstance(target, CompileTarget) else CompileTarget(target)
+            for target in targets
+        ],
+    )
+
+
+def write_protos(source_dir: Path) -> None:
+    """Writes a small proto tree with a shared root and an independent leaf"""
+    (source_dir / "common").mkdir(parents=True)
+    header = 'syntax = "proto3";\n'
+    (source_dir / "common" / "root.proto").write_text(header + "message Root {}\n")
+    (source_dir / "a.proto").write_text(
+        header + '// import "leaf.proto";\nimport "common/root.proto";\n'
+        "message A { Root root = 1; }\n"
+    )
+    (source_dir / "b.proto").write_text(
+        header + 'import public "a.proto";\nmessage B { A a = 1; }\n'
+    )
+    (source_dir / "leaf.proto").write_text(header + "message Leaf {}\n")
+
+
+@pytest.fixture
+def release_server(tmp_path: Path) -> typing.Iterator[ReleaseServer]:
+    root = tmp_path / "releases"
+    root.mkdir()
+    server = ReleaseServer(root)
+    server.thread.start()
+    try:
+        yield server
+    finally:
+        server.httpd.shutdown()
+        server.httpd.server_close()
+
+
+@pytest.fixture(autouse=True)
+def restore_logger() -> typing.Iterator[None]:
+    """Undoes the console logging configured by invocations of the cli"""
+    logger = logging.getLogger(LOGGER_NAME)
+    level, handlers = logger.level, list(logger.handlers)
+    try:
+        yield
+    finally:
+        logger.setLevel(level)
+        logger.handlers = handlers
+
+
+@pytest.fixture
+def cache_dir(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> Path:
+    path = tmp_path / "cache"
+    monkeypatch.setenv("PROTO_COMPILE_CACHE_DIR", str(path))
+    return path
+
+
+requires_protoc = pytest.mark.skipif(
+    SYSTEM_PROTOC is None or os.name == "nt", reason="requires a system protoc"
+)
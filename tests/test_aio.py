@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+
+"""Tests for the asyncio compile API."""
+
+import asyncio
+import os
+import subprocess
+import typing
+from pathlib import Path
+
+import pytest
+from conftest import make_base_options, make_options, python, write_protos
+
+from proto_compile import aio, plugins, proto_compile
+from proto_compile.options import CompilerOptions, CompileTarget
+from proto_compile.plugins import ProtoCompiler
+from proto_compile.process import (
+    STDOUT,
+    EventSink,
+    OutputEvent,
+    ProcessError,
+    run_async,
+)
+from proto_compile.utils import rglob
+from proto_compile.versions import Target
+
+
+def test_run_async() -> None:
+    events: typing.List[OutputEvent] = []
+    output = asyncio.run(
+        run_async(python("print('a'); print('b')"), sink=EventSink(events.append))
+    )
+    assert output == "a\nb"
+    assert [(e.stream, e.line) for e in events] == [(STDOUT, "a"), (STDOUT, "b")]
+
+    with pytest.raises(ProcessError) as e:
+        asyncio.run(run_async(python("import sys; print('failed'); sys.exit(3)")))
+    assert e.value.returncode == 3
+    assert e.value.output == "failed"
+
+    with pytest.raises(subprocess.TimeoutExpired):
+        asyncio.run(run_async(python("import time; time.sleep(10)"), timeout=0.5))
+
+
+def test_cancel_kills_process(tmp_path: Path) -> None:
+    pid_file = tmp_path / "pid"
+    code = "import os, time; open(%r, 'w').write(str(os.getpid())); time.sleep(30)"
+
+    async def cancel() -> None:
+        task = asyncio.ensure_future(run_async(python(code % str(pid_file))))
+        while not pid_file.exists() or not pid_file.read_text():
+            await asyncio.sleep(0.05)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(cancel())
+    # the process was killed and reaped
+    with pytest.raises(ProcessLookupError):
+        os.kill(int(pid_file.read_text()), 0)
+
+
+def test_compile_async_matches_compile(tmp_path: Path) -> None:
+    write_protos(tmp_path / "protos")
+    proto_compile.compile_python_grpc(
+        make_base_options(tmp_path, output_dir=tmp_path / "sync")
+    )
+
+    async def compile_all() -> typing.List[proto_compile.CompileResult]:
+        return list(
+            await asyncio.gather(
+                *[
+                    aio.compile_python_grpc_async(
+                        make_base_options(tmp_path, output_dir=tmp_path / name)
+                    )
+                    for name in ["x", "y"]
+                ]
+            )
+        )
+
+    results = asyncio.run(compile_all())
+    expected = sorted(str(f) for f in rglob(tmp_path / "sync"))
+    assert "a_pb2_grpc.py" in expected
+    for name, compiled in zip(["x", "y"], results):
+        assert sorted(str(f) for f in rglob(tmp_path / name)) == expected
+        assert all(f.startswith(str(tmp_path / name)) for f in compiled.written)
+        assert compiled.versions["protoc"] == plugins.embedded_protoc_version()
+
+
+class SleepingCompiler(ProtoCompiler):
+    """Records how many protoc runs are in flight at once"""
+
+    def __init__(self) -> None:
+        self.running = 0
+        self.max_running = 0
+
+    def compile(self, arguments: typing.List[str], verbosity: int = 0) -> None:
+        raise AssertionError("compile_async must be used")
+
+    async def compile_async(
+        self, arguments: typing.List[str], verbosity: int = 0
+    ) -> None:
+        self.running += 1
+        self.max_running = max(self.max_running, self.running)
+        try:
+            await asyncio.sleep(0.05)
+            if "fail" in arguments:
+                raise RuntimeError("protoc failed")
+        finally:
+            self.running -= 1
+
+
+def units(
+    compiler: ProtoCompiler, count: int, fail: bool = False
+) -> typing.List[proto_compile.CompileUnit]:
+    return [
+        (
+            proto_compile.TargetInvocation(
+                [CompileTarget(Target.PYTHON)], compiler, []
+            ),
+            ["fail" if fail and i == 0 else "a.proto"],
+        )
+        for i in range(count)
+    ]
+
+
+def test_limiter_bounds_concurrency() -> None:
+    compiler = SleepingCompiler()
+
+    async def compile_all() -> None:
+        # two batches of units share one limiter
+        limiter = asyncio.Semaphore(2)
+        await asyncio.gather(
+            aio.run_units_async(units(compiler, 3), limiter),
+            aio.run_units_async(units(compiler, 3), limiter),
+        )
+
+    asyncio.run(compile_all())
+    assert compiler.max_running == 2
+
+    with pytest.raises(proto_compile.CompilationError, match="protoc failed"):
+        asyncio.run(
+            aio.run_units_async(units(compiler, 3, fail=True), asyncio.Semaphore(3))
+        )
+
+
+def test_cancel_leaves_outputs_untouched(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    write_protos(tmp_path / "protos")
+    (tmp_path / "out").mkdir()
+    (tmp_path / "out" / "a_pb2.py").write_text("previous")
+    started = tmp_path / "started"
+    protoc = tmp_path / "protoc"
+    protoc.write_text("#!/bin/sh\ntouch %s\nexec sleep 30\n" % started)
+    protoc.chmod(0o755)
+
+    def install_toolchain(
+        options: CompilerOptions,
+        target_plugins: typing.List[typing.Optional[plugins.ProtocPlugin]],
+        *args: typing.Any
+    ) -> typing.Tuple[
+        ProtoCompiler, typing.List[typing.Optional[plugins.ProtocPlugin]]
+    ]:
+        return proto_compile.DefaultProtoCompiler(protoc), target_plugins
+
+    monkeypatch.setattr(aio, "install_toolchain", install_toolchain)
+    options = make_options(tmp_path)
+
+    async def cancel() -> None:
+        task = asyncio.ensure_future(aio.compile_async(options))
+        while not started.exists():
+            await asyncio.sleep(0.05)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(asyncio.wait_for(cancel(), timeout=20))
+    assert [f.name for f in (tmp_path / "out").iterdir()] == ["a_pb2.py"]
+    assert (tmp_path / "out" / "a_pb2.py").read_text() == "previous"
+
+
+def test_compile_async_rejects_watch(tmp_path: Path) -> None:
+    options = make_options(tmp_path, proto_source_dir=tmp_path, watch=True)
+    with pytest.raises(ValueError, match="watch"):
+        asyncio.run(aio.compile_async(options))
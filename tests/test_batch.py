@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+
+"""Tests for multiple source roots and batch manifests."""
+
+import typing
+from pathlib import Path
+
+import pytest
+from click.testing import CliRunner
+from conftest import (
+    ReleaseServer,
+    fake_protoc,
+    install_protoc,
+    requires_protoc,
+    write_protos,
+)
+
+from proto_compile import cli, proto_compile
+from proto_compile.batch import load_manifest
+from proto_compile.imports import ImportGraph
+from proto_compile.options import BaseCompilerOptions, CompilerOptions, CompileTarget
+from proto_compile.utils import rglob
+from proto_compile.versions import DEFAULT_PROTOC_VERSION, Target
+
+HEADER = 'syntax = "proto3";\n'
+
+
+def write_roots(tmp_path: Path) -> None:
+    """Writes two source roots that import from a vendored include dir"""
+    (tmp_path / "vendor" / "google" / "type").mkdir(parents=True)
+    (tmp_path / "vendor" / "google" / "type" / "date.proto").write_text(
+        HEADER + "package google.type;\nmessage Date {}\n"
+    )
+    (tmp_path / "api").mkdir()
+    (tmp_path / "api" / "user.proto").write_text(
+        HEADER + 'import "google/type/date.proto";\n'
+        "message User { google.type.Date born = 1; }\n"
+    )
+    (tmp_path / "admin").mkdir()
+    (tmp_path / "admin" / "role.proto").write_text(
+        HEADER + 'import "user.proto";\nmessage Role { User user = 1; }\n'
+    )
+
+
+def test_import_graph_with_include_dirs(tmp_path: Path) -> None:
+    write_roots(tmp_path)
+    files = [
+        str(tmp_path / "api" / "user.proto"),
+        str(tmp_path / "admin" / "role.proto"),
+    ]
+    graph = ImportGraph.from_files([tmp_path / "admin", tmp_path / "api"], files)
+    assert graph.dependencies[files[1]] == {files[0]}
+    assert graph.affected([files[0]]) == set(files)
+
+
+@requires_protoc
+def test_compile_multiple_source_roots(
+    release_server: ReleaseServer, tmp_path: Path, cache_dir: Path
+) -> None:
+    write_roots(tmp_path)
+    options = BaseCompilerOptions(
+        proto_source_dir=tmp_path / "api",
+        output_dir=tmp_path / "out",
+        extra_source_dirs=[tmp_path / "admin"],
+        include_dirs=[tmp_path / "vendor"],
+        embedded_protoc=False,
+    )
+    install_protoc(release_server, cache_dir, options.protoc_version, fake_protoc(""))
+    proto_compile.compile(
+        CompilerOptions(options, targets=[CompileTarget(Target.PYTHON)])
+    )
+    # the vendored include dir is not compiled
+    assert sorted(str(f) for f in rglob(tmp_path / "out")) == [
+        "role_pb2.py",
+        "user_pb2.py",
+    ]
+
+
+MANIFEST_TOML = """
+[options]
+protoc_version = "3.0.0"
+jobs = 3
+
+[[compile]]
+source_dirs = ["api", "admin"]
+include_dirs = ["vendor"]
+output_dir = "out/python"
+targets = ["python", {target = "python_grpc", output_dir = "out/grpc"}]
+
+[[compile]]
+source_dirs = ["protos"]
+output_dir = "out/protos"
+targets = ["python"]
+shards = 2
+"""
+
+MANIFEST_YAML = """
+options:
+  protoc_version: "3.0.0"
+  jobs: 3
+compile:
+  - source_dirs: [api, admin]
+    include_dirs: [vendor]
+    output_dir: out/python
+    targets: [python, {target: python_grpc, output_dir: out/grpc}]
+  - source_dirs: [protos]
+    output_dir: out/protos
+    targets: [python]
+    shards: 2
+"""
+
+
+@pytest.mark.parametrize(
+    "name,content",
+    [("batch.toml", MANIFEST_TOML), ("batch.yaml", MANIFEST_YAML)],
+)
+def test_load_manifest(tmp_path: Path, name: str, content: str) -> None:
+    (tmp_path / name).write_text(content)
+    manifest = load_manifest(tmp_path / name, verbosity=2)
+    assert manifest.workers == 3
+    first, second = manifest.jobs
+    assert first.proto_source_dir == str(tmp_path / "api")
+    assert first.extra_source_dirs == [str(tmp_path / "admin")]
+    assert first.include_dirs == [str(tmp_path / "vendor")]
+    assert first.output_dir == str(tmp_path / "out" / "python")
+    assert [t.language for t in first.targets] == [Target.PYTHON, Target.PYTHON_GRPC]
+    assert first.targets[1].output_dir == str(tmp_path / "out" / "grpc")
+    assert first.protoc_version == second.protoc_version == "3.0.0"
+    assert first.verbosity == second.verbosity == 2
+    assert (first.shards, second.shards) == (1, 2)
+
+
+@pytest.mark.parametrize(
+    "content,error",
+    [
+        ("[[compile]]\nsource_dirs = ['a']\noutput_dir = 'out'\n", "targets"),
+        (
+            "[[compile]]\nsource_dirs = ['a']\noutput_dir = 'o'\ntargets = ['rust']\n",
+            "unknown target: rust",
+        ),
+        (
+            "[[compile]]\nsource_dirs = ['a']\noutput_dir = 'o'\ntargets = ['go']\n"
+            "protoc_version = '3.0.0'\n",
+            r"unknown job option\(s\): protoc_version",
+        ),
+    ],
+)
+def test_invalid_manifest(tmp_path: Path, content: str, error: str) -> None:
+    (tmp_path / "batch.toml").write_text(content)
+    with pytest.raises(ValueError, match=error):
+        load_manifest(tmp_path / "batch.toml")
+
+
+def test_batch_requires_same_toolchain(tmp_path: Path) -> None:
+    batch = [
+        CompilerOptions(
+            BaseCompilerOptions(tmp_path, tmp_path, protoc_version=version),
+            targets=[CompileTarget(Target.PYTHON)],
+        )
+        for version in ["3.0.0", "3.1.0"]
+    ]
+    with pytest.raises(ValueError, match="protoc_version"):
+        proto_compile.compile_batch(batch)
+
+
+@requires_protoc
+def test_batch_shares_one_toolchain(
+    release_server: ReleaseServer,
+    tmp_path: Path,
+    cache_dir: Path,
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    write_roots(tmp_path)
+    write_protos(tmp_path / "protos")
+    (tmp_path / "batch.toml").write_text(
+        MANIFEST_TOML.replace("3.0.0", DEFAULT_PROTOC_VERSION)
+    )
+    install_protoc(release_server, cache_dir, DEFAULT_PROTOC_VERSION, fake_protoc(""))
+
+    installs: typing.List[typing.List[Target]] = []
+    install_toolchain = proto_compile.install_toolchain
+
+    def counting_install_toolchain(
+        options: CompilerOptions, *args: typing.Any
+    ) -> typing.Any:
+        installs.append([t.language for t in options.targets])
+        return install_toolchain(options, *args)
+
+    monkeypatch.setattr(proto_compile, "install_toolchain", counting_install_toolchain)
+    result = CliRunner().invoke(cli.batch, [str(tmp_path / "batch.toml")])
+    assert result.exit_code == 0, result.output
+    assert installs == [[Target.PYTHON, Target.PYTHON_GRPC, Target.PYTHON]]
+    assert sorted(str(f) for f in rglob(tmp_path / "out")) == [
+        "grpc/role_pb2_grpc.py",
+        "grpc/user_pb2_grpc.py",
+        "protos/a_pb2.py",
+        "protos/b_pb2.py",
+        "protos/common/root_pb2.py",
+        "protos/leaf_pb2.py",
+        "python/role_pb2.py",
+        "python/user_pb2.py",
+    ]
@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+
+"""Tests for project files and the build graph."""
+
+import threading
+import typing
+from pathlib import Path
+
+import pytest
+from click.testing import CliRunner
+from conftest import write_protos
+
+from proto_compile import build, cli, plugins, proto_compile
+from proto_compile.batch import load_manifest
+from proto_compile.build import Step, find_project, run_graph
+from proto_compile.utils import rglob
+
+PROJECT = """
+[options]
+protoc_version = "%s"
+use_cache = false
+remote_cache = "remote"
+
+[[compile]]
+name = "messages"
+source_dirs = ["protos"]
+output_dir = "out/messages"
+targets = ["python"]
+
+[[compile]]
+name = "services"
+source_dirs = ["protos"]
+output_dir = "out/services"
+targets = ["python", {target = "python_grpc", output_dir = "out/grpc"}]
+""" % plugins.embedded_protoc_version()
+
+
+def test_find_project(tmp_path: Path) -> None:
+    (tmp_path / "a" / "b").mkdir(parents=True)
+    assert find_project(tmp_path / "a" / "b") is None
+    (tmp_path / build.PROJECT_FILE).write_text("")
+    assert find_project(tmp_path / "a" / "b") == str(tmp_path / build.PROJECT_FILE)
+
+
+def test_select_jobs(tmp_path: Path) -> None:
+    (tmp_path / build.PROJECT_FILE).write_text(PROJECT)
+    manifest = load_manifest(tmp_path / build.PROJECT_FILE)
+    assert manifest.names == ["messages", "services"]
+    assert manifest.select([]) == manifest.jobs
+    assert manifest.select(["services"]) == manifest.jobs[1:]
+    with pytest.raises(ValueError, match="unknown job"):
+        manifest.select(["other"])
+
+    (tmp_path / build.PROJECT_FILE).write_text(
+        PROJECT.replace('"services"', '"messages"')
+    )
+    with pytest.raises(ValueError, match="duplicate job name: messages"):
+        load_manifest(tmp_path / build.PROJECT_FILE)
+
+
+def test_run_graph() -> None:
+    ran: typing.List[str] = []
+    lock = threading.Lock()
+    installed = threading.Event()
+
+    def record(name: str, added: build.StepResult = None) -> build.Step:
+        def run() -> build.StepResult:
+            with lock:
+                ran.append(name)
+            return added
+
+        return Step(name, run)
+
+    def wait_for_install() -> build.StepResult:
+        # the install runs although the only worker is busy
+        assert installed.wait(timeout=10)
+        return None
+
+    def install() -> build.StepResult:
+        installed.set()
+        return None
+
+    def fail() -> build.StepResult:
+        raise RuntimeError("failed")
+
+    first = record("first")
+    failing = Step("failing", fail)
+    later = record("later", added=[record("added", added=[record("nested")])])
+    later.deps = [first]
+    steps = [
+        first,
+        later,
+        Step(
+            "skipped", lambda: None, deps=[Step("dependent", lambda: None, [failing])]
+        ),
+        Step("waits", wait_for_install),
+        Step("install", install, install=True),
+    ]
+    failures = run_graph(steps, jobs=1)
+    assert [(step.name, str(error)) for step, error in failures] == [
+        ("failing", "failed")
+    ]
+    assert ran.index("first") < ran.index("later") < ran.index("added")
+    assert ran.index("added") < ran.index("nested")
+
+
+def test_build_project(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    write_protos(tmp_path / "protos")
+    (tmp_path / build.PROJECT_FILE).write_text(PROJECT)
+    (tmp_path / "src").mkdir()
+    monkeypatch.chdir(tmp_path / "src")
+
+    result = CliRunner().invoke(cli.build, ["services"])
+    assert result.exit_code == 0, result.output
+    assert not (tmp_path / "out" / "messages").exists()
+    assert "leaf_pb2.py" in [str(f) for f in rglob(tmp_path / "out" / "services")]
+    assert "leaf_pb2_grpc.py" in [str(f) for f in rglob(tmp_path / "out" / "grpc")]
+
+    result = CliRunner().invoke(cli.build, ["other"])
+    assert result.exit_code != 0
+    assert "unknown job(s): other" in result.output
+
+
+def test_build_uses_remote_cache(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    write_protos(tmp_path / "protos")
+    (tmp_path / build.PROJECT_FILE).write_text(PROJECT)
+    manifest = load_manifest(tmp_path / build.PROJECT_FILE)
+    built = build.build(manifest.jobs, jobs=2)
+    expected = sorted(str(f) for f in rglob(tmp_path / "out"))
+    assert sorted(built.outputs) == ["PYTHON", "PYTHON_GRPC"]
+    assert len(built.written) == len(expected)
+    assert built.versions["protoc"] == plugins.embedded_protoc_version()
+    assert built.cache == dict(remote=False)
+
+    def embedded_compiler(*args: typing.Any) -> None:
+        raise AssertionError("the toolchain must not be installed")
+
+    # both jobs are fetched from the remote cache
+    monkeypatch.setattr(build, "embedded_compiler", embedded_compiler)
+    for f in (tmp_path / "out").rglob("*.py"):
+        f.unlink()
+    fetched = build.build(load_manifest(tmp_path / build.PROJECT_FILE).jobs)
+    assert fetched.cache == dict(remote=True)
+    assert sorted(str(f) for f in rglob(tmp_path / "out")) == expected
+
+
+def test_build_failures(tmp_path: Path) -> None:
+    write_protos(tmp_path / "protos")
+    (tmp_path / "protos" / "broken.proto").write_text("syntax = broken")
+    (tmp_path / build.PROJECT_FILE).write_text(PROJECT)
+    manifest = load_manifest(tmp_path / build.PROJECT_FILE)
+    with pytest.raises(proto_compile.CompilationError) as e:
+        build.build(manifest.jobs)
+    assert sorted(target.language.name for target, _ in e.value.failures) == [
+        "PYTHON",
+        "PYTHON",
+        "PYTHON_GRPC",
+    ]
+    # nothing is reconciled
+    assert not (tmp_path / "out").exists()
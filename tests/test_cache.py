@@ -0,0 +1,291 @@
+# -*- coding: utf-8 -*-
+
+"""Tests for the persistent toolchain cache."""
+
+import json
+import os
+import threading
+import time
+import typing
+from pathlib import Path
+
+import pytest
+from conftest import PROTO_DIR, ReleaseServer, fake_protoc, requires_protoc
+
+from proto_compile import plugins, proto_compile
+from proto_compile.cache import ToolchainCache, platform_key
+from proto_compile.options import BaseCompilerOptions, CompilerOptions, CompileTarget
+from proto_compile.plugins import ProtocPlugin
+from proto_compile.utils import ChecksumMismatchError, PathLike, file_sha256, rglob
+from proto_compile.versions import Target
+
+
+def protoc_key(version: str) -> typing.List[str]:
+    return ["protoc", version] + platform_key()
+
+
+def fetch_protoc(cache: ToolchainCache, url: str, version: str) -> Path:
+    return cache.fetch(
+        key=protoc_key(version),
+        url=url,
+        executable="bin/protoc",
+        unarchive_as="protoc",
+    )
+
+
+def test_warm_fetch_does_not_download(
+    release_server: ReleaseServer, tmp_path: Path
+) -> None:
+    url = release_server.add_protoc_release("1.0", fake_protoc("1.0"))
+    cache = ToolchainCache(tmp_path / "cache")
+
+    executable = fetch_protoc(cache, url, "1.0")
+    assert executable.is_file()
+    assert os.access(executable, os.X_OK)
+    assert len(release_server.requests) == 1
+
+    assert fetch_protoc(cache, url, "1.0") == executable
+    assert len(release_server.requests) == 1
+    assert [e.key for e in cache.entries()] == [protoc_key("1.0")]
+    assert not list((cache.root / "tmp").iterdir())
+
+
+def test_sha256_mismatch_is_not_cached(
+    release_server: ReleaseServer, tmp_path: Path
+) -> None:
+    url = release_server.add_protoc_release("1.0", fake_protoc("1.0"))
+    archive = release_server.root / url[len(release_server.url) + 1 :]
+    cache = ToolchainCache(tmp_path / "cache")
+
+    with pytest.raises(ChecksumMismatchError):
+        cache.fetch(protoc_key("1.0"), url, "bin/protoc", "protoc", sha256="0" * 64)
+    assert cache.entries() == []
+
+    cache.fetch(
+        protoc_key("1.0"), url, "bin/protoc", "protoc", sha256=file_sha256(archive)
+    )
+    assert len(cache.entries()) == 1
+
+
+def test_corrupted_entry_is_reinstalled(
+    release_server: ReleaseServer, tmp_path: Path
+) -> None:
+    url = release_server.add_protoc_release("1.0", fake_protoc("1.0"))
+    cache = ToolchainCache(tmp_path / "cache")
+    executable = fetch_protoc(cache, url, "1.0")
+    executable.write_text("corrupted")
+
+    assert cache.lookup(protoc_key("1.0")) is None
+    executable = fetch_protoc(cache, url, "1.0")
+    assert executable.read_text() == fake_protoc("1.0")
+    assert len(release_server.requests) == 2
+
+
+def test_eviction(release_server: ReleaseServer, tmp_path: Path) -> None:
+    cache = ToolchainCache(tmp_path / "cache", max_size=None, max_age=None)
+    for version in ["1.0", "2.0", "3.0"]:
+        url = release_server.add_protoc_release(version, fake_protoc(version))
+        fetch_protoc(cache, url, version)
+
+    # make 1.0 the least recently used and 2.0 stale
+    now = time.time()
+    for version, age in [("1.0", 10), ("2.0", 100), ("3.0", 0)]:
+        metadata = cache.entry_dir(protoc_key(version)) / cache.METADATA
+        os.utime(metadata, (now - age, now - age))
+
+    evicted = cache.evict(max_age=50)
+    assert [e.key for e in evicted] == [protoc_key("2.0")]
+
+    size = sum(e.size for e in cache.entries())
+    evicted = cache.evict(max_size=size - 1)
+    assert [e.key for e in evicted] == [protoc_key("1.0")]
+    assert [e.key for e in cache.entries()] == [protoc_key("3.0")]
+
+
+@requires_protoc
+def test_compile_with_warm_cache(
+    release_server: ReleaseServer, tmp_path: Path, cache_dir: Path
+) -> None:
+    options = BaseCompilerOptions(
+        proto_source_dir=PROTO_DIR, output_dir=tmp_path / "out", cache_dir=cache_dir
+    )
+    url = release_server.add_protoc_release(options.protoc_version, fake_protoc(""))
+    fetch_protoc(ToolchainCache(cache_dir), url, options.protoc_version)
+    release_server.httpd.shutdown()
+
+    proto_compile.compile(
+        CompilerOptions(base_options=options, targets=[CompileTarget(Target.PYTHON)])
+    )
+    assert sorted(str(f) for f in rglob(tmp_path / "out")) == [
+        "example_service_pb2.py",
+        "health_pb2.py",
+    ]
+
+
+class CountingPlugin(ProtocPlugin):
+    cacheable = True
+    installs = 0
+
+    def executable(self) -> typing.Optional[PathLike]:
+        return self.dest_dir / "bin" / "protoc-gen-counting"
+
+    def install(self) -> None:
+        CountingPlugin.installs += 1
+        executable = Path(str(self.executable()))
+        executable.parent.mkdir(parents=True)
+        executable.write_text("#!/bin/sh\nexit 1\n")
+        executable.chmod(0o755)
+
+
+def test_cached_plugin_install(tmp_path: Path) -> None:
+    cache = ToolchainCache(tmp_path / "cache")
+    CountingPlugin.installs = 0
+    for i in range(2):
+        plugin = proto_compile.install_plugin(
+            CountingPlugin(tmp_path / str(i), version="1.0"), cache
+        )
+        assert plugin.dest_dir == cache.entry_dir(plugin.cache_key())
+        assert os.access(str(plugin.executable()), os.X_OK)
+    assert CountingPlugin.installs == 1
+
+    # a different version is a different cache entry
+    proto_compile.install_plugin(CountingPlugin(tmp_path, version="2.0"), cache)
+    assert CountingPlugin.installs == 2
+    assert len(cache.entries()) == 2
+
+
+class SharedPackagePlugin(CountingPlugin):
+    package = "counting"
+
+
+class OtherSharedPackagePlugin(CountingPlugin):
+    package = "counting"
+
+
+def test_bootstrap_installs_concurrently(tmp_path: Path) -> None:
+    cache = ToolchainCache(tmp_path / "cache")
+    CountingPlugin.installs = 0
+    # protoc and the plugin must be installed at the same time
+    barrier = threading.Barrier(2, timeout=10)
+
+    class BlockingPlugin(CountingPlugin):
+        def install(self) -> None:
+            barrier.wait()
+            super().install()
+
+    def install_protoc() -> PathLike:
+        barrier.wait()
+        return "protoc"
+
+    protoc, installed = proto_compile.bootstrap(
+        install_protoc,
+        [
+            BlockingPlugin(tmp_path, version="1.0"),
+            None,
+            SharedPackagePlugin(tmp_path, version="1.0"),
+            OtherSharedPackagePlugin(tmp_path / "other", version="1.0"),
+        ],
+        cache=cache,
+    )
+    assert protoc == "protoc"
+    assert installed[1] is None
+    assert [type(p) for p in installed if p is not None] == [
+        BlockingPlugin,
+        SharedPackagePlugin,
+        OtherSharedPackagePlugin,
+    ]
+    # plugins with the same cache key are only installed once
+    assert CountingPlugin.installs == 2
+    assert installed[2] is not None and installed[3] is not None
+    assert installed[2].dest_dir == installed[3].dest_dir
+
+
+def test_bootstrap_does_not_evict_its_own_installs(tmp_path: Path) -> None:
+    cache = ToolchainCache(tmp_path / "cache", max_size=1)
+    protoc, installed = proto_compile.bootstrap(
+        lambda: "protoc",
+        [
+            CountingPlugin(tmp_path, version="1.0"),
+            SharedPackagePlugin(tmp_path, version="1.0"),
+        ],
+        cache=cache,
+    )
+    assert len(cache.entries()) == 2
+    for plugin in installed:
+        assert plugin is not None
+        assert os.access(str(plugin.executable()), os.X_OK)
+
+
+def test_protoc_release_sha256(release_server: ReleaseServer) -> None:
+    url = release_server.add_protoc_release("1.0", fake_protoc("1.0"))
+    archive = release_server.root / url[len(release_server.url) + 1 :]
+    api = release_server.root / "api"
+    api.mkdir()
+    (api / "v1.0").write_text(
+        json.dumps(
+            dict(
+                assets=[
+                    dict(name="other.zip", digest="sha256:" + "0" * 64),
+                    dict(name=archive.name, digest="sha256:" + file_sha256(archive)),
+                ]
+            )
+        )
+    )
+    api_url = release_server.url + "/api"
+    assert plugins.protoc_release_sha256("1.0", url, api_url) == file_sha256(archive)
+    # unknown releases are not verified
+    assert plugins.protoc_release_sha256("2.0", url, api_url) is None
+
+
+class LatestPlugin(CountingPlugin):
+    latest: typing.Optional[str] = "1.2"
+
+    def latest_version(self) -> typing.Optional[str]:
+        return self.latest
+
+
+def test_latest_plugin_versions_are_pinned(tmp_path: Path) -> None:
+    cache = ToolchainCache(tmp_path / "cache")
+    CountingPlugin.installs = 0
+    plugin = proto_compile.install_plugin(LatestPlugin(tmp_path / "a"), cache)
+    assert plugin.version == "1.2"
+    assert [e.key for e in cache.entries()] == [plugin.cache_key()]
+
+    # a new release is installed instead of reusing the cached one
+    LatestPlugin.latest = "1.3"
+    plugin = proto_compile.install_plugin(LatestPlugin(tmp_path / "b"), cache)
+    assert plugin.version == "1.3"
+    assert CountingPlugin.installs == 2
+
+    # unresolvable latest versions are never cached
+    LatestPlugin.latest = None
+    for i in range(2):
+        plugin = proto_compile.install_plugin(LatestPlugin(tmp_path / str(i)), cache)
+        assert plugin.dest_dir == tmp_path / str(i)
+    assert CountingPlugin.installs == 4
+    assert len(cache.entries()) == 2
+
+
+def test_blobs_and_manifests_count_towards_max_size(tmp_path: Path) -> None:
+    cache = ToolchainCache(tmp_path / "cache", max_age=None)
+    now = time.time()
+    digests = []
+    for i, age in enumerate([30, 10, 20]):
+        src = tmp_path / str(i)
+        src.write_bytes(b"x" * 100)
+        digest = cache.blobs.put(src, digest=str(i) * 64)
+        os.utime(cache.blobs.path(digest), (now - age, now - age))
+        digests.append(digest)
+    cache.manifests_dir.mkdir()
+    manifest = cache.manifests_dir / "build.json"
+    manifest.write_bytes(b"x" * 100)
+
+    cache.evict(max_size=250)
+    assert not cache.blobs.contains(digests[0])
+    assert not cache.blobs.contains(digests[2])
+    assert cache.blobs.contains(digests[1])
+    assert manifest.is_file()
+
+    cache.evict(max_age=5)
+    assert cache.blobs.paths() == []
+    assert manifest.is_file()
@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+
+"""Tests for the compile daemon."""
+
+import json
+import logging
+import socket
+import threading
+import typing
+from pathlib import Path
+
+import pytest
+from click.testing import CliRunner
+from conftest import PROTO_DIR, make_options
+
+from proto_compile import cli, daemon
+from proto_compile.options import CompilerOptions, CompileTarget
+from proto_compile.result import CompileResult, Diagnostic
+from proto_compile.versions import Target
+
+
+def options(tmp_path: Path) -> CompilerOptions:
+    return make_options(
+        tmp_path,
+        [Target.PYTHON, CompileTarget(Target.GO, out_options="paths=source_relative")],
+        proto_source_dir=PROTO_DIR,
+        protoc_version="1.0",
+        cache_dir=tmp_path / "cache",
+        jobs=2,
+    )
+
+
+@pytest.fixture
+def compiled() -> typing.List[CompilerOptions]:
+    return []
+
+
+@pytest.fixture
+def server(
+    tmp_path: Path, compiled: typing.List[CompilerOptions]
+) -> typing.Iterator[daemon.Daemon]:
+    def compile(options: CompilerOptions) -> None:
+        compiled.append(options)
+        print("compiling {}".format(options.proto_source_dir))
+        if options.protoc_version == "broken":
+            raise RuntimeError("protoc failed")
+
+    server = daemon.Daemon(tmp_path / "daemon.sock", compile)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield server
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_options_round_trip(tmp_path: Path) -> None:
+    encoded = daemon.encode_options(options(tmp_path))
+    decoded = daemon.decode_options(encoded)
+    assert daemon.encode_options(decoded) == encoded
+    assert decoded.targets[1].language == Target.GO
+    assert decoded.daemon_socket is None
+
+
+def test_forward(
+    server: daemon.Daemon,
+    compiled: typing.List[CompilerOptions],
+    tmp_path: Path,
+    caplog: pytest.LogCaptureFixture,
+) -> None:
+    caplog.set_level(logging.INFO, logger="proto_compile")
+    assert daemon.forward(options(tmp_path), server.socket_path)
+    assert caplog.messages == ["compiling {}".format(PROTO_DIR)]
+    assert len(compiled) == 1
+    assert compiled[0].output_dir == str(tmp_path / "out")
+
+    failing = options(tmp_path)
+    failing.protoc_version = "broken"
+    with pytest.raises(daemon.DaemonError, match="RuntimeError: protoc failed"):
+        daemon.forward(failing, server.socket_path)
+
+
+def test_result_round_trip() -> None:
+    compiled = CompileResult(
+        outputs=dict(PYTHON=["/out/a_pb2.py"]),
+        timings=dict(bootstrap=0.5),
+        cache=dict(remote=False),
+        diagnostics=[Diagnostic("WARNING", "proto_compile", "warning")],
+    )
+    encoded = daemon.encode_result(compiled)
+    decoded = daemon.decode_result(json.loads(json.dumps(encoded)))
+    assert daemon.encode_result(decoded) == encoded
+    assert decoded.diagnostics[0].level == "WARNING"
+
+
+def test_forward_without_daemon(tmp_path: Path) -> None:
+    assert not daemon.forward(options(tmp_path), tmp_path / "missing.sock")
+
+
+@pytest.mark.parametrize(
+    "error",
+    [
+        socket.timeout("timed out"),
+        PermissionError(13, "denied"),
+        ConnectionResetError(),
+    ],
+)
+def test_forward_falls_back_on_socket_errors(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch, error: OSError
+) -> None:
+    def request(*args: typing.Any) -> None:
+        raise error
+
+    monkeypatch.setattr(daemon, "_request", request)
+    assert daemon.forward(options(tmp_path), tmp_path / "daemon.sock") is None
+
+
+def test_stale_socket_is_replaced(tmp_path: Path, server: daemon.Daemon) -> None:
+    with pytest.raises(daemon.DaemonError):
+        daemon.Daemon(server.socket_path, print)
+
+    stale = tmp_path / "stale.sock"
+    stale.touch()
+    daemon.Daemon(stale, print).server_close()
+    assert not stale.exists()
+
+
+def test_cli_forwards_to_daemon(
+    server: daemon.Daemon,
+    compiled: typing.List[CompilerOptions],
+    tmp_path: Path,
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    monkeypatch.setenv(daemon.SOCKET_ENV, str(server.socket_path))
+    result = CliRunner().invoke(
+        cli.proto_compile, [PROTO_DIR, str(tmp_path / "out"), "python-grpc"]
+    )
+    assert result.exit_code == 0, result.output
+    assert [t.language for t in compiled[0].targets] == [
+        Target.PYTHON,
+        Target.PYTHON_GRPC,
+    ]
+
+    result = CliRunner().invoke(
+        cli.proto_compile,
+        [PROTO_DIR, str(tmp_path / "out"), "--no-daemon", "--help"],
+    )
+    assert result.exit_code == 0
+    assert len(compiled) == 1
@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+
+"""Tests for the descriptor set pipeline."""
+
+import filecmp
+import typing
+from pathlib import Path
+
+import pytest
+from conftest import (
+    ReleaseServer,
+    fake_protoc,
+    install_protoc,
+    make_options,
+    requires_protoc,
+    write_protos,
+)
+
+from proto_compile import descriptors, proto_compile
+from proto_compile.cache import ToolchainCache
+from proto_compile.options import CompileTarget
+from proto_compile.versions import DEFAULT_PROTOC_VERSION, Target
+
+
+def test_import_closure(tmp_path: Path) -> None:
+    write_protos(tmp_path / "protos")
+    include_dirs = [str(tmp_path / "protos")]
+    closure = descriptors.import_closure(include_dirs, [tmp_path / "protos/b.proto"])
+    assert sorted(closure) == ["a.proto", "b.proto", "common/root.proto"]
+    assert descriptors.proto_name(include_dirs, closure["a.proto"]) == "a.proto"
+
+
+def test_key_changes_with_imports(tmp_path: Path) -> None:
+    write_protos(tmp_path / "protos")
+    include_dirs = [str(tmp_path / "protos")]
+    files = [tmp_path / "protos" / "b.proto"]
+    key = descriptors.descriptor_set_key("protoc-3", include_dirs, files)
+    assert key == descriptors.descriptor_set_key("protoc-3", include_dirs, files)
+    assert key != descriptors.descriptor_set_key("protoc-4", include_dirs, files)
+    # transitive import of b.proto
+    with open(tmp_path / "protos" / "common" / "root.proto", "a") as f:
+        f.write("message Other {}\n")
+    assert key != descriptors.descriptor_set_key("protoc-3", include_dirs, files)
+
+
+def compile_python(source_dir: Path, output_dir: Path, **options: typing.Any) -> None:
+    proto_compile.compile(
+        make_options(
+            source_dir,
+            [
+                Target.PYTHON,
+                CompileTarget(Target.PYTHON_GRPC, output_dir=output_dir / "grpc"),
+            ],
+            proto_source_dir=source_dir,
+            output_dir=output_dir,
+            use_cache=True,
+            protoc_version=None,
+            embedded_protoc=False,
+            jobs=2,
+            **options,
+        )
+    )
+
+
+@requires_protoc
+def test_descriptor_set_output_is_identical(
+    release_server: ReleaseServer, tmp_path: Path, cache_dir: Path
+) -> None:
+    source_dir = tmp_path / "protos"
+    write_protos(source_dir)
+    install_protoc(release_server, cache_dir, DEFAULT_PROTOC_VERSION, fake_protoc(""))
+
+    compile_python(source_dir, tmp_path / "parsed")
+    compile_python(
+        source_dir,
+        tmp_path / "descriptors",
+        descriptor_set_out=tmp_path / "set.pb",
+    )
+    comparison = filecmp.dircmp(tmp_path / "parsed", tmp_path / "descriptors")
+    assert comparison.left_only == comparison.right_only == []
+    # descriptor sets always contain the json names of the fields, which
+    # only changes the serialized descriptors in the *_pb2.py files
+    assert (
+        filecmp.dircmp(
+            tmp_path / "parsed" / "grpc", tmp_path / "descriptors" / "grpc"
+        ).diff_files
+        == []
+    )
+    assert (tmp_path / "descriptors" / "common" / "root_pb2.py").exists()
+
+    cached = list(ToolchainCache(cache_dir).descriptors_dir.glob("*.pb"))
+    assert len(cached) == 1
+    assert (tmp_path / "set.pb").read_bytes() == cached[0].read_bytes()
+
+
+@requires_protoc
+def test_descriptor_set_is_cached(
+    release_server: ReleaseServer, tmp_path: Path, cache_dir: Path
+) -> None:
+    source_dir = tmp_path / "protos"
+    write_protos(source_dir)
+    install_protoc(release_server, cache_dir, DEFAULT_PROTOC_VERSION, fake_protoc(""))
+    descriptors_dir = ToolchainCache(cache_dir).descriptors_dir
+
+    compile_python(source_dir, tmp_path / "out", descriptor_set=True)
+    (cached,) = descriptors_dir.glob("*.pb")
+    cached.write_bytes(b"")
+    # an invalid descriptor set proves that protoc reads the cached set
+    (tmp_path / "out" / "a_pb2.py").unlink()
+    with pytest.raises(proto_compile.CompilationError):
+        compile_python(source_dir, tmp_path / "out", descriptor_set=True)
+    assert not (tmp_path / "out" / "a_pb2.py").exists()
+
+    (source_dir / "leaf.proto").write_text('syntax = "proto3";\nmessage Leaf2 {}\n')
+    compile_python(source_dir, tmp_path / "out", descriptor_set=True)
+    assert len(list(descriptors_dir.glob("*.pb"))) == 2
+    assert "Leaf2" in (tmp_path / "out" / "leaf_pb2.py").read_text()
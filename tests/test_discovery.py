@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+
+"""Tests for the discovery of .proto files."""
+
+import os
+import typing
+from pathlib import Path
+
+import pytest
+
+from proto_compile import discovery
+from proto_compile.discovery import discover
+
+
+def touch(root: Path, *paths: str) -> None:
+    for path in paths:
+        (root / path).parent.mkdir(parents=True, exist_ok=True)
+        (root / path).write_text("")
+
+
+def relative(root: Path, paths: typing.List[str]) -> typing.List[str]:
+    return [os.path.relpath(path, root) for path in paths]
+
+
+def test_default_excludes(tmp_path: Path) -> None:
+    touch(
+        tmp_path,
+        "a.proto",
+        "api/v1/b.proto",
+        "api/v1/b.txt",
+        "node_modules/dep/c.proto",
+        ".git/d.proto",
+    )
+    assert relative(tmp_path, discover(tmp_path)) == ["a.proto", "api/v1/b.proto"]
+
+
+def test_gitignore(tmp_path: Path) -> None:
+    touch(
+        tmp_path,
+        "a.proto",
+        "generated/b.proto",
+        "api/c.proto",
+        "api/tmp_d.proto",
+        "api/tmp_keep.proto",
+    )
+    (tmp_path / ".gitignore").write_text("# comment\ngenerated/\n")
+    (tmp_path / "api" / ".gitignore").write_text("tmp_*.proto\n!tmp_keep.proto\n")
+    assert relative(tmp_path, discover(tmp_path)) == [
+        "a.proto",
+        "api/c.proto",
+        "api/tmp_keep.proto",
+    ]
+    assert len(discover(tmp_path, gitignore=False)) == 5
+
+
+def test_include_and_exclude(tmp_path: Path) -> None:
+    touch(tmp_path, "a.proto", "api/v1/b.proto", "api/c.proto", "api/v1/internal.proto")
+    assert relative(
+        tmp_path,
+        discover(tmp_path, include=["api/**/*.proto"], exclude=["internal.proto"]),
+    ) == ["api/c.proto", "api/v1/b.proto"]
+    assert relative(tmp_path, discover(tmp_path, exclude=["/api/v1"])) == [
+        "a.proto",
+        "api/c.proto",
+    ]
+
+
+@pytest.mark.parametrize(
+    "pattern,path,is_dir,matches",
+    [
+        ("*.proto", "a/b.proto", False, True),
+        ("/b.proto", "a/b.proto", False, False),
+        ("a/*.proto", "a/b/c.proto", False, False),
+        ("a/**/c.proto", "a/b/c.proto", False, True),
+        ("a/**/c.proto", "a/c.proto", False, True),
+        ("build/", "build", False, False),
+        ("build/", "build", True, True),
+        ("file_[0-9].proto", "file_1.proto", False, True),
+        ("file_[!0-9].proto", "file_1.proto", False, False),
+    ],
+)
+def test_patterns(pattern: str, path: str, is_dir: bool, matches: bool) -> None:
+    rules = discovery.IgnoreRules().extended([pattern])
+    assert rules.matches(path, is_dir=is_dir) == matches
+
+
+def test_index_only_rescans_changed_dirs(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    source_dir = tmp_path / "protos"
+    touch(source_dir, "a/a.proto", "b/b.proto", "c/c.proto")
+    index = tmp_path / "index.json"
+    assert len(discover(source_dir, index_path=index)) == 3
+
+    scanned: typing.List[str] = []
+    scandir = os.scandir
+
+    def counting_scandir(path: str) -> typing.Any:
+        scanned.append(os.path.relpath(path, source_dir))
+        return scandir(path)
+
+    monkeypatch.setattr(os, "scandir", counting_scandir)
+    assert len(discover(source_dir, index_path=index)) == 3
+    assert scanned == []
+
+    touch(source_dir, "b/d.proto")
+    assert relative(source_dir, discover(source_dir, index_path=index)) == [
+        "a/a.proto",
+        "b/b.proto",
+        "b/d.proto",
+        "c/c.proto",
+    ]
+    assert scanned == ["b"]
+
+
+def test_index_picks_up_gitignore_edits(tmp_path: Path) -> None:
+    source_dir = tmp_path / "protos"
+    touch(source_dir, "a/a.proto", "a/nested/b.proto")
+    (source_dir / ".gitignore").write_text("c.proto\n")
+    index = tmp_path / "index.json"
+    assert len(discover(source_dir, index_path=index)) == 2
+
+    (source_dir / ".gitignore").write_text("b.proto\n")
+    # the mtime granularity of some file systems is coarse
+    os.utime(source_dir / ".gitignore", ns=(1, 1))
+    assert relative(source_dir, discover(source_dir, index_path=index)) == ["a/a.proto"]
+
+
+def test_walk_dirs(tmp_path: Path) -> None:
+    touch(
+        tmp_path,
+        ".gitignore",
+        "a/b/b.proto",
+        "a/skip/c/c.proto",
+        "gen/c/c.proto",
+        "node_modules/x/x.proto",
+    )
+    (tmp_path / ".gitignore").write_text("gen/\n")
+
+    def walk(**kwargs: typing.Any) -> typing.List[str]:
+        dirs = discovery.walk_dirs(tmp_path, exclude=["skip/"], **kwargs)
+        return sorted(relative(tmp_path, dirs))
+
+    assert walk() == [".", "a", "a/b"]
+    assert walk(start=tmp_path / "a" / "b") == ["a/b"]
+    assert walk(start=tmp_path / "a" / "skip" / "c") == []
+    assert walk(start=tmp_path / "gen") == []
+    assert walk(start=tmp_path / "gen", gitignore=False) == ["gen", "gen/c"]
+    assert walk(start=tmp_path.parent) == []
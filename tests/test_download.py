@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+
+"""Tests for the native downloader."""
+
+import os
+import zipfile
+from pathlib import Path
+
+import pytest
+from conftest import ReleaseServer, fake_protoc
+
+from proto_compile.utils import DownloadError, download, download_executable, extract
+
+
+def test_download_resumes_partial_file(
+    release_server: ReleaseServer, tmp_path: Path
+) -> None:
+    content = os.urandom(1 << 17)
+    (release_server.root / "artifact").write_bytes(content)
+    dest = tmp_path / "artifact"
+    (tmp_path / "artifact.part").write_bytes(content[:1000])
+
+    download(release_server.url + "/artifact", dest)
+    assert dest.read_bytes() == content
+    assert release_server.ranges == ["bytes=1000-"]
+    assert not (tmp_path / "artifact.part").exists()
+
+
+def test_download_restarts_invalid_partial_file(
+    release_server: ReleaseServer, tmp_path: Path
+) -> None:
+    (release_server.root / "artifact").write_bytes(b"content")
+    dest = tmp_path / "artifact"
+    (tmp_path / "artifact.part").write_bytes(b"longer than the content")
+
+    download(release_server.url + "/artifact", dest, backoff=0)
+    assert dest.read_bytes() == b"content"
+    assert release_server.ranges == ["bytes=23-", None]
+
+    # without a partial download, 416 is an error
+    release_server.failures = 1
+    release_server.failure_status = 416
+    with pytest.raises(DownloadError, match="416"):
+        download(release_server.url + "/artifact", tmp_path / "b", backoff=0)
+    assert not (tmp_path / "b.part").exists()
+
+
+def test_download_retries_server_errors(
+    release_server: ReleaseServer, tmp_path: Path
+) -> None:
+    (release_server.root / "artifact").write_bytes(b"content")
+    release_server.failures = 2
+    dest = download(release_server.url + "/artifact", tmp_path / "a", backoff=0)
+    assert dest.read_bytes() == b"content"
+    assert len(release_server.requests) == 3
+
+
+def test_download_gives_up(release_server: ReleaseServer, tmp_path: Path) -> None:
+    (release_server.root / "artifact").write_bytes(b"content")
+    release_server.failures = 3
+    with pytest.raises(DownloadError):
+        download(release_server.url + "/artifact", tmp_path / "a", retries=2, backoff=0)
+    # client errors are not retried
+    with pytest.raises(DownloadError):
+        download(release_server.url + "/missing", tmp_path / "b", backoff=0)
+    assert len(release_server.requests) == 4
+
+
+def test_download_executable_extracts_members(
+    release_server: ReleaseServer, tmp_path: Path
+) -> None:
+    dest_dir = tmp_path / "dest"
+    dest_dir.mkdir()
+    url = release_server.add_protoc_release("1.0", fake_protoc("1.0"))
+    protoc = download_executable(
+        url=url,
+        executable="bin/protoc",
+        dest_dir=dest_dir,
+        unarchive_as="protoc",
+        members=["bin/protoc"],
+    )
+    assert Path(protoc) == dest_dir / "protoc" / "bin" / "protoc"
+    assert os.access(protoc, os.X_OK)
+    assert not (dest_dir / "protoc" / "include").exists()
+    # the downloaded archive is removed after extraction
+    assert sorted(os.listdir(dest_dir)) == ["protoc"]
+
+
+def test_extract_rejects_path_traversal(tmp_path: Path) -> None:
+    archive = tmp_path / "evil.zip"
+    with zipfile.ZipFile(archive, "w") as zf:
+        zf.writestr("../evil", "content")
+    with pytest.raises(ValueError):
+        extract(archive, tmp_path / "out")
+    assert not (tmp_path / "evil").exists()
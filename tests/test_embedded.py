@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+
+"""Tests for compiling with the protoc bundled with grpc_tools."""
+
+import subprocess
+import sys
+import typing
+from pathlib import Path
+
+import pytest
+from conftest import EMBEDDED_VERSION, make_options, write_protos
+
+from proto_compile import proto_compile
+from proto_compile.utils import rglob
+from proto_compile.versions import Target
+
+
+def test_embedded_protoc_version() -> None:
+    output = subprocess.check_output(
+        [sys.executable, "-m", "grpc_tools.protoc", "--version"], text=True
+    )
+    assert EMBEDDED_VERSION == output.split()[-1]
+
+
+def test_compile_without_protoc_download(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    def install_protoc(*args: typing.Any) -> None:
+        raise AssertionError("protoc must not be downloaded")
+
+    monkeypatch.setattr(proto_compile, "install_protoc", install_protoc)
+    write_protos(tmp_path / "protos")
+    proto_compile.compile(
+        make_options(
+            tmp_path,
+            [Target.PYTHON, Target.PYTHON_GRPC],
+            protoc_version=EMBEDDED_VERSION,
+        )
+    )
+    outputs = [Path(f).name for f in rglob(tmp_path / "out")]
+    assert "a_pb2.py" in outputs
+    assert "a_pb2_grpc.py" in outputs
+
+
+def test_falls_back_to_protoc_release(tmp_path: Path) -> None:
+    assert proto_compile.embedded_compiler(
+        make_options(tmp_path, [Target.PYTHON], protoc_version=EMBEDDED_VERSION)
+    )
+    # the requested version does not match the bundled protoc
+    assert not proto_compile.embedded_compiler(
+        make_options(tmp_path, [Target.PYTHON], protoc_version="3.0.0")
+    )
+    # the bundled protoc cannot generate java
+    assert not proto_compile.embedded_compiler(
+        make_options(
+            tmp_path, [Target.PYTHON, Target.JAVA], protoc_version=EMBEDDED_VERSION
+        )
+    )
+    assert not proto_compile.embedded_compiler(
+        make_options(
+            tmp_path,
+            [Target.PYTHON],
+            protoc_version=EMBEDDED_VERSION,
+            embedded_protoc=False,
+        )
+    )
@@ -0,0 +1,233 @@
+# -*- coding: utf-8 -*-
+
+"""Tests for incremental compilation."""
+
+import os
+import shutil
+import typing
+from pathlib import Path
+
+import pytest
+from conftest import (
+    PROTO_DIR,
+    SYSTEM_PROTOC,
+    ReleaseServer,
+    install_protoc,
+    make_options,
+    requires_protoc,
+    write_protos,
+)
+
+from proto_compile import incremental, proto_compile
+from proto_compile.cache import ToolchainCache
+from proto_compile.imports import ImportGraph, parse_imports
+from proto_compile.options import CompileTarget
+from proto_compile.utils import PathLike, rglob
+from proto_compile.versions import Target
+
+
+def counting_protoc(log: Path) -> str:
+    """A protoc wrapper that records every compilation"""
+    return '#!/bin/sh\n[ "$1" = "--version" ] || echo "$@" >> %s\nexec %s "$@"\n' % (
+        log,
+        SYSTEM_PROTOC,
+    )
+
+
+@requires_protoc
+def test_incremental_rebuild(
+    release_server: ReleaseServer, tmp_path: Path, cache_dir: Path
+) -> None:
+    log = tmp_path / "protoc.log"
+    source_dir = tmp_path / "protos"
+    shutil.copytree(PROTO_DIR, source_dir)
+    out_dir = tmp_path / "out"
+    options = make_options(
+        tmp_path,
+        proto_source_dir=source_dir,
+        output_dir=out_dir,
+        cache_dir=cache_dir,
+        use_cache=True,
+        protoc_version=None,
+        incremental=True,
+    )
+    install_protoc(
+        release_server, cache_dir, options.protoc_version, counting_protoc(log)
+    )
+
+    def runs() -> int:
+        return len(log.read_text().splitlines()) if log.exists() else 0
+
+    proto_compile.compile(options)
+    assert runs() == 1
+
+    # nothing changed, but the blobs of the outputs are marked as used
+    blobs = ToolchainCache(cache_dir).blobs
+    for blob in blobs.paths():
+        os.utime(blob, (0, 0))
+    proto_compile.compile(options)
+    assert runs() == 1
+    assert len(blobs.paths()) == 2
+    assert all(blob.stat().st_mtime > 0 for blob in blobs.paths())
+
+    # missing and modified outputs are restored from the cache
+    generated = out_dir / "health_pb2.py"
+    expected = generated.read_text()
+    generated.unlink()
+    (out_dir / "example_service_pb2.py").write_text("modified")
+    proto_compile.compile(options)
+    assert runs() == 1
+    assert generated.read_text() == expected
+    assert (out_dir / "example_service_pb2.py").read_text() != "modified"
+
+    # changing an input recompiles
+    with open(source_dir / "health.proto", "a") as f:
+        f.write("\n// changed\n")
+    proto_compile.compile(options)
+    assert runs() == 2
+
+    # changing the target options recompiles
+    options.targets = [CompileTarget(Target.PYTHON, out_options="pyi_out")]
+    proto_compile.compile(options)
+    assert runs() == 3
+    assert sorted(str(f) for f in rglob(out_dir)) == [
+        "example_service_pb2.py",
+        "example_service_pb2.pyi",
+        "health_pb2.py",
+        "health_pb2.pyi",
+    ]
+
+
+def test_import_graph(tmp_path: Path) -> None:
+    write_protos(tmp_path)
+    assert parse_imports(tmp_path / "a.proto") == ["common/root.proto"]
+    assert parse_imports(tmp_path / "b.proto") == ["a.proto"]
+    # comment markers in strings do not start comments
+    (tmp_path / "c.proto").write_text(
+        'syntax = "proto3";\noption go_package = "http://example.com/*";\n'
+        'import "a.proto"; // import "leaf.proto";\n'
+        "option (x) = '/*';\nimport \"b.proto\";\n/* */\n"
+    )
+    assert parse_imports(tmp_path / "c.proto") == ["a.proto", "b.proto"]
+
+    files = [str(tmp_path / f) for f in ["common/root.proto", "a.proto", "b.proto"]]
+    graph = ImportGraph.from_files(tmp_path, files + [str(tmp_path / "leaf.proto")])
+    assert graph.affected([str(tmp_path / "leaf.proto")]) == {
+        str(tmp_path / "leaf.proto")
+    }
+    assert graph.affected([str(tmp_path / "a.proto")]) == set(files[1:])
+    assert graph.affected([str(tmp_path / "common/root.proto")]) == set(files)
+
+
+@requires_protoc
+def test_partial_rebuild(
+    release_server: ReleaseServer,
+    tmp_path: Path,
+    cache_dir: Path,
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    log = tmp_path / "protoc.log"
+    source_dir = tmp_path / "protos"
+    write_protos(source_dir)
+    out_dir = tmp_path / "out"
+    options = make_options(
+        tmp_path,
+        proto_source_dir=source_dir,
+        output_dir=out_dir,
+        cache_dir=cache_dir,
+        use_cache=True,
+        protoc_version=None,
+        incremental=True,
+    )
+    options.clear_output_dirs = True
+    install_protoc(
+        release_server, cache_dir, options.protoc_version, counting_protoc(log)
+    )
+
+    def compiled() -> typing.List[str]:
+        arguments = log.read_text().splitlines()[-1].split()
+        return sorted(
+            os.path.relpath(arg, source_dir)
+            for arg in arguments
+            if arg.endswith(".proto")
+        )
+
+    outputs = ["a_pb2.py", "b_pb2.py", "common/root_pb2.py", "leaf_pb2.py"]
+    proto_compile.compile(options)
+    assert compiled() == ["a.proto", "b.proto", "common/root.proto", "leaf.proto"]
+
+    # editing a leaf only recompiles the leaf
+    with open(source_dir / "leaf.proto", "a") as f:
+        f.write("message Leaf2 {}\n")
+    proto_compile.compile(options)
+    assert compiled() == ["leaf.proto"]
+    assert sorted(str(f) for f in rglob(out_dir)) == outputs
+    assert "Leaf2" in (out_dir / "leaf_pb2.py").read_text()
+
+    # editing a shared root recompiles everything that imports it
+    with open(source_dir / "common" / "root.proto", "a") as f:
+        f.write("message Root2 {}\n")
+    proto_compile.compile(options)
+    assert compiled() == ["a.proto", "b.proto", "common/root.proto"]
+    assert sorted(str(f) for f in rglob(out_dir)) == outputs
+
+    # the imports of unchanged files are not parsed again
+    def parse_imports(path: PathLike) -> typing.List[str]:
+        raise AssertionError("%s was parsed" % path)
+
+    monkeypatch.setattr(incremental, "parse_imports", parse_imports)
+    runs = len(log.read_text().splitlines())
+    proto_compile.compile(options)
+    assert len(log.read_text().splitlines()) == runs
+
+
+def test_include_dir_changes_recompile(tmp_path: Path, cache_dir: Path) -> None:
+    (tmp_path / "vendor").mkdir()
+    (tmp_path / "vendor" / "dep.proto").write_text(
+        'syntax = "proto3";\nmessage Dep {}\n'
+    )
+    write_protos(tmp_path / "protos")
+    with open(tmp_path / "protos" / "leaf.proto", "a") as f:
+        f.write('import "dep.proto";\nmessage UsesDep { Dep dep = 1; }\n')
+    options = make_options(
+        tmp_path, cache_dir=cache_dir, use_cache=True, incremental=True
+    )
+    options.include_dirs = [str(tmp_path / "vendor")]
+
+    assert proto_compile.compile(options).cache == dict(incremental=False)
+    assert proto_compile.compile(options).cache == dict(incremental=True)
+
+    # only the importer is recompiled, the vendored import is never compiled
+    with open(tmp_path / "vendor" / "dep.proto", "a") as f:
+        f.write("message Dep2 {}\n")
+    compiled = proto_compile.compile(options)
+    assert compiled.cache == dict(incremental=False)
+    assert [os.path.basename(f) for f in compiled.outputs["PYTHON"]] == ["leaf_pb2.py"]
+    assert not (tmp_path / "out" / "dep_pb2.py").exists()
+
+
+def test_toolchain_changes_recompile(tmp_path: Path, cache_dir: Path) -> None:
+    write_protos(tmp_path / "protos")
+    options = make_options(
+        tmp_path, cache_dir=cache_dir, use_cache=True, incremental=True
+    )
+
+    assert proto_compile.compile(options).cache == dict(incremental=False)
+    assert proto_compile.compile(options).cache == dict(incremental=True)
+    fingerprint = incremental.toolchain_fingerprint(options)
+    options.descriptor_set = True
+    assert proto_compile.compile(options).cache["incremental"] is False
+    assert proto_compile.compile(options).cache["incremental"] is True
+    options.embedded_protoc = False
+    assert incremental.toolchain_fingerprint(options) != fingerprint
+    options.descriptor_set = False
+    assert incremental.toolchain_fingerprint(options) != fingerprint
+
+
+def test_incremental_requires_cache(tmp_path: Path) -> None:
+    options = make_options(
+        tmp_path, proto_source_dir=PROTO_DIR, cache_dir=tmp_path, incremental=True
+    )
+    with pytest.raises(ValueError):
+        proto_compile.compile(options)
+    assert not (tmp_path / "manifests").exists()
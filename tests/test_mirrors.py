@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+
+"""Tests for the release mirror, offline mode and prefetching."""
+
+import hashlib
+import os
+import typing
+from pathlib import Path
+
+import pytest
+from conftest import (
+    ReleaseServer,
+    fake_protoc,
+    install_protoc,
+    make_options,
+    requires_protoc,
+)
+
+from proto_compile import mirrors, plugins, prefetch, proto_compile
+from proto_compile.utils import DownloadError
+from proto_compile.versions import DEFAULT_PROTOC_VERSION
+
+
+def compile_offline(tmp_path: Path, mirror: typing.Optional[Path] = None) -> None:
+    source_dir = tmp_path / "protos"
+    source_dir.mkdir(exist_ok=True)
+    (source_dir / "a.proto").write_text('syntax = "proto3";\nmessage A {}\n')
+    proto_compile.compile(
+        make_options(
+            tmp_path,
+            use_cache=True,
+            protoc_version=None,
+            embedded_protoc=False,
+            mirror=mirror,
+            offline=True,
+        )
+    )
+
+
+def test_mirror_url(tmp_path: Path) -> None:
+    assert mirrors.mirror_url(tmp_path) == tmp_path.as_uri()
+    assert mirrors.mirror_url("http://mirror/releases/") == "http://mirror/releases"
+    assert mirrors.base_url("https://up", "protoc") == "https://up"
+    assert mirrors.base_url("https://up", "protoc", "file:///m") == "file:///m/protoc"
+    with pytest.raises(mirrors.OfflineError):
+        mirrors.base_url("https://up", "protoc", offline=True)
+
+
+def test_parse_platform() -> None:
+    assert prefetch.parse_platform("Darwin-arm64") == ("darwin", "arm64")
+    assert str(prefetch.parse_platform("linux-aarch64")) == "linux-aarch64"
+    with pytest.raises(ValueError):
+        prefetch.parse_platform("linux")
+
+
+def test_offline_without_mirror_fails_on_cache_miss(
+    tmp_path: Path, cache_dir: Path
+) -> None:
+    with pytest.raises(mirrors.OfflineError):
+        compile_offline(tmp_path)
+
+
+@requires_protoc
+def test_offline_uses_cached_protoc(
+    release_server: ReleaseServer, tmp_path: Path, cache_dir: Path
+) -> None:
+    install_protoc(release_server, cache_dir, DEFAULT_PROTOC_VERSION, fake_protoc(""))
+    requests = len(release_server.requests)
+    compile_offline(tmp_path)
+    assert (tmp_path / "out" / "a_pb2.py").exists()
+    assert len(release_server.requests) == requests
+
+
+@requires_protoc
+def test_prefetch_and_install_from_mirror(
+    release_server: ReleaseServer, tmp_path: Path, cache_dir: Path
+) -> None:
+    url = release_server.add_protoc_release(
+        DEFAULT_PROTOC_VERSION, fake_protoc(""), subdir=mirrors.PROTOC_DIR
+    )
+    archive = release_server.root / url[len(release_server.url) + 1 :]
+    sha256 = hashlib.sha256(archive.read_bytes()).hexdigest()
+    Path(str(archive) + mirrors.SHA256_SUFFIX).write_text(sha256 + "\n")
+    grpc_web = plugins.grpc_web_release_url(
+        "1.0", base_url=release_server.url + "/" + mirrors.GRPC_WEB_DIR
+    )
+    grpc_web_path = release_server.root / grpc_web[len(release_server.url) + 1 :]
+    grpc_web_path.parent.mkdir(parents=True)
+    grpc_web_path.write_bytes(b"#!/bin/sh\n")
+
+    mirror_dir = tmp_path / "mirror"
+    fetched = prefetch.prefetch(
+        mirror_dir,
+        protoc_versions=[DEFAULT_PROTOC_VERSION],
+        grpc_web_versions=["1.0"],
+        source=release_server.url,
+    )
+    assert len(fetched) == 2
+    assert mirrors.mirror_sha256(Path(fetched[0]).as_uri()) == sha256
+    # mirrored artifacts are not downloaded again
+    requests = len(release_server.requests)
+    assert prefetch.prefetch(mirror_dir, [DEFAULT_PROTOC_VERSION], ["1.0"]) == []
+    assert len(release_server.requests) == requests
+
+    # installs from the local mirror and verifies the stored sha256
+    compile_offline(tmp_path, mirror=mirror_dir)
+    assert (tmp_path / "out" / "a_pb2.py").exists()
+    assert len(release_server.requests) == requests
+
+    plugin = plugins.GrpcWebPlugin(
+        tmp_path / "plugin", version="1.0", mirror=mirror_dir, offline=True
+    )
+    plugin.install()
+    assert os.access(plugin.executable(), os.X_OK)
+
+
+def test_prefetch_verifies_sha256(
+    release_server: ReleaseServer, tmp_path: Path
+) -> None:
+    url = release_server.add_protoc_release(
+        "1.0", fake_protoc("1.0"), subdir=mirrors.PROTOC_DIR
+    )
+    archive = release_server.root / url[len(release_server.url) + 1 :]
+    Path(str(archive) + mirrors.SHA256_SUFFIX).write_text("0" * 64 + "\n")
+
+    # a local dir is a mirror as well
+    with pytest.raises(DownloadError, match=r"2 artifact(?s:.*)sha256 of"):
+        prefetch.prefetch(
+            tmp_path / "mirror", ["1.0", "2.0"], [], source=release_server.root
+        )
+    assert not any((tmp_path / "mirror").rglob("*.zip"))
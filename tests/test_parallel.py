@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+
+"""Tests for parallel per-target compilation."""
+
+import filecmp
+import shutil
+import subprocess
+import threading
+import typing
+from pathlib import Path
+
+import pytest
+from click.testing import CliRunner
+from conftest import (
+    PROTO_DIR,
+    ReleaseServer,
+    fake_protoc,
+    install_protoc,
+    requires_protoc,
+    write_protos,
+)
+
+from proto_compile import cli, proto_compile
+from proto_compile.imports import ImportGraph, partition
+from proto_compile.options import BaseCompilerOptions, CompilerOptions, CompileTarget
+from proto_compile.plugins import ProtoCompiler
+from proto_compile.utils import rglob
+from proto_compile.versions import Target
+
+
+class BarrierCompiler(ProtoCompiler):
+    """Only succeeds if all targets are compiled at the same time"""
+
+    def __init__(self, parties: int, fail: bool = False) -> None:
+        self.barrier = threading.Barrier(parties, timeout=10)
+        self.fail = fail
+        self.arguments: typing.List[typing.List[str]] = []
+
+    def compile(self, arguments: typing.List[str], verbosity: int = 0) -> None:
+        self.arguments.append(arguments)
+        self.barrier.wait()
+        if self.fail and any("python" in arg for arg in arguments):
+            raise RuntimeError("python failed")
+
+
+def invocations(compiler: ProtoCompiler) -> typing.List[proto_compile.TargetInvocation]:
+    return [
+        proto_compile.TargetInvocation(
+            [CompileTarget(target)], compiler, ["--{}_out=out".format(target.value)]
+        )
+        for target in [Target.GO, Target.PYTHON, Target.JAVA]
+    ]
+
+
+def test_targets_compile_concurrently() -> None:
+    compiler = BarrierCompiler(parties=3)
+    proto_compile.compile_targets(invocations(compiler), ["a.proto"], jobs=3)
+    assert sorted(compiler.arguments) == [
+        ["a.proto", "--go_out=out"],
+        ["a.proto", "--java_out=out"],
+        ["a.proto", "--python_out=out"],
+    ]
+
+
+def test_target_failures_are_collected() -> None:
+    compiler = BarrierCompiler(parties=3, fail=True)
+    with pytest.raises(proto_compile.CompilationError) as e:
+        proto_compile.compile_targets(invocations(compiler), ["a.proto"], jobs=0)
+    assert [target.language for target, _ in e.value.failures] == [Target.PYTHON]
+    # the other targets were still compiled
+    assert len(compiler.arguments) == 3
+
+
+@requires_protoc
+def test_compile_with_jobs(
+    release_server: ReleaseServer, tmp_path: Path, cache_dir: Path
+) -> None:
+    options = BaseCompilerOptions(
+        proto_source_dir=PROTO_DIR, output_dir=tmp_path / "out", jobs=2
+    )
+    install_protoc(release_server, cache_dir, options.protoc_version, fake_protoc(""))
+    release_server.httpd.shutdown()
+
+    proto_compile.compile(
+        CompilerOptions(
+            base_options=options,
+            targets=[
+                CompileTarget(Target.PYTHON),
+                CompileTarget(Target.PYTHON_GRPC, output_dir=tmp_path / "grpc"),
+            ],
+        )
+    )
+    assert sorted(str(f) for f in rglob(tmp_path / "out")) == [
+        "example_service_pb2.py",
+        "health_pb2.py",
+    ]
+    assert sorted(str(f) for f in rglob(tmp_path / "grpc")) == [
+        "example_service_pb2_grpc.py",
+        "health_pb2_grpc.py",
+    ]
+
+
+def test_partition(tmp_path: Path) -> None:
+    write_protos(tmp_path)
+    for name in ["x", "y", "z"]:
+        (tmp_path / ("%s.proto" % name)).write_text('syntax = "proto3";\n')
+    files = [str(f) for f in rglob(tmp_path, absolute=True)]
+    graph = ImportGraph.from_files(tmp_path, files)
+
+    shards = partition(graph, files, 3)
+    assert len(shards) == 3
+    assert sorted(sum(shards, [])) == sorted(files)
+    # files that import each other stay together
+    connected = sorted(
+        str(tmp_path / f) for f in ["a.proto", "b.proto", "common/root.proto"]
+    )
+    assert connected in shards
+    assert sorted(len(shard) for shard in shards) == [2, 2, 3]
+
+    # components larger than a balanced batch are split
+    assert partition(graph, files, 100) == [[f] for f in sorted(files)]
+    assert partition(graph, files, 1) == [sorted(files)]
+
+
+def test_partition_splits_shared_root(tmp_path: Path) -> None:
+    (tmp_path / "root.proto").write_text('syntax = "proto3";\n')
+    for i in range(8):
+        (tmp_path / ("%d.proto" % i)).write_text(
+            'syntax = "proto3";\nimport "root.proto";\n'
+        )
+    files = [str(f) for f in rglob(tmp_path, absolute=True)]
+    graph = ImportGraph.from_files(tmp_path, files)
+    assert len(graph.components()) == 1
+
+    shards = partition(graph, files, 4)
+    assert sorted(len(shard) for shard in shards) == [2, 2, 2, 3]
+    assert sorted(sum(shards, [])) == sorted(files)
+
+
+@requires_protoc
+def test_sharded_output_is_identical(
+    release_server: ReleaseServer, tmp_path: Path, cache_dir: Path
+) -> None:
+    source_dir = tmp_path / "protos"
+    shutil.copytree(PROTO_DIR, source_dir)
+    write_protos(source_dir)
+    install_protoc(release_server, cache_dir, "1.0", fake_protoc(""))
+    release_server.httpd.shutdown()
+
+    def build(out_dir: Path, shards: int, jobs: int) -> None:
+        options = BaseCompilerOptions(
+            proto_source_dir=source_dir,
+            output_dir=out_dir,
+            protoc_version="1.0",
+            shards=shards,
+            jobs=jobs,
+        )
+        proto_compile.compile(
+            CompilerOptions(
+                base_options=options,
+                targets=[CompileTarget(Target.PYTHON), CompileTarget(Target.CPP)],
+            )
+        )
+
+    build(tmp_path / "single", shards=1, jobs=1)
+    # the component of the shared root is larger than a shard and is split
+    build(tmp_path / "sharded", shards=3, jobs=0)
+    build(tmp_path / "serial", shards=3, jobs=1)
+
+    outputs = sorted(str(f) for f in rglob(tmp_path / "single"))
+    assert len(outputs) == 18
+    for out_dir in ["sharded", "serial"]:
+        assert sorted(str(f) for f in rglob(tmp_path / out_dir)) == outputs
+        _, mismatch, errors = filecmp.cmpfiles(
+            tmp_path / "single", tmp_path / out_dir, outputs, shallow=False
+        )
+        assert mismatch == errors == []
+
+
+def test_compilation_error_contains_diagnostics() -> None:
+    error = subprocess.CalledProcessError(
+        1, "protoc", output=b"a.proto:1:1: Expected top-level statement.\n"
+    )
+    message = str(
+        proto_compile.CompilationError([(CompileTarget(Target.PYTHON), error)])
+    )
+    assert "1 target(s) failed to compile" in message
+    assert "    a.proto:1:1: Expected top-level statement." in message
+
+
+@pytest.mark.parametrize("option", [["--jobs", "-1"], ["--shards", "0"]])
+def test_cli_rejects_invalid_parallelism(option: typing.List[str]) -> None:
+    result = CliRunner().invoke(
+        cli.proto_compile, [PROTO_DIR, "out"] + option + ["python-grpc"]
+    )
+    assert result.exit_code == 2
+    assert "Invalid value" in result.output
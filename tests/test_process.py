@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+
+"""Tests for the streaming process runner."""
+
+import subprocess
+import threading
+import time
+import typing
+from pathlib import Path
+
+import pytest
+from conftest import SYSTEM_PROTOC, python, requires_protoc, write_protos
+
+from proto_compile.process import (
+    STDERR,
+    STDOUT,
+    EventSink,
+    FileSink,
+    OutputEvent,
+    ProcessCancelledError,
+    ProcessError,
+    run,
+)
+from proto_compile.proto_compile import DefaultProtoCompiler
+
+
+def test_streams_lines_into_sink() -> None:
+    events: typing.List[OutputEvent] = []
+    output = run(
+        python(
+            "import sys; print('out'); sys.stdout.flush(); print('err', file=sys.stderr)"
+        ),
+        sink=EventSink(events.append),
+    )
+    assert sorted((e.stream, e.line) for e in events) == [
+        (STDERR, "err"),
+        (STDOUT, "out"),
+    ]
+    assert sorted(output.splitlines()) == ["err", "out"]
+
+
+def test_keeps_only_the_tail() -> None:
+    with pytest.raises(ProcessError) as e:
+        run(
+            python("import sys\nfor i in range(1000): print(i)\nsys.exit(3)"),
+            tail=2,
+        )
+    assert e.value.returncode == 3
+    assert e.value.output == "998\n999"
+    assert str(e.value).endswith("exit status 3.\n998\n999")
+
+
+def test_file_sink(tmp_path: Path) -> None:
+    with FileSink(tmp_path / "build.log") as sink:
+        run("echo hello", shell=True, sink=sink)
+        run("echo again", shell=True, sink=sink)
+    assert sink.file.closed
+    assert (tmp_path / "build.log").read_text() == ("[stdout] hello\n[stdout] again\n")
+
+
+def test_timeout_kills_process() -> None:
+    started = time.monotonic()
+    with pytest.raises(subprocess.TimeoutExpired) as e:
+        run("echo started; sleep 10", shell=True, timeout=0.5)
+    assert time.monotonic() - started < 5
+    assert e.value.output == "started"
+
+
+def test_cancel() -> None:
+    cancel = threading.Event()
+    threading.Timer(0.2, cancel.set).start()
+    with pytest.raises(ProcessCancelledError):
+        run(["sleep", "10"], cancel=cancel)
+
+
+def recording_protoc(tmp_path: Path) -> Path:
+    """A protoc that records its arguments and the contents of its @argfile"""
+    protoc = tmp_path / "bin dir" / "protoc"
+    protoc.parent.mkdir()
+    protoc.write_text(
+        "#!/bin/sh\n"
+        'for arg in "$@"; do echo "$arg"; done > "%s"\n'
+        'case "$1" in @*) cat "${1#@}" >> "%s";; esac\n'
+        % (tmp_path / "argv", tmp_path / "argv")
+    )
+    protoc.chmod(0o755)
+    return protoc
+
+
+def test_protoc_runs_without_shell(tmp_path: Path) -> None:
+    protoc = recording_protoc(tmp_path)
+    arguments = ["-I=/protos with spaces", "/protos with spaces/a.proto", "$HOME"]
+    DefaultProtoCompiler(protoc).compile(arguments)
+    assert (tmp_path / "argv").read_text().splitlines() == arguments
+
+
+def test_protoc_argfile_for_long_command_lines(tmp_path: Path) -> None:
+    protoc = recording_protoc(tmp_path)
+    compiler = DefaultProtoCompiler(protoc)
+    compiler.max_command_length = 1000
+    arguments = ["/protos/file_%d.proto" % i for i in range(100)]
+    compiler.compile(arguments)
+    argv = (tmp_path / "argv").read_text().splitlines()
+    assert argv[0].startswith("@")
+    assert argv[1:] == arguments
+    # the argfile is removed afterwards
+    assert not Path(argv[0][1:]).exists()
+
+
+@requires_protoc
+def test_protoc_reads_argfile(tmp_path: Path) -> None:
+    assert SYSTEM_PROTOC is not None
+    source_dir = tmp_path / "protos with spaces"
+    write_protos(source_dir)
+    (tmp_path / "out").mkdir()
+    compiler = DefaultProtoCompiler(SYSTEM_PROTOC)
+    compiler.max_command_length = 10
+    compiler.compile(
+        ["-I={}".format(source_dir), "--python_out={}".format(tmp_path / "out")]
+        + [str(source_dir / name) for name in ["a.proto", "b.proto", "leaf.proto"]]
+    )
+    assert (tmp_path / "out" / "b_pb2.py").exists()
@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+
+"""Tests for the build profiling."""
+
+import contextvars
+import json
+import logging
+import threading
+import time
+from pathlib import Path
+
+import pytest
+from conftest import ReleaseServer, fake_protoc, requires_protoc
+
+from proto_compile import mirrors, plugins, profiling, proto_compile
+from proto_compile.options import BaseCompilerOptions, CompilerOptions, CompileTarget
+from proto_compile.versions import DEFAULT_PROTOC_VERSION, Target
+
+
+def test_spans_are_only_recorded_while_profiling(tmp_path: Path) -> None:
+    with profiling.span("ignored"):
+        pass
+    with profiling.profiled(tmp_path):
+        (profiler,) = profiling._active.get()
+
+        def work() -> None:
+            with profiling.span("work", "test", index=1):
+                time.sleep(0.01)
+
+        # threads record into the profilers of the context they run in
+        threads = [
+            threading.Thread(target=contextvars.copy_context().run, args=(work,))
+            for _ in range(2)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        with pytest.raises(RuntimeError):
+            with profiling.span("failed"):
+                raise RuntimeError()
+    assert profiling._active.get() == ()
+
+    work_total, failed_total = profiler.totals()
+    assert work_total["name"] == "work"
+    assert work_total["count"] == 2
+    assert work_total["total"] >= 0.02
+    assert failed_total["name"] == "failed"
+
+    trace = json.loads((tmp_path / profiling.TRACE_FILE).read_text())
+    events = trace["traceEvents"]
+    assert [e["name"] for e in events] == ["work", "work", "failed"]
+    assert all(e["ph"] == "X" and e["dur"] > 0 for e in events[:2])
+    # every thread is a separate track
+    assert sorted(e["tid"] for e in events[:2]) == [0, 1]
+    assert events[0]["args"] == dict(index=1)
+    report = json.loads((tmp_path / profiling.REPORT_FILE).read_text())
+    assert len(report["spans"]) == 3
+
+
+@requires_protoc
+def test_profile_compile(
+    release_server: ReleaseServer,
+    tmp_path: Path,
+    cache_dir: Path,
+    caplog: pytest.LogCaptureFixture,
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    release_server.add_protoc_release(
+        DEFAULT_PROTOC_VERSION, fake_protoc(""), subdir=mirrors.PROTOC_DIR
+    )
+    source_dir = tmp_path / "protos"
+    source_dir.mkdir()
+    (source_dir / "a.proto").write_text('syntax = "proto3";\nmessage A {}\n')
+    options = BaseCompilerOptions(
+        proto_source_dir=source_dir,
+        output_dir=tmp_path / "out",
+        embedded_protoc=False,
+        profile=tmp_path / "profile",
+        mirror=release_server.url,
+    )
+    monkeypatch.setattr(plugins, "protoc_release_sha256", lambda version, url: None)
+    caplog.set_level(logging.INFO, logger="proto_compile")
+    proto_compile.compile(
+        CompilerOptions(options, targets=[CompileTarget(Target.PYTHON)])
+    )
+
+    report = json.loads((tmp_path / "profile" / profiling.REPORT_FILE).read_text())
+    names = {total["name"] for total in report["totals"]}
+    assert {
+        "discover",
+        "bootstrap",
+        "install protoc",
+        "download",
+        "extract",
+        "compile python",
+    } <= names
+    assert (tmp_path / "profile" / profiling.TRACE_FILE).exists()
+    assert "wall time" in caplog.text
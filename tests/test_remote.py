@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+
+"""Tests for the remote cache of generated outputs."""
+
+import http.server
+import shutil
+import threading
+import typing
+from pathlib import Path
+
+import pytest
+from conftest import make_options, write_protos
+
+from proto_compile import proto_compile, remote
+from proto_compile.utils import rglob
+from proto_compile.versions import Target
+
+GRPC_TARGETS = [Target.PYTHON, Target.PYTHON_GRPC]
+
+
+class BundleServer:
+    """HTTP server that stores the bodies of PUT requests in memory"""
+
+    def __init__(self) -> None:
+        self.bundles: typing.Dict[str, bytes] = dict()
+        server = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self) -> None:
+                content = server.bundles.get(self.path)
+                if content is None:
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header("Content-Length", str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+            def do_PUT(self) -> None:
+                length = int(self.headers["Content-Length"])
+                server.bundles[self.path] = self.rfile.read(length)
+                self.send_response(201)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+
+            def log_message(self, format: str, *args: typing.Any) -> None:
+                pass
+
+        self.httpd = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    @property
+    def url(self) -> str:
+        return "http://127.0.0.1:%d/cache" % self.httpd.server_address[1]
+
+
+@pytest.fixture
+def bundle_server() -> typing.Iterator[BundleServer]:
+    server = BundleServer()
+    server.thread.start()
+    try:
+        yield server
+    finally:
+        server.httpd.shutdown()
+        server.httpd.server_close()
+
+
+@pytest.mark.parametrize("backend", ["dir", "file", "http"])
+def test_backend_roundtrip(
+    backend: str, tmp_path: Path, bundle_server: BundleServer
+) -> None:
+    location = dict(
+        dir=str(tmp_path / "remote"),
+        file=(tmp_path / "remote").as_uri(),
+        http=bundle_server.url,
+    )[backend]
+    cache = remote.remote_cache(location)
+    src = tmp_path / "bundle"
+    src.write_bytes(b"bundle")
+    dest = tmp_path / "fetched"
+
+    assert not cache.get("ab" * 32, dest)
+    cache.put("ab" * 32, src)
+    assert cache.get("ab" * 32, dest)
+    assert dest.read_bytes() == b"bundle"
+
+
+def test_pack_unpack(tmp_path: Path) -> None:
+    (tmp_path / "a" / "pkg").mkdir(parents=True)
+    (tmp_path / "a" / "pkg" / "a.py").write_text("a")
+    (tmp_path / "b").mkdir()
+    (tmp_path / "b" / "b.js").write_text("b")
+    bundle = tmp_path / "bundle.tar.gz"
+    remote.pack([tmp_path / "a", tmp_path / "b"], bundle)
+
+    dirs = [tmp_path / "x", tmp_path / "y"]
+    remote.unpack(bundle, dirs, tmp_path)
+    assert (tmp_path / "x" / "pkg" / "a.py").read_text() == "a"
+    assert (tmp_path / "y" / "b.js").read_text() == "b"
+
+    bundle.write_bytes(b"corrupt")
+    with pytest.raises(remote.RemoteCacheError):
+        remote.unpack(bundle, dirs, tmp_path)
+
+
+def test_outputs_key(tmp_path: Path) -> None:
+    def key(source_dir: Path, **kwargs: typing.Any) -> str:
+        opts = make_options(
+            tmp_path,
+            GRPC_TARGETS,
+            proto_source_dir=source_dir,
+            output_dir=source_dir / "out",
+            **kwargs
+        )
+        files = sorted(str(f) for f in source_dir.rglob("*.proto"))
+        output_dirs = [str(source_dir / "out")]
+        return remote.outputs_key(opts, [str(source_dir)], files, output_dirs)
+
+    write_protos(tmp_path / "a")
+    write_protos(tmp_path / "b")
+    # independent of the checkout path
+    assert key(tmp_path / "a") == key(tmp_path / "b")
+    assert key(tmp_path / "a") != key(tmp_path / "a", protoc_version="1.0")
+    assert key(tmp_path / "a") != key(tmp_path / "a", descriptor_set=True)
+    (tmp_path / "b" / "common" / "root.proto").write_text(
+        'syntax = "proto3";\nmessage Root { string name = 1; }\n'
+    )
+    assert key(tmp_path / "a") != key(tmp_path / "b")
+
+    with pytest.raises(ValueError, match="not pinned"):
+        remote.target_version(Target.GO, None)
+    assert remote.target_version(Target.GO, "v1.0.0") == "v1.0.0"
+
+
+def test_compile_fetches_outputs_from_remote_cache(
+    tmp_path: Path, bundle_server: BundleServer, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    write_protos(tmp_path / "a" / "protos")
+    shutil.copytree(tmp_path / "a" / "protos", tmp_path / "b" / "protos")
+    proto_compile.compile(
+        make_options(
+            tmp_path,
+            GRPC_TARGETS,
+            proto_source_dir=tmp_path / "a" / "protos",
+            output_dir=tmp_path / "a" / "out",
+            remote_cache=bundle_server.url,
+        )
+    )
+    assert len(bundle_server.bundles) == 1
+
+    def install_toolchain(*args: typing.Any) -> None:
+        raise AssertionError("the toolchain must not be installed")
+
+    # another worker with another checkout path
+    monkeypatch.setattr(proto_compile, "install_toolchain", install_toolchain)
+    proto_compile.compile(
+        make_options(
+            tmp_path,
+            GRPC_TARGETS,
+            proto_source_dir=tmp_path / "b" / "protos",
+            output_dir=tmp_path / "b" / "out",
+            remote_cache=bundle_server.url,
+            remote_cache_read_only=True,
+        )
+    )
+    expected = sorted(str(f) for f in rglob(tmp_path / "a" / "out"))
+    assert "a_pb2_grpc.py" in expected
+    assert sorted(str(f) for f in rglob(tmp_path / "b" / "out")) == expected
+    for name in expected:
+        assert (tmp_path / "b" / "out" / name).read_bytes() == (
+            tmp_path / "a" / "out" / name
+        ).read_bytes()
+
+
+def test_compile_with_corrupt_bundle(tmp_path: Path) -> None:
+    write_protos(tmp_path / "protos")
+    opts = make_options(tmp_path, GRPC_TARGETS, remote_cache=tmp_path / "remote")
+    proto_compile.compile(opts)
+    (bundle,) = (tmp_path / "remote").rglob("*" + remote.BUNDLE_SUFFIX)
+    bundle.write_bytes(b"corrupt")
+    shutil.rmtree(tmp_path / "out")
+
+    # falls back to compiling and replaces the corrupt bundle
+    proto_compile.compile(opts)
+    assert (tmp_path / "out" / "a_pb2_grpc.py").exists()
+    assert bundle.read_bytes() != b"corrupt"
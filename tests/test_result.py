@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+
+"""Tests for the structured results of compilations."""
+
+import concurrent.futures
+import os
+import typing
+from pathlib import Path
+
+import pytest
+from conftest import make_options, write_protos
+
+from proto_compile import plugins, proto_compile
+from proto_compile.result import CompileResult
+from proto_compile.versions import Target
+
+GRPC_TARGETS = [Target.PYTHON, Target.PYTHON_GRPC]
+
+
+def names(files: typing.List[str]) -> typing.List[str]:
+    return sorted(os.path.basename(f) for f in files)
+
+
+def test_compile_result(tmp_path: Path, capsys: pytest.CaptureFixture[str]) -> None:
+    write_protos(tmp_path / "protos")
+    compiled = proto_compile.compile(make_options(tmp_path, GRPC_TARGETS))
+    assert isinstance(compiled, CompileResult)
+    # both targets write into the same output dir
+    assert "leaf_pb2.py" in names(compiled.outputs["PYTHON"])
+    assert "leaf_pb2_grpc.py" not in names(compiled.outputs["PYTHON"])
+    assert "leaf_pb2_grpc.py" in names(compiled.outputs["PYTHON_GRPC"])
+    assert sorted(compiled.written) == sorted(
+        compiled.outputs["PYTHON"] + compiled.outputs["PYTHON_GRPC"]
+    )
+    assert {"discover", "bootstrap", "reconcile outputs"} <= set(compiled.timings)
+    assert compiled.wall_time >= compiled.timings["bootstrap"]
+    assert compiled.versions["protoc"] == plugins.embedded_protoc_version()
+    assert "PYTHON_GRPC" in compiled.versions
+    assert compiled.diagnostics == []
+
+    recompiled = proto_compile.compile(
+        make_options(tmp_path, GRPC_TARGETS, remote_cache=tmp_path / "remote")
+    )
+    assert recompiled.written == []
+    assert recompiled.cache == dict(remote=False)
+    fetched = proto_compile.compile(
+        make_options(tmp_path, GRPC_TARGETS, remote_cache=tmp_path / "remote")
+    )
+    assert fetched.cache == dict(remote=True)
+    assert fetched.outputs == recompiled.outputs
+    # nothing is printed without a configured handler
+    assert capsys.readouterr().out == ""
+
+
+def test_diagnostics(tmp_path: Path) -> None:
+    (tmp_path / "empty").mkdir()
+    compiled = proto_compile.compile(
+        make_options(tmp_path, GRPC_TARGETS, proto_source_dir=tmp_path / "empty")
+    )
+    assert compiled.outputs == dict()
+    ((level, logger, message),) = compiled.diagnostics
+    assert (level, logger) == ("WARNING", "proto_compile.proto_compile")
+    assert message.endswith("does not contain any .proto files. Skipping...")
+
+
+def test_concurrent_results_are_separate(tmp_path: Path) -> None:
+    for name in ["a", "b"]:
+        write_protos(tmp_path / name)
+    (tmp_path / "empty").mkdir()
+    sources = ["a", "b", "empty"]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=3) as pool:
+        results = list(
+            pool.map(
+                lambda name: proto_compile.compile(
+                    make_options(
+                        tmp_path,
+                        GRPC_TARGETS,
+                        proto_source_dir=tmp_path / name,
+                        output_dir=tmp_path / "out" / name,
+                    )
+                ),
+                sources,
+            )
+        )
+    for name, compiled in zip(sources, results):
+        files = compiled.outputs.get("PYTHON", [])
+        assert all(f.startswith(str(tmp_path / "out" / name)) for f in files)
+        assert len(compiled.diagnostics) == (1 if name == "empty" else 0)
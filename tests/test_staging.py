@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+
+"""Tests for staging and reconciling the generated outputs."""
+
+import os
+from pathlib import Path
+
+from conftest import make_options, write_protos
+
+from proto_compile import proto_compile
+from proto_compile.staging import OutputStaging, same_content
+
+
+def write(path: Path, content: str) -> Path:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(content)
+    return path
+
+
+def test_same_content(tmp_path: Path) -> None:
+    a = write(tmp_path / "a", "content")
+    assert same_content(a, write(tmp_path / "b", "content"))
+    assert not same_content(a, write(tmp_path / "c", "changed"))
+    assert not same_content(a, tmp_path / "missing")
+
+
+def test_reconcile_writes_only_changed_files(tmp_path: Path) -> None:
+    out = tmp_path / "out"
+    unchanged = write(out / "pkg" / "unchanged.py", "same")
+    changed = write(out / "pkg" / "changed.py", "old")
+    stale = write(out / "stale" / "removed.py", "stale")
+    nested = write(out / "js" / "a.js", "same")
+    for path in [unchanged, changed, stale, nested]:
+        os.utime(path, ns=(0, 0))
+
+    staging = OutputStaging(tmp_path / "staging")
+    staged = Path(staging.stage(out, clear=True))
+    staged_js = Path(staging.stage(out / "js"))
+    assert staging.stage(str(out) + "/") == str(staged)
+    write(staged / "pkg" / "unchanged.py", "same")
+    write(staged / "pkg" / "changed.py", "new")
+    write(staged / "pkg" / "added.py", "added")
+    write(staged_js / "a.js", "same")
+
+    reconciled = staging.reconcile()
+    assert sorted(reconciled.written) == [
+        str(out / "pkg" / "added.py"),
+        str(changed),
+    ]
+    assert reconciled.removed == [str(stale)]
+    assert len(reconciled.outputs) == 4
+    assert changed.read_text() == "new"
+    # unchanged files and the outputs of nested output dirs keep their mtime
+    assert unchanged.stat().st_mtime_ns == 0
+    assert nested.stat().st_mtime_ns == 0
+    assert not (out / "stale").exists()
+
+
+def test_reconcile_keeps_other_files(tmp_path: Path) -> None:
+    out = tmp_path / "out"
+    other = write(out / "other.txt", "other")
+    staging = OutputStaging(tmp_path / "staging")
+    write(Path(staging.stage(out)) / "a.py", "a")
+    assert staging.reconcile().removed == []
+    assert other.exists()
+    assert (out / "a.py").read_text() == "a"
+
+
+def test_recompile_keeps_mtimes_of_unchanged_outputs(tmp_path: Path) -> None:
+    write_protos(tmp_path / "protos")
+    stale = write(tmp_path / "out" / "stale_pb2.py", "")
+    options = make_options(tmp_path, clear_output_dirs=True)
+    proto_compile.compile(options)
+    output = tmp_path / "out" / "leaf_pb2.py"
+    assert output.exists()
+    assert not stale.exists()
+
+    os.utime(output, ns=(0, 0))
+    proto_compile.compile(options)
+    assert output.stat().st_mtime_ns == 0
+
+    (tmp_path / "protos" / "leaf.proto").write_text(
+        'syntax = "proto3";\nmessage Changed {}\n'
+    )
+    proto_compile.compile(options)
+    assert output.stat().st_mtime_ns > 0
@@ -0,0 +1,17 @@
+# -*- coding: utf-8 -*-
+
+"""Tests that the cli does not import heavy dependencies on startup."""
+
+import subprocess
+import sys
+
+import pytest
+
+
+@pytest.mark.parametrize(
+    "module", ["grpc_tools.protoc", "pkg_resources", "urllib.request", "asyncio"]
+)
+def test_cli_imports_lazily(module: str) -> None:
+    code = "import sys, proto_compile.cli; print({!r} in sys.modules)".format(module)
+    output = subprocess.check_output([sys.executable, "-c", code], text=True)
+    assert output.strip() == "False"
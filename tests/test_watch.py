@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+
+"""Tests for the watch mode."""
+
+import threading
+import time
+import typing
+from pathlib import Path
+
+import pytest
+from conftest import write_protos
+
+from proto_compile import watch
+from proto_compile.options import BaseCompilerOptions, CompilerOptions, CompileTarget
+from proto_compile.versions import Target
+
+
+def wait_for(condition: typing.Callable[[], bool], timeout: float = 5) -> None:
+    deadline = time.time() + timeout
+    while not condition():
+        assert time.time() < deadline, "timed out"
+        time.sleep(0.01)
+
+
+@pytest.fixture(params=["inotify", "polling"])
+def watcher(
+    request: pytest.FixtureRequest, monkeypatch: pytest.MonkeyPatch
+) -> typing.Iterator[str]:
+    if request.param == "polling":
+        monkeypatch.setattr(
+            watch,
+            "watcher",
+            lambda dirs, poll_interval: watch.PollingWatcher(dirs, interval=0.02),
+        )
+    else:
+        try:
+            watch.InotifyWatcher([watch.WatchedDir(".")]).close()
+        except (OSError, AttributeError, TypeError):
+            pytest.skip("inotify is not available")
+    yield request.param
+
+
+def test_recompiles_changed_protos(tmp_path: Path, watcher: str) -> None:
+    source_dir = tmp_path / "protos"
+    write_protos(source_dir)
+    options = CompilerOptions(
+        BaseCompilerOptions(
+            proto_source_dir=source_dir, output_dir=source_dir, watch=True
+        ),
+        targets=[CompileTarget(Target.PYTHON)],
+    )
+    compiled: typing.List[CompilerOptions] = []
+
+    def compile(options: CompilerOptions) -> None:
+        compiled.append(options)
+        if len(compiled) == 3:
+            raise RuntimeError("syntax error")
+
+    stop = threading.Event()
+    thread = threading.Thread(
+        target=watch.watch,
+        args=(options, compile),
+        kwargs=dict(debounce=0.2, poll_interval=0.05, stop=stop),
+    )
+    thread.start()
+    try:
+        wait_for(lambda: len(compiled) == 1)
+        assert compiled[0].incremental and not compiled[0].watch
+
+        # generated files do not trigger a compilation
+        (source_dir / "a_pb2.py").write_text("generated")
+        # a burst of saves is compiled once
+        for i in range(3):
+            (source_dir / "a.proto").write_text('syntax = "proto3";' + " " * i)
+            time.sleep(0.02)
+        wait_for(lambda: len(compiled) == 2)
+
+        # failed compilations do not stop watching
+        (source_dir / "new").mkdir()
+        (source_dir / "new" / "c.proto").write_text('syntax = "proto3";')
+        wait_for(lambda: len(compiled) == 3)
+        (source_dir / "new" / "c.proto").unlink()
+        wait_for(lambda: len(compiled) == 4)
+
+        time.sleep(0.5)
+        assert len(compiled) == 4
+    finally:
+        stop.set()
+        thread.join()
+
+
+def test_watches_all_source_roots_and_include_dirs(
+    tmp_path: Path, watcher: str
+) -> None:
+    for name in ["protos", "extra", "vendor"]:
+        (tmp_path / name).mkdir()
+        (tmp_path / name / (name + ".proto")).write_text('syntax = "proto3";')
+    options = CompilerOptions(
+        BaseCompilerOptions(
+            proto_source_dir=tmp_path / "protos",
+            output_dir=tmp_path / "out",
+            extra_source_dirs=[str(tmp_path / "extra")],
+            include_dirs=[str(tmp_path / "vendor")],
+            watch=True,
+        ),
+        targets=[CompileTarget(Target.PYTHON)],
+    )
+    compiled: typing.List[CompilerOptions] = []
+    stop = threading.Event()
+    thread = threading.Thread(
+        target=watch.watch,
+        args=(options, compiled.append),
+        kwargs=dict(debounce=0.1, poll_interval=0.05, stop=stop),
+    )
+    thread.start()
+    try:
+        wait_for(lambda: len(compiled) == 1)
+        # the snapshot is taken after the first compilation
+        time.sleep(0.2)
+        (tmp_path / "extra" / "extra.proto").write_text('syntax = "proto3"; ')
+        wait_for(lambda: len(compiled) == 2)
+        (tmp_path / "vendor" / "vendor.proto").write_text('syntax = "proto3"; ')
+        wait_for(lambda: len(compiled) == 3)
+    finally:
+        stop.set()
+        thread.join()
+
+
+def test_inotify_only_watches_discovered_dirs(tmp_path: Path) -> None:
+    for name in ["a/b", "node_modules/x", ".git/objects", "skip", "gen"]:
+        (tmp_path / name).mkdir(parents=True)
+    (tmp_path / ".gitignore").write_text("gen/\n")
+    try:
+        watcher = watch.InotifyWatcher(
+            [watch.WatchedDir(str(tmp_path), exclude=["skip/"])]
+        )
+    except (OSError, AttributeError, TypeError):
+        pytest.skip("inotify is not available")
+
+    def watched() -> typing.List[str]:
+        watcher.wait(0.01)
+        return sorted(path for _, path in watcher.watches.values())
+
+    try:
+        assert watched() == [str(tmp_path / d) for d in ["", "a", "a/b"]]
+
+        # files that are not included do not count
+        (tmp_path / "a" / "a_pb2.py").write_text("generated")
+        assert not watcher.wait(0.2)
+
+        # created dirs are watched without walking the tree again
+        (tmp_path / "new" / "c").mkdir(parents=True)
+        (tmp_path / "node_modules" / "y").mkdir()
+        assert watcher.wait(1)
+        wait_for(lambda: str(tmp_path / "new" / "c") in watched())
+        (tmp_path / "new" / "c" / "c.proto").write_text('syntax = "proto3";')
+        assert watcher.wait(1)
+        assert not any("node_modules" in path for path in watched())
+
+        (tmp_path / "new").rename(tmp_path / "moved")
+        expected = [str(tmp_path / d) for d in ["", "a", "a/b", "moved", "moved/c"]]
+        wait_for(lambda: watched() == expected)
+    finally:
+        watcher.close()